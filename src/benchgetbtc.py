@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This module benchmarks getbtc against the local mock server.
+Each scenario runs in its own process so that the peak RSS of the scenario can be measured.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import datetime
+import multiprocessing
+import logger
+import mockserver
+from synthetic import SyntheticExecutions
+
+
+# getbtcの日付は日本時間
+JST_OFFSET = datetime.timedelta(hours=9)
+
+
+def run_scenario(scenario, domain_url, work_dir, result_queue):
+    # type: (dict, str, str, multiprocessing.Queue) -> None
+    """
+    シナリオを子プロセスで実行し、結果をキューへ入れる
+    :param scenario: シナリオ. name, kind(search or backfill), start_date, workers, requests_per_window, repeat
+    :param domain_url: モックサーバのURL
+    :param work_dir: 作業ディレクトリ. data, index, logを作る
+    :param result_queue: 結果を返すキュー
+    :return:
+    """
+    for dir_name in ['data', 'index', 'log']:
+        os.makedirs(os.path.join(work_dir, dir_name))
+    os.chdir(work_dir)
+
+    import getbtc
+    import storage
+    root_logger = logger.Logger('WARNING')
+
+    get_btc = getbtc.GetBtcDataFromBitflyer(scenario['start_date'], None, root_logger,
+                                            workers=scenario['workers'],
+                                            requests_per_window=scenario['requests_per_window'])
+    get_btc.domain_url = domain_url
+
+    result = {'rows': 0, 'probes': []}
+    start_time = time.time()
+    if scenario['kind'] == 'search':
+        # 同じ日付を繰り返し検索する. 2回目以降はインデックスが効く
+        for _ in range(scenario['repeat']):
+            get_btc.search_before_id_pipeline(scenario['start_date'])
+            result['probes'].append(get_btc.search_probe_count)
+    else:
+        get_btc.run()
+        result['probes'].append(get_btc.search_probe_count)
+        btc_storage = storage.BtcStorage('./data')
+        result['rows'] = sum(len(btc_storage.load(x, columns=['id'])) for x in btc_storage.list_files())
+    result['seconds'] = time.time() - start_time
+    result['retries'] = get_btc.transport.retry_count
+    # Linuxではキロバイト
+    result['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    result_queue.put(result)
+
+
+class GetBtcBenchmark(object):
+    """
+    This class runs the benchmark scenarios of getbtc.
+    """
+
+    def __init__(self, root_logger, executions, server, backfill_sizes, workers_list, requests_per_window):
+        # type: (logger, SyntheticExecutions, MockBitflyerServer, list, list, float) -> None
+        """
+        Class initialization.
+        :param root_logger: ロガー
+        :param executions: モックサーバの約定の履歴
+        :param server: モックサーバ
+        :param backfill_sizes: 取得する約定数のリスト
+        :param workers_list: ワーカ数のリスト
+        :param requests_per_window: getbtcのリクエスト数の上限
+        """
+        self.logger = root_logger
+        self.executions = executions
+        self.server = server
+        self.backfill_sizes = backfill_sizes
+        self.workers_list = workers_list
+        self.requests_per_window = requests_per_window
+        # 子プロセスは親のメモリを引き継がないようにspawnで起動する
+        self.context = multiprocessing.get_context('spawn')
+
+    def get_date_of_id(self, exec_id):
+        # type: (int) -> datetime
+        """
+        idの約定の日時(日本時間)を分単位に切り捨てて返す
+        :param exec_id: id
+        :return: 日本時間の日時
+        """
+        date_ms = int(self.executions.date_ms[exec_id - 1])
+        date = datetime.datetime(1970, 1, 1) + datetime.timedelta(milliseconds=date_ms) + JST_OFFSET
+        return date.replace(second=0, microsecond=0)
+
+    def get_scenarios(self):
+        # type: () -> list
+        """
+        シナリオのリスト
+        :return: シナリオのリスト
+        """
+        scenarios = [{'name': 'search', 'kind': 'search', 'workers': 1, 'repeat': 3,
+                      'start_date': self.get_date_of_id(self.executions.size // 3)}]
+        for size in self.backfill_sizes:
+            for workers in self.workers_list:
+                scenarios.append({'name': 'backfill {} rows, {} workers'.format(size, workers),
+                                  'kind': 'backfill', 'workers': workers, 'repeat': 1,
+                                  'start_date': self.get_date_of_id(self.executions.size - size + 1)})
+        for scenario in scenarios:
+            scenario['requests_per_window'] = self.requests_per_window
+        return scenarios
+
+    def run(self):
+        # type: () -> list
+        """
+        全てのシナリオを実行する
+        :return: 結果のリスト
+        """
+        results = []
+        for scenario in self.get_scenarios():
+            work_dir = tempfile.mkdtemp(prefix='benchgetbtc_')
+            try:
+                self.server.reset_count()
+                result_queue = self.context.Queue()
+                process = self.context.Process(target=run_scenario,
+                                               args=(scenario, self.server.url, work_dir, result_queue))
+                process.start()
+                result = result_queue.get()
+                process.join()
+            finally:
+                shutil.rmtree(work_dir)
+
+            result['name'] = scenario['name']
+            result['requests'] = self.server.request_count
+            result['status'] = dict(self.server.status_count)
+            result['rows_per_sec'] = result['rows'] / result['seconds']
+            result['requests_per_sec'] = result['requests'] / result['seconds']
+            self.logger.logger.info('{}: {}'.format(scenario['name'], self.format_result(result)))
+            results.append(result)
+        return results
+
+    @staticmethod
+    def format_result(result):
+        # type: (dict) -> str
+        """
+        結果を1行にする
+        :param result: 結果
+        :return: 文字列
+        """
+        return ('{:.2f} sec, {} rows, {:.0f} rows/sec, {} requests, {:.1f} requests/sec, probes {}, '
+                'retries {}, peak rss {:.1f} MB'.format(result['seconds'], result['rows'], result['rows_per_sec'],
+                                                     result['requests'], result['requests_per_sec'],
+                                                     result['probes'], result['retries'], result['peak_rss_mb']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--executions', help='number of synthetic executions', action='store', type=int,
+                        default=2000000)
+    parser.add_argument('-s', '--sizes', help='comma separated backfill sizes in rows', action='store',
+                        default='10000,100000')
+    parser.add_argument('-w', '--workers', help='comma separated numbers of workers', action='store',
+                        default='1,4')
+    parser.add_argument('-r', '--rate', help='requests per second of getbtc', action='store', type=float,
+                        default=1000.0)
+    parser.add_argument('--latency', help='mean latency of the mock server in seconds', action='store',
+                        type=float, default=0.0)
+    parser.add_argument('--error-rate', help='rate of 500 responses', action='store', type=float, default=0.0)
+    parser.add_argument('--empty-rate', help='rate of empty bodies', action='store', type=float, default=0.0)
+    parser.add_argument('--limit', help='requests per window of the mock server before 429', action='store',
+                        type=int, default=0)
+    parser.add_argument('--window', help='window of the limit in seconds', action='store', type=float, default=1.0)
+    parser.add_argument('-o', '--output', help='json file to write the results', action='store', required=False)
+
+    args = parser.parse_args()
+    assert os.path.exists('./log'), 'Please make directry: log dirctory'
+    logger = logger.Logger()
+    logger.logger.info('START benchmark getbtc')
+
+    # 子プロセスからsrcのモジュールを読み込めるようにする
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    executions = SyntheticExecutions(args.executions)
+    server = mockserver.MockBitflyerServer(executions, latency=args.latency, error_rate=args.error_rate,
+                                           empty_rate=args.empty_rate, requests_per_window=args.limit,
+                                           window_seconds=args.window).start()
+    try:
+        benchmark = GetBtcBenchmark(logger, executions, server, [int(x) for x in args.sizes.split(',')],
+                                    [int(x) for x in args.workers.split(',')], args.rate)
+        results = benchmark.run()
+    finally:
+        server.stop()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+        logger.logger.info(' save on {}'.format(args.output))
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This module benchmarks generatehloc on synthetic btc files.
+Each stage of GenerateHLOC.run is timed by the stage metrics for every time axis, and the results are
+appended to a json lines file with the commit so that runs can be compared across commits.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+from datetime import datetime as dt
+import logger
+import tickgenerator
+
+
+def run_scenario(scenario, work_dir, result_queue):
+    # type: (dict, str, multiprocessing.Queue) -> None
+    """
+    一つの時間軸の変換を子プロセスで実行し、ステージごとの時間をキューへ入れる
+    :param scenario: シナリオ. input_dir, time_axis, storage_format, is_stream
+    :param work_dir: 作業ディレクトリ. hloc, logを作る
+    :param result_queue: 結果を返すキュー
+    :return:
+    """
+    for dir_name in ['hloc', 'log']:
+        os.makedirs(os.path.join(work_dir, dir_name))
+    os.chdir(work_dir)
+
+    import generatehloc
+    import metrics
+    root_logger = logger.Logger('WARNING')
+
+    generate_hloc = generatehloc.GenerateHLOC(root_logger, scenario['input_dir'], scenario['time_axis'],
+                                              scenario['storage_format'], scenario['is_stream'])
+    start_time = time.perf_counter()
+    generate_hloc.run()
+    total_seconds = time.perf_counter() - start_time
+
+    # run()の各ステージの合計時間. 読み込み, 日付の変換, 足の集計, 足のまとめ, 保存
+    stage_histogram = metrics.REGISTRY.histogram('hloc_stage_seconds')
+    stages = {x['labels']['stage']: x['sum'] for x in stage_histogram.snapshot()}
+
+    # Linuxではキロバイト
+    result_queue.put({'stages': stages, 'seconds': total_seconds,
+                      'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+                      'hloc_files': sum(1 for x in os.listdir('hloc') if x.startswith('hloc_'))})
+
+
+class HlocBenchmark(object):
+    """
+    This class runs the benchmark of generatehloc for each size and time axis.
+    """
+
+    def __init__(self, root_logger, data_dir, storage_format='csv', is_stream=False, file_lines=500000):
+        # type: (logger, str, str, bool, int) -> None
+        """
+        Class initialization.
+        :param root_logger: ロガー
+        :param data_dir: 生成したbtcファイルを置くディレクトリ. 同じ約定数であれば使い回す
+        :param storage_format: csv or parquet
+        :param is_stream: generatehlocの-sを指定して測る
+        :param file_lines: 一つのbtcファイルの行数
+        """
+        self.logger = root_logger
+        self.data_dir = data_dir
+        self.storage_format = storage_format
+        self.is_stream = is_stream
+        self.file_lines = file_lines
+        self.time_list = ['one_minute', '5_minute', 'one_hour', 'one_day']
+        # 子プロセスは親のメモリを引き継がないようにspawnで起動する
+        self.context = multiprocessing.get_context('spawn')
+
+    def prepare(self, rows):
+        # type: (int) -> str
+        """
+        約定数のbtcファイルを生成する. 生成済みであれば使い回す
+        :param rows: 約定数
+        :return: btcファイルのディレクトリ
+        """
+        input_dir = os.path.abspath(os.path.join(self.data_dir, 'ticks_{}_{}'.format(rows, self.storage_format)))
+        complete_file = os.path.join(input_dir, '.complete')
+        if os.path.exists(complete_file):
+            return input_dir
+
+        if os.path.exists(input_dir):
+            shutil.rmtree(input_dir)
+        os.makedirs(input_dir)
+        self.logger.logger.info('generate {} rows on {}'.format(rows, input_dir))
+        tickgenerator.TickGenerator(self.logger, input_dir, self.storage_format, self.file_lines).run(rows)
+        open(complete_file, 'w').close()
+        return input_dir
+
+    def run(self, rows_list):
+        # type: (list) -> list
+        """
+        約定数と時間軸ごとに変換を測る
+        :param rows_list: 約定数のリスト
+        :return: 結果のリスト
+        """
+        commit = self.get_commit()
+        results = []
+        for rows in rows_list:
+            input_dir = self.prepare(rows)
+            for time_axis in self.time_list:
+                scenario = {'input_dir': input_dir, 'time_axis': time_axis,
+                            'storage_format': self.storage_format, 'is_stream': self.is_stream}
+                work_dir = tempfile.mkdtemp(prefix='benchhloc_')
+                try:
+                    result_queue = self.context.Queue()
+                    process = self.context.Process(target=run_scenario, args=(scenario, work_dir, result_queue))
+                    process.start()
+                    result = result_queue.get()
+                    process.join()
+                finally:
+                    shutil.rmtree(work_dir)
+
+                result.update({'commit': commit, 'date': dt.now().strftime('%Y-%m-%d %H:%M:%S'), 'rows': rows,
+                               'time_axis': time_axis, 'storage_format': self.storage_format,
+                               'is_stream': self.is_stream, 'rows_per_sec': rows / result['seconds']})
+                self.logger.logger.info('{} rows, {}: {:.2f} sec, {:.0f} rows/sec, peak rss {:.1f} MB, {}'.format(
+                    rows, time_axis, result['seconds'], result['rows_per_sec'], result['peak_rss_mb'],
+                    ', '.join('{} {:.2f}'.format(k, v) for k, v in result['stages'].items())))
+                results.append(result)
+        return results
+
+    @staticmethod
+    def get_commit():
+        # type: () -> str
+        """
+        実行しているコミット
+        :return: コミットのハッシュ. gitが使えなければNone
+        """
+        try:
+            commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                             cwd=os.path.dirname(os.path.abspath(__file__)),
+                                             stderr=subprocess.DEVNULL)
+            return commit.decode('utf-8').strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--rows', help='comma separated numbers of executions (ex. 1000000,10000000,100000000)',
+                        action='store', default='1000000')
+    parser.add_argument('-d', '--dir', help='directory to generate btc files', action='store', default='./bench')
+    parser.add_argument('-f', '--format', help='storage format. csv or parquet', action='store',
+                        choices=['csv', 'parquet'], default='csv')
+    parser.add_argument('-s', '--stream', help='benchmark the stream mode', action='store_true')
+    parser.add_argument('-o', '--output', help='json lines file to append the results', action='store',
+                        default='./bench/results_hloc.jsonl')
+
+    args = parser.parse_args()
+    assert os.path.exists('./log'), 'Please make directry: log dirctory'
+    logger = logger.Logger()
+    logger.logger.info('START benchmark generatehloc')
+
+    # 子プロセスからsrcのモジュールを読み込めるようにする
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    if not os.path.exists(args.dir):
+        os.makedirs(args.dir)
+
+    benchmark = HlocBenchmark(logger, args.dir, args.format, args.stream)
+    results = benchmark.run([int(x) for x in args.rows.split(',')])
+
+    with open(args.output, 'a') as f:
+        for result in results:
+            f.write(json.dumps(result, sort_keys=True) + '\n')
+    logger.logger.info(' save on {}'.format(args.output))
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This module provides a durable checkpoint of getbtc.
+Fetched pages are appended to a spool file and the next before id is recorded in a small cursor file after every page,
+so that a restarted run resumes where it stopped.
+The checkpoint with the saved files is rewritten only when a file is saved, so the work per page stays constant.
+"""
+
+import os
+import json
+import pandas as pd
+
+
+class FetchCheckpoint(object):
+    """
+    This class records the progress of fetching and the pages not yet saved.
+    """
+
+    def __init__(self, data_dir, product_code):
+        # type: (str, str) -> None
+        """
+        Class initialization.
+        :param data_dir: データの保存先のディレクトリ
+        :param product_code: プロダクトコード. プロダクトごとにファイルを分ける
+        """
+        self.checkpoint_file = os.path.join(data_dir, '.checkpoint_{}.json'.format(product_code))
+        # 保存前のページを追記するファイル
+        self.spool_file = os.path.join(data_dir, '.checkpoint_{}.spool.csv'.format(product_code))
+        # ページごとに次のbefore_idだけを記録するファイル
+        self.cursor_file = os.path.join(data_dir, '.checkpoint_{}.cursor.json'.format(product_code))
+        # key: 実行の引数, target_start_id, finish_id, before: 次に取得するbefore_id,
+        # flushed_id: 保存済みのデータで最も古いid, files: 保存したファイルのリスト
+        self.state = None
+
+    def load(self, key):
+        # type: (dict) -> dict
+        """
+        同じ引数で中断した実行のチェックポイントを読み込む
+        :param key: 実行の引数
+        :return: チェックポイント. 無ければNone
+        """
+        if not os.path.exists(self.checkpoint_file):
+            return None
+
+        with open(self.checkpoint_file) as f:
+            state = json.load(f)
+        if state['key'] != key:
+            return None
+
+        # 最後に保存してから取得したページがあれば、そのbefore_idから続ける
+        if os.path.exists(self.cursor_file):
+            with open(self.cursor_file) as f:
+                state['before'] = json.load(f)['before']
+
+        self.state = state
+        return self.state
+
+    def start(self, key, target_start_id, finish_id):
+        # type: (dict, int, int) -> dict
+        """
+        新しいチェックポイントを作る. 前回のページは破棄する
+        :param key: 実行の引数
+        :param target_start_id: 取得する最初のid
+        :param finish_id: 最初に指定するbefore_id. 0の場合は最新のデータから
+        :return: チェックポイント
+        """
+        for file_name in [self.spool_file, self.cursor_file]:
+            if os.path.exists(file_name):
+                os.remove(file_name)
+        self.state = {'key': key, 'target_start_id': target_start_id, 'finish_id': finish_id,
+                      'before': finish_id, 'flushed_id': None, 'files': []}
+        self.save()
+        return self.state
+
+    def save(self):
+        # type: () -> None
+        """
+        チェックポイントを保存する
+        :return:
+        """
+        self.write_json(self.checkpoint_file, self.state)
+
+    @staticmethod
+    def write_json(file_name, data):
+        # type: (str, dict) -> None
+        """
+        JSONを保存する. 途中で止まっても壊れないように一時ファイルから置き換える
+        :param file_name: 保存するファイル
+        :param data: データ
+        :return:
+        """
+        writing_file = file_name + '.writing'
+        with open(writing_file, 'w') as f:
+            json.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(writing_file, file_name)
+
+    def append_page(self, page_df, next_before_id):
+        # type: (df, int) -> None
+        """
+        取得したページを追記し、次のbefore_idを記録する. 保存したファイルのリストは書き直さない
+        :param page_df: 取得したページ. idの降順
+        :param next_before_id: 次に取得するbefore_id
+        :return:
+        """
+        is_new = not os.path.exists(self.spool_file)
+        with open(self.spool_file, 'a') as f:
+            page_df.to_csv(f, header=is_new, index=False)
+            f.flush()
+            os.fsync(f.fileno())
+
+        self.state['before'] = int(next_before_id)
+        self.write_json(self.cursor_file, {'before': self.state['before']})
+
+    def load_spool(self):
+        # type: () -> df
+        """
+        保存前のページを読み込む. 記録より後に追記されたページと保存済みのデータは除く
+        :return: 保存前のデータ. idの降順. 無ければNone
+        """
+        if not os.path.exists(self.spool_file):
+            return None
+
+        spool_df = pd.read_csv(self.spool_file)
+        is_pending = spool_df['id'] >= self.state['before']
+        if self.state['flushed_id'] is not None:
+            is_pending &= spool_df['id'] < self.state['flushed_id']
+        return spool_df[is_pending]
+
+    def flush(self, file_list, flushed_id):
+        # type: (list, int) -> None
+        """
+        保存したファイルとその時点のbefore_idを記録し、追記したページを破棄する
+        :param file_list: 保存したファイルのリスト
+        :param flushed_id: 保存したデータで最も古いid
+        :return:
+        """
+        self.state['files'] += file_list
+        self.state['flushed_id'] = int(flushed_id)
+        self.save()
+        for file_name in [self.spool_file, self.cursor_file]:
+            if os.path.exists(file_name):
+                os.remove(file_name)
+
+    def clear(self):
+        # type: () -> None
+        """
+        取得が終わったらチェックポイントを削除する
+        :return:
+        """
+        for file_name in [self.spool_file, self.cursor_file, self.checkpoint_file]:
+            if os.path.exists(file_name):
+                os.remove(file_name)
+        self.state = None
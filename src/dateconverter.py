@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This module provides vectorized conversion of exec_date.
+bitflyer returns exec_date as ISO format in UTC (ex. 2018-04-07T13:06:00.123).
+"""
+
+import numpy as np
+import pandas as pd
+
+
+class DateConverter(object):
+    """
+    This class converts ISO exec_date to int64 epoch nanoseconds or Japan time datetime64 at once.
+    """
+
+    # 日本時間とUTCの差
+    jst_offset_ns = 9 * 60 * 60 * 10 ** 9
+    # 切り捨てる単位
+    unit_ns = {'s': 10 ** 9, 'm': 60 * 10 ** 9, 'h': 60 * 60 * 10 ** 9, 'd': 24 * 60 * 60 * 10 ** 9}
+    # YYYY-MM-DDTHH:MM:SS.fffffffff の長さ
+    iso_length = 29
+    # 末尾のZと、それより後に文字が続いていないかを見るために余分に読む長さ
+    read_length = iso_length + 2
+
+    @classmethod
+    def to_epoch_ns(cls, exec_date):
+        # type: (Series) -> ndarray
+        """
+        ISO形式の日付をUTCのエポックナノ秒へ変換する. int64の場合はそのまま返す
+        :param exec_date: ISO形式の日付のシリーズ, 配列またはリスト
+        :return: int64の配列
+        """
+        values = np.asarray(exec_date.values if isinstance(exec_date, pd.Series) else exec_date)
+        if values.dtype == np.int64:
+            return values
+        if len(values) == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        # 固定長のバイト列にして文字の位置で年月日時分秒を取り出す. 足りない部分は0で埋まる
+        chars = values.astype('S{}'.format(cls.read_length)).view(np.uint8).reshape(len(values), cls.read_length)
+
+        # 小数点以下は数字が続く間だけ読み、足りない桁を0として9桁のナノ秒にする
+        nanosecond = np.zeros(len(values), dtype=np.int64)
+        is_fraction = chars[:, 19] == ord('.')
+        # 秒または小数点以下の次の文字の位置
+        suffix_index = np.where(is_fraction, 20, 19)
+        for i in range(20, cls.iso_length):
+            digit = chars[:, i].astype(np.int64) - ord('0')
+            is_fraction &= (digit >= 0) & (digit <= 9)
+            nanosecond = nanosecond * 10 + np.where(is_fraction, digit, 0)
+            suffix_index += is_fraction
+
+        # 想定した形式(末尾は何も無いかZのみ)でなければpandasで変換する. +09:00等のオフセットや10桁以上の小数も含む
+        rows = np.arange(len(values))
+        suffix = chars[rows, suffix_index]
+        is_end = (suffix == 0) | ((suffix == ord('Z')) & (chars[rows, suffix_index + 1] == 0))
+        if not ((chars[:, 4] == ord('-')) & (chars[:, 7] == ord('-')) & (chars[:, 13] == ord(':'))
+                & (chars[:, 16] == ord(':')) & is_end).all():
+            date = pd.to_datetime(pd.Series(values), format='ISO8601', utc=True).dt.tz_localize(None)
+            return date.values.astype('datetime64[ns]').astype(np.int64)
+
+        year = cls.to_number(chars, 0, 4)
+        month = cls.to_number(chars, 5, 7)
+        day = cls.to_number(chars, 8, 10)
+        hour = cls.to_number(chars, 11, 13)
+        minute = cls.to_number(chars, 14, 16)
+        second = cls.to_number(chars, 17, 19)
+
+        # 1970-01-01からの日数. http://howardhinnant.github.io/date_algorithms.html#days_from_civil
+        year = year - (month <= 2)
+        era = year // 400
+        year_of_era = year - era * 400
+        day_of_year = (153 * ((month + 9) % 12) + 2) // 5 + day - 1
+        day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+        days = era * 146097 + day_of_era - 719468
+
+        return ((days * 24 + hour) * 60 + minute) * 60 * 10 ** 9 + second * 10 ** 9 + nanosecond
+
+    @classmethod
+    def to_jst(cls, exec_date, unit=None):
+        # type: (Series, str) -> ndarray
+        """
+        ISO形式またはエポックナノ秒の日付を日本時間のdatetime64へ変換する
+        :param exec_date: 日付のシリーズ, 配列またはリスト
+        :param unit: 切り捨てる単位. s, m, h, d. 指定がなければ切り捨てない
+        :return: datetime64[ns]の配列
+        """
+        jst_ns = cls.to_epoch_ns(exec_date) + cls.jst_offset_ns
+        if unit is not None:
+            jst_ns = jst_ns - jst_ns % cls.unit_ns[unit]
+        return jst_ns.view('datetime64[ns]')
+
+    @staticmethod
+    def to_iso(epoch_ns):
+        # type: (ndarray) -> ndarray
+        """
+        UTCのエポックナノ秒をISO形式の日付へ戻す. bitflyerと同じく行ごとに小数点以下の末尾の0を省き、
+        小数点以下が無ければ秒までにする. APIの日付はそのまま戻るが、Zやオフセット付き、末尾に0がある日付は
+        この形式に揃う
+        :param epoch_ns: int64の配列
+        :return: 文字列の配列(ex. 2018-04-07T13:06:00.12, 2018-04-07T13:06:01)
+        """
+        epoch_ns = np.asarray(epoch_ns, dtype=np.int64)
+        text = np.datetime_as_string(epoch_ns.view('datetime64[ns]'), unit='ns')
+        return np.char.rstrip(np.char.rstrip(text, '0'), '.').astype(object)
+
+    @classmethod
+    def to_jst_datetime(cls, date_line, unit=None):
+        # type: (str, str) -> dt
+        """
+        ISO形式の日付一つを日本時間のdatetimeへ変換する
+        :param date_line: ISO形式の日付
+        :param unit: 切り捨てる単位. s, m, h, d. 指定がなければ切り捨てない
+        :return: 日本時間のdatetime
+        """
+        return cls.to_jst([date_line], unit).astype('datetime64[us]').tolist()[0]
+
+    @staticmethod
+    def to_number(chars, start, end):
+        # type: (ndarray, int, int) -> ndarray
+        """
+        文字の位置から数字を取り出す
+        :param chars: 日付のバイト列
+        :param start: 開始位置
+        :param end: 終了位置
+        :return: int64の配列
+        """
+        number = np.zeros(len(chars), dtype=np.int64)
+        for i in range(start, end):
+            number = number * 10 + (chars[:, i].astype(np.int64) - ord('0'))
+        return number
@@ -6,11 +6,19 @@ This module provides processing to generate HLOC(High, Low, Open, Close).
 """
 
 import os
+import math
+import itertools
 import argparse
-import pandas as pd
-from datetime import datetime as dt
-import datetime
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import logger
+import storage
+import manifest
+import metrics
+import query
+from dateconverter import DateConverter
+from ohlcv import OhlcvAggregator, ActivityAggregator
+from ticks import TickArray
 
 
 class GenerateHLOC(object):
@@ -18,21 +26,37 @@ class GenerateHLOC(object):
     This class generate HLOC.
     """
 
-    def __init__(self, root_logger, input_dir, time_axis):
-        # type: (logger, str, str) -> None
+    def __init__(self, root_logger, input_dir, time_axis, storage_format='csv', is_stream=False, processes=1,
+                 is_incremental=False):
+        # type: (logger, str, str, str, bool, int, bool) -> None
         """
         Class initialization.
         """
 
         self.logger = root_logger
         self.input_dir = input_dir
-        # 作りたい足を指定
+        # 作りたい足を指定. カンマ区切りで複数指定できる
         self.time_axis = time_axis
-        # 時間軸, 1分足, 5分足, 1時間足, 日足
+        self.time_axis_list = time_axis.split(',')
+        # 時間軸, 1分足, 5分足, 1時間足, 日足. この他に15m, 4h, 1wのように数字と単位(s, m, h, d, w)で指定できる
+        # 1000_tick, 50_volume, 100000000_dollarのように約定数, 出来高(BTC), 売買代金(円)ごとの足も作れる
         self.time_list = ['one_minute', '5_minute', 'one_hour', 'one_day']
+        # 時間軸ごとの足の指定
+        self.time_axis_spec = {'one_minute': '1m', '5_minute': '5m', 'one_hour': '1h', 'one_day': '1d'}
+        self.aggregator = None
 
-        self.columns =['datetime','min', 'max', 'first', 'last', 'size']
+        self.columns = ['datetime'] + OhlcvAggregator.columns
         self.file_lines = 500000
+        # 入力データの保存形式. csv or parquet
+        self.storage = storage.BtcStorage(input_dir, storage_format)
+        # ファイルを古い順に一つずつ処理し、確定した足から出力する
+        self.is_stream = is_stream
+        # ファイルごとの読み込みと集計を並列に行うプロセス数
+        self.processes = processes
+        # 追加, 変更されたファイルだけを集計し、影響する足から出力し直す
+        self.is_incremental = is_incremental
+        self.output_dir = './hloc'
+        self.manifest_dir = os.path.join(self.output_dir, '.manifest')
 
     def run(self):
         # type: (None) -> None
@@ -41,10 +65,15 @@ class GenerateHLOC(object):
         :return:
         """
 
-        # 引数の時間軸チェック
-        if not self.time_axis in self.time_list:
-            self.logger.logger.error('Please specify time axis as one_minute, one_hour or one_day.')
+        # 引数の時間軸チェック. 全ての時間軸を同じ集計処理で作る
+        try:
+            aggregators = [self.get_aggregator(x) for x in self.time_axis_list]
+        except ValueError:
+            self.logger.logger.error('Please specify time axis as one_minute, 5_minute, one_hour, one_day, '
+                                     'a number with a unit such as 15m, 4h, 1w '
+                                     'or a threshold with a bar type such as 1000_tick, 50_volume, 100000000_dollar.')
             exit(1)
+        self.aggregator = aggregators[0]
 
         # 入力データのディレクトリチェック
         if not os.path.exists(self.input_dir):
@@ -55,80 +84,24 @@ class GenerateHLOC(object):
         self.logger.logger.info('time axis: {}'.format(self.time_axis))
         self.logger.logger.info('input directory: {}'.format(self.input_dir))
 
-        summary_hloc = pd.DataFrame(columns=self.columns)
-        summary_hloc = summary_hloc.set_index('datetime')
-
-        # 指定されたディレクトリからファイルを取得
-        file_list = os.listdir(self.input_dir)
-
-        for file_name in file_list:
-            # ディレクトリに存在するファイルを一つずつ読み込む
-            df_btc = self.load_btc_data(file_name)
-            
-            # 5分足, TODO ちゃんと書く
-            if self.time_axis in '5_minute':
-                df_btc['exec_date'] = df_btc['exec_date'].map(self.format_date2)
-                tmp_df = df_btc[['exec_date', 'price']]
-                datetime_index = pd.DatetimeIndex(tmp_df['exec_date'])                                                                                                                                                                        
-                tmp_df.index = datetime_index
-                tmp_df = tmp_df.drop('exec_date', axis=1)
-                
-                # mean は特に意味はない(直でindexwp取得するとFutureWarningが出るため)
-                hloc_index = tmp_df.resample('5T').mean().index
-                max = tmp_df.resample('5T').max()
-                min = tmp_df.resample('5T').min()
-                first = tmp_df.resample('5T').first()
-                last =  tmp_df.resample('5T').last()
-                
-                df_size = df_btc[['exec_date', 'size']]
-                df_size.index = datetime_index
-                df_size = df_size.drop('exec_date', axis=1)
-                size = df_size.resample('5T').sum()
-                
-                df_hloc = pd.DataFrame(index=hloc_index)
-                df_hloc = df_hloc.join(max)
-                df_hloc = df_hloc.rename(columns={'price': 'max'})
-                df_hloc = df_hloc.join(min)
-                df_hloc = df_hloc.rename(columns={'price': 'min'})
-                df_hloc = df_hloc.join(first)
-                df_hloc = df_hloc.rename(columns={'price': 'first'})
-                df_hloc = df_hloc.join(last)
-                df_hloc = df_hloc.rename(columns={'price': 'last'})
-                df_hloc = df_hloc.join(size)
-                df_hloc['datetime'] = df_hloc.index
-              
-                summary_hloc = self.summarize_hloc(summary_hloc, df_hloc)
-
-                continue
-
-            # 時間を取り出しISOから日本時間に直しリストへ格納
-            date_list = []
-            exec_date = df_btc['exec_date']
-            date_list = self.format_date(exec_date, date_list)
-
-            # 引数で指定された時間軸でデータを揃える
-            if self.time_axis in 'one_minute':
-                # 1分足
-                time_axis_date_list = self.get_one_minute_datetime(date_list)
-            elif self.time_axis in 'one_hour':
-                # 1時間足
-                time_axis_date_list = self.get_one_hour_datetime(date_list)
-            elif self.time_axis in 'one_day':
-                # 日足
-                time_axis_date_list = self.get_one_day_datetime(date_list)
-            else:
-                self.logger.logger.error('Unexpected time axis is specified : {}'.format(self.time_axis))
-                exit(1)
-
-            # 元のdatetimeを削除し時間軸を変換したデータを格納
-            adjust_df_btc = df_btc.drop('exec_date', axis=1)
-            adjust_df_btc['datetime'] = time_axis_date_list
-
-            # hlocと出来高をを取得
-            df_hloc = self.generate_hloc(adjust_df_btc)
-
-            # hlocデータをまとめる
-            summary_hloc = self.summarize_hloc(summary_hloc, df_hloc)
+        # 指定されたディレクトリからファイルを古い順に取得
+        file_list = self.storage.list_files()
+
+        if self.is_incremental:
+            for time_axis in self.time_axis_list:
+                self.run_incremental(file_list, time_axis)
+            return
+
+        # 複数の時間軸は一度の読み込みでまとめて作る
+        if self.is_stream or len(self.time_axis_list) > 1:
+            self.run_stream(file_list)
+            return
+
+        # ファイルごとにhlocと出来高を取得し、ファイルをまたぐ足を一つにまとめる
+        df_hloc_list = list(self.iter_file_hloc(file_list, self.aggregator))
+        with metrics.REGISTRY.timer('hloc_stage_seconds', stage='summarize'):
+            summary_hloc = self.aggregator.merge(df_hloc_list)
+        self.logger.logger.info('summary lines: {}'.format(len(summary_hloc)))
 
         # まとめたデータをfile_lines(デフォルトは500,000)で分ける
         summary_hloc_list = self.separate_summary(summary_hloc)
@@ -138,87 +111,246 @@ class GenerateHLOC(object):
             separate_summary = separate_summary.sort_index()
             self.save_hloc_data(separate_summary)
 
-
-    def get_one_minute_datetime(self, date_list):
-        # type: (list) -> list
+    def run_stream(self, file_list, time_axis_list=None):
+        # type: (list, list) -> list
         """
-        Convert seconds to 0
-        :param date_list: date time list
-        :return: list after conversion
+        Generate hloc of all time axes file by file with bounded memory.
+        Ticks are read once and aggregated into base bars (the greatest common width of the time axes),
+        then the base bars are rolled up to each time axis.
+        Only the last bar of each time axis is carried to the next file because it may continue in the next file.
+        The other bars are finished and written to the output at once.
+        Tick, volume and dollar bars are aggregated from the ticks of each file in the same way.
+        :param file_list: file list in chronological order
+        :param time_axis_list: time axes to generate. all time axes if not specified
+        :return: list of output files
         """
-        self.logger.logger.info('Convert to 1 minute data')
-        return [x.replace(second=0) for x in date_list]
-
-    def get_one_hour_datetime(self, date_list):
-        # type: (list) -> list
+        time_axis_list = time_axis_list or self.time_axis_list
+        aggregators = [self.get_aggregator(x) for x in time_axis_list]
+        writers = [HlocWriter(self.logger, x, self.file_lines, self.output_dir, y.date_format)
+                   for x, y in zip(time_axis_list, aggregators)]
+        open_bars = [x.empty() for x in aggregators]
+
+        # 全ての時間軸の幅と区切りを割り切れる幅の足を元にする
+        base_ns = 0
+        for aggregator in aggregators:
+            if not aggregator.is_sequential:
+                base_ns = math.gcd(math.gcd(base_ns, aggregator.width_ns), aggregator.offset_ns)
+        base_aggregator = OhlcvAggregator(base_ns) if base_ns > 0 else None
+        if base_aggregator is not None:
+            self.logger.logger.info('base bar: {} seconds'.format(base_ns / 10 ** 9))
+            base_open_bar = base_aggregator.empty()
+
+        # 約定数, 出来高, 売買代金の足はファイルをまたいで累積するので約定を順に集計する
+        activity_list = [x for x in aggregators if x.is_sequential]
+        if activity_list:
+            file_hloc_iter = ([aggregate_executions(tick_array, x) for x in [base_aggregator] + activity_list
+                               if x is not None] for tick_array in self.iter_file_ticks(file_list))
+        else:
+            file_hloc_iter = ([x] for x in self.iter_file_hloc(file_list, base_aggregator))
+
+        for df_file_list in file_hloc_iter:
+            df_file_iter = iter(df_file_list)
+            if base_aggregator is not None:
+                # 前のファイルから持ち越した足と同じ足であればまとめる
+                with metrics.REGISTRY.timer('hloc_stage_seconds', stage='summarize'):
+                    df_base = base_aggregator.merge([base_open_bar, next(df_file_iter)])
+                if len(df_base) > 0:
+                    base_open_bar = df_base.iloc[-1:]
+
+            # 確定した足を各時間軸にまとめ、各時間軸の最後の足は持ち越す
+            for i, aggregator in enumerate(aggregators):
+                with metrics.REGISTRY.timer('hloc_stage_seconds', stage='summarize'):
+                    if aggregator.is_sequential:
+                        df_hloc = aggregator.merge([open_bars[i], next(df_file_iter)])
+                    else:
+                        df_hloc = aggregator.merge([open_bars[i], aggregator.rollup(df_base.iloc[:-1])])
+                if len(df_hloc) == 0:
+                    continue
+                writers[i].write(df_hloc.iloc[:-1])
+                open_bars[i] = df_hloc.iloc[-1:]
+
+        for i, aggregator in enumerate(aggregators):
+            with metrics.REGISTRY.timer('hloc_stage_seconds', stage='summarize'):
+                if aggregator.is_sequential:
+                    df_hloc = open_bars[i]
+                else:
+                    df_hloc = aggregator.merge([open_bars[i], aggregator.rollup(base_open_bar)])
+            writers[i].write(df_hloc)
+            writers[i].close()
+        return [x for writer in writers for x in writer.file_list]
+
+    def run_incremental(self, file_list, time_axis):
+        # type: (list, str) -> None
+        """
+        Update hloc of the time axis incrementally.
+        Only new or changed files are aggregated, and the others are read from the partitions in the manifest.
+        Output files before the oldest affected bar are kept as they are and the rest are rewritten,
+        so the result is the same as the full rebuild.
+        :param file_list: file list in chronological order
+        :param time_axis: time axis
+        :return:
+        """
+        aggregator = self.get_aggregator(time_axis)
+        if aggregator.is_sequential:
+            # 約定数, 出来高, 売買代金の足の境界は最初の約定からの累積で決まるので、全てのファイルから作り直す
+            self.logger.logger.info('{}: rebuild all bars'.format(time_axis))
+            output_list = self.list_hloc_files(time_axis)
+            file_name_list = self.run_stream(file_list, [time_axis])
+            for output_file in [x[2] for x in output_list if x[2] not in file_name_list]:
+                os.remove(output_file)
+            return
+
+        hloc_manifest = manifest.HlocManifest(self.manifest_dir, time_axis)
+
+        # 削除, 追加, 変更されたファイル
+        removed_list = [x for x in hloc_manifest.entries if x not in file_list]
+        changed_list = [x for x in file_list if hloc_manifest.is_changed(x, os.path.join(self.input_dir, x))]
+        self.logger.logger.info('{}: {} changed files, {} removed files'.format(
+            time_axis, len(changed_list), len(removed_list)))
+        if not removed_list and not changed_list:
+            return
+
+        # 影響する足. 変更前と変更後の両方を含める
+        affected_list = [hloc_manifest.get_bar_span(x)[0] for x in removed_list + changed_list]
+        for file_name in removed_list:
+            hloc_manifest.remove(file_name)
+        for file_name, (df_hloc, first_id, last_id) in zip(
+                changed_list, self.iter_file_hloc(changed_list, aggregator, with_ids=True)):
+            hloc_manifest.put(file_name, os.path.join(self.input_dir, file_name), df_hloc, first_id, last_id)
+            affected_list.append(hloc_manifest.get_bar_span(file_name)[0])
+        affected_list = [x for x in affected_list if x is not None]
+
+        if affected_list:
+            # 影響する足を含む出力ファイル以降を書き直す. 最後のファイルは行数が足りない場合があるので必ず書き直す
+            output_list = self.list_hloc_files(time_axis)
+            first_bar = min(affected_list)
+            rewrite_list = [x for x in output_list if x[1] >= first_bar] or output_list[-1:]
+            if rewrite_list:
+                first_bar = min(first_bar, rewrite_list[0][0])
+
+            partition_list = [x for x in file_list if hloc_manifest.get_bar_span(x)[1] is not None
+                              and hloc_manifest.get_bar_span(x)[1] >= first_bar]
+            with metrics.REGISTRY.timer('hloc_stage_seconds', stage='summarize'):
+                df_hloc = aggregator.merge([hloc_manifest.load_partition(x) for x in partition_list])
+            df_hloc = df_hloc[df_hloc.index >= first_bar]
+            self.logger.logger.info('{}: rewrite {} bars from {}'.format(time_axis, len(df_hloc), first_bar))
+
+            writer = HlocWriter(self.logger, time_axis, self.file_lines, self.output_dir)
+            writer.write(df_hloc)
+            writer.close()
+
+            # 書き直した後に古い出力ファイルを消す
+            for output_file in [x[2] for x in rewrite_list if x[2] not in writer.file_list]:
+                os.remove(output_file)
+
+        hloc_manifest.save()
+
+    def list_hloc_files(self, time_axis):
+        # type: (str) -> list
         """
-        Convert seconds and minute to 0
-        :param date_list: date time list
-        :return: list after conversion
+        List output files of the time axis.
+        :param time_axis: time axis
+        :return: list of (first bar, last bar, path) in chronological order
         """
-        self.logger.logger.info('Convert to 1 hour data')
-        temp_list = [x.replace(second=0) for x in date_list]
-        return [x.replace(minute=0) for x in temp_list]
+        return query.list_hloc_files(self.output_dir, time_axis)
 
-    def get_one_day_datetime(self, date_list):
-        # type: (list) -> list
+    def iter_file_hloc(self, file_list, aggregator, with_ids=False):
+        # type: (list, OhlcvAggregator, bool) -> iterator
         """
-        Convert seconds, minute and houe to 0
-        :param date_list: date time list
-        :return: list after conversion
+        Generate hloc of each file in the order of file_list.
+        If processes is more than 1, files are loaded and aggregated in a process pool.
+        Each file is aggregated independently, so the result is the same as the serial one.
+        :param file_list: file list in chronological order
+        :param aggregator: aggregator of bars
+        :param with_ids: yield (hloc, oldest id, newest id) instead of hloc
+        :return: iterator of hloc data frame of each file
         """
-        self.logger.logger.info('Convert to 1 day data')
-        temp_list = [x.replace(second=0) for x in date_list]
-        temp_list = [x.replace(minute=0) for x in temp_list]
-        return [x.replace(hour=0) for x in temp_list]
+        # 前のファイルの続きとして集計する足は読み込みだけを並列に行う
+        if self.processes <= 1 or aggregator.is_sequential:
+            for tick_array in self.iter_file_ticks(file_list):
+                df_hloc = self.generate_hloc(tick_array, aggregator)
+                yield (df_hloc, ) + get_id_range(tick_array) if with_ids else df_hloc
+            return
+
+        self.logger.logger.info('processes: {}'.format(self.processes))
+        with ProcessPoolExecutor(max_workers=self.processes) as executor:
+            # 結果はfile_listの順に返る
+            df_hloc_list = executor.map(aggregate_file_with_ids if with_ids else aggregate_file,
+                                        [self.storage] * len(file_list), file_list, [aggregator] * len(file_list))
+            # ワーカのプロセスのステージの時間は集めず、ファイル数だけ数える
+            for file_name, df_hloc in zip(file_list, df_hloc_list):
+                self.logger.info_every('generate hloc', 1.0, 'generate hloc: {}',
+                                       os.path.join(self.input_dir, file_name))
+                metrics.REGISTRY.counter('hloc_files_total', 'btc files aggregated').inc()
+                yield df_hloc
+
+    def iter_file_ticks(self, file_list):
+        # type: (list) -> iterator
+        """
+        Load executions of each file in the order of file_list.
+        If processes is more than 1, files are loaded in a process pool and at most 2 files per process are held.
+        :param file_list: file list in chronological order
+        :return: iterator of TickArray of each file
+        """
+        if self.processes <= 1:
+            for file_name in file_list:
+                tick_array = self.load_btc_data(file_name)
+                metrics.REGISTRY.counter('hloc_files_total', 'btc files aggregated').inc()
+                yield tick_array
+            return
+
+        self.logger.logger.info('processes: {}'.format(self.processes))
+        with ProcessPoolExecutor(max_workers=self.processes) as executor:
+            # 先に読み込むファイルはプロセスごとに2つまで
+            file_iter = iter(file_list)
+            future_list = deque((x, executor.submit(load_ticks, self.storage, x))
+                                for x in itertools.islice(file_iter, self.processes * 2))
+            while future_list:
+                file_name, future = future_list.popleft()
+                next_file_name = next(file_iter, None)
+                if next_file_name is not None:
+                    future_list.append((next_file_name, executor.submit(load_ticks, self.storage, next_file_name)))
+
+                tick_array = future.result()
+                self.logger.info_every('load btc file', 1.0, 'Load btc file: {}',
+                                       os.path.join(self.input_dir, file_name))
+                metrics.REGISTRY.counter('hloc_rows_total', 'executions loaded').inc(len(tick_array))
+                metrics.REGISTRY.counter('hloc_files_total', 'btc files aggregated').inc()
+                yield tick_array
+
+    def get_aggregator(self, time_axis):
+        # type: (str) -> object
+        """
+        Create the aggregator of the time axis.
+        :param time_axis: one_minute, 5_minute, one_hour, one_day, a spec such as 15m, 4h, 1w
+                          or a bar type such as 1000_tick, 50_volume, 100000000_dollar
+        :return: OhlcvAggregator or ActivityAggregator
+        """
+        spec = self.time_axis_spec.get(time_axis, time_axis)
+        if ActivityAggregator.spec_pattern.match(spec):
+            return ActivityAggregator.from_spec(spec)
+        return OhlcvAggregator.from_spec(spec)
 
-    def generate_hloc(self, adjust_df_btc):
+    def generate_hloc(self, tick_array, aggregator=None):
+        # type: (TickArray, OhlcvAggregator) -> df
         """
-        Group data frames with datetime.
-        Then, high, low, open, close, volume are acquired and stored.
-        reference
-        http://www.madopro.net/entry/bitcoin_chart
-        :param adjust_df_btc: Data frame after time axis adjustment
+        Aggregate executions into bars of the time axis in a single pass.
+        High, low, open, close, volume and the number of trades are acquired at once.
+        :param tick_array: btc executions
+        :param aggregator: aggregator of bars. the time axis aggregator is used if not specified
         :return: Data frame storing hloc and volume every time
         """
         self.logger.logger.info('generate hloc')
-
-        # ベースとなるデータフレーム作成と安値取得
-        df_hloc = adjust_df_btc[['datetime', 'price']].groupby(['datetime']).min().rename(columns={'price': 'min'})
-
-        # 高値を取得しマージ
-        df_hloc = df_hloc.merge(
-            adjust_df_btc[['datetime', 'price']].groupby(['datetime']).max().rename(columns={'price': 'max'}),
-            left_index=True, right_index=True)
-
-        # 始値を取得しマージ
-        df_hloc = df_hloc.merge(
-            adjust_df_btc[['datetime', 'price']].groupby(['datetime']).last().rename(columns={'price': 'first'}),
-            left_index=True, right_index=True)
-
-        # 終値を取得しマージ
-        df_hloc = df_hloc.merge(
-            adjust_df_btc[['datetime', 'price']].groupby(['datetime']).first().rename(columns={'price': 'last'}),
-            left_index=True, right_index=True)
-
-        # 出来高を取得しマージ
-        df_hloc = df_hloc.merge(
-            adjust_df_btc[['datetime', 'size']].groupby(['datetime']).sum(),
-            left_index=True, right_index=True)
-
-        return df_hloc
-
-    def summarize_hloc(self, summary_hloc, df_hloc):
-        self.logger.logger.info('summarize_hloc')
-        summary_hloc = pd.concat([summary_hloc, df_hloc])
-        self.logger.logger.info('summary lines: {}'.format(len(summary_hloc)))
-        return summary_hloc
+        if aggregator is None:
+            aggregator = self.aggregator
+        return aggregate_executions(tick_array, aggregator)
 
     def separate_summary(self, summary_hloc):
         self.logger.logger.info('separate_summary')
         summary_hloc_list = []
 
-        for file_num in range(int(len(summary_hloc)/self.file_lines)+1):
+        # 行数がfile_linesで割り切れる場合に空のファイルを作らない
+        for file_num in range(int((len(summary_hloc) + self.file_lines - 1) / self.file_lines)):
             # スライスでfile_linesごとに分ける
             tmp_summary = summary_hloc[self.file_lines*file_num:self.file_lines*(file_num+1)]
             summary_hloc_list.append(tmp_summary)
@@ -235,52 +367,162 @@ class GenerateHLOC(object):
         """
         # TODO move util
         # ファイル名作成
-        str_first_date = str(df_hloc.index[0]).replace(' ', '-')
-        str_last_date = str(df_hloc.index[-1]).replace(' ', '-')
+        str_first_date = df_hloc.index[0].strftime('%Y-%m-%d-%H:%M:%S')
+        str_last_date = df_hloc.index[-1].strftime('%Y-%m-%d-%H:%M:%S')
         file_name = './hloc/hloc_{}_{}_{}.csv'.format(self.time_axis, str_first_date, str_last_date)
 
         # 保存
-        df_hloc.to_csv(file_name)
+        with metrics.REGISTRY.timer('hloc_stage_seconds', stage='save'):
+            df_hloc.to_csv(file_name, date_format=self.aggregator.date_format)
+        metrics.REGISTRY.counter('hloc_bars_total', 'bars written').inc(len(df_hloc), time_axis=self.time_axis)
         self.logger.logger.info(' save on {}'.format(file_name))
 
     def load_btc_data(self, file_name):
         """
         Load btc data.
-        :return: btc data frame
+        :return: btc executions of the columns used for hloc
         """
-        # TODO move util
         input_path = os.path.join(self.input_dir, file_name)
-        df_btc = pd.read_csv(input_path)
-        self.logger.logger.info('Load btc file: {}'.format(input_path))
-        return df_btc
+        tick_array = load_ticks(self.storage, file_name)
+        metrics.REGISTRY.counter('hloc_rows_total', 'executions loaded').inc(len(tick_array))
+        self.logger.info_every('load btc file', 1.0, 'Load btc file: {}', input_path)
+        return tick_array
 
-    @staticmethod
-    def format_date(df_date, date_list):
+
+# hlocに使う列. 売買と受付idは読み込まない
+hloc_columns = ['id', 'date_ns', 'price', 'size']
+
+
+def load_ticks(btc_storage, file_name):
+    # type: (storage.BtcStorage, str) -> TickArray
+    """
+    ファイルからhlocに使う列だけを読み込み、型付きの配列にする
+    :param btc_storage: 入力データのストレージ
+    :param file_name: data_dirからの相対パス
+    :return: TickArray
+    """
+    with metrics.REGISTRY.timer('hloc_stage_seconds', stage='load'):
+        df_btc = btc_storage.load(file_name, columns=TickArray.get_source_columns(hloc_columns))
+    # ISOからエポックナノ秒に直す
+    with metrics.REGISTRY.timer('hloc_stage_seconds', stage='parse_date'):
+        return TickArray.from_frame(df_btc, hloc_columns)
+
+
+def aggregate_executions(tick_array, aggregator):
+    # type: (TickArray, OhlcvAggregator) -> df
+    """
+    約定を足ごとにまとめる
+    :param tick_array: 約定
+    :param aggregator: 足の集計処理
+    :return: hlocのデータフレーム
+    """
+    with metrics.REGISTRY.timer('hloc_stage_seconds', stage='aggregate'):
+        # 日本時間のエポックナノ秒で足に分ける
+        return aggregator.aggregate(tick_array['id'], tick_array['date_ns'] + DateConverter.jst_offset_ns,
+                                    tick_array['price'], tick_array['size'])
+
+
+def aggregate_file(btc_storage, file_name, aggregator):
+    # type: (storage.BtcStorage, str, OhlcvAggregator) -> df
+    """
+    ファイルを読み込み足ごとにまとめる. プロセスプールで実行するためモジュールの関数にしている
+    :param btc_storage: 入力データのストレージ
+    :param file_name: data_dirからの相対パス
+    :param aggregator: 足の集計処理
+    :return: hlocのデータフレーム
+    """
+    return aggregate_executions(load_ticks(btc_storage, file_name), aggregator)
+
+
+def aggregate_file_with_ids(btc_storage, file_name, aggregator):
+    # type: (storage.BtcStorage, str, OhlcvAggregator) -> tuple
+    """
+    ファイルを読み込み足ごとにまとめ、ファイルのidの範囲も返す
+    :param btc_storage: 入力データのストレージ
+    :param file_name: data_dirからの相対パス
+    :param aggregator: 足の集計処理
+    :return: (hlocのデータフレーム, 最も古いid, 最も新しいid)
+    """
+    tick_array = load_ticks(btc_storage, file_name)
+    return (aggregate_executions(tick_array, aggregator), ) + get_id_range(tick_array)
+
+
+def get_id_range(tick_array):
+    # type: (TickArray) -> tuple
+    """
+    btcデータのidの範囲
+    :param tick_array: 約定
+    :return: (最も古いid, 最も新しいid). データがなければ(None, None)
+    """
+    if len(tick_array) == 0:
+        return None, None
+    return int(tick_array['id'].min()), int(tick_array['id'].max())
+
+
+class HlocWriter(object):
+    """
+    This class writes finished bars to hloc files incrementally.
+    """
+
+    def __init__(self, root_logger, time_axis, file_lines, output_dir='./hloc', date_format=None):
+        # type: (logger, str, int, str, str) -> None
         """
-        Format string date as datetime.
-        :param df_date: btc execute date data frame
-        :param date_list: empty list
-        :return: datetime formatted string date
+        Class initialization.
+        :param date_format: 日時の形式. 指定がなければpandasの既定
         """
-        # TODO move util
-        for str_date in df_date:
-            tmp_date = str_date.replace('T', ' ')
-            tmp_date = tmp_date.split('.')
-            tmp_date = tmp_date[0]
-            date = dt.strptime(tmp_date, '%Y-%m-%d %H:%M:%S')
-            # Adjust ISO format to Japan time
-            date = date + datetime.timedelta(hours=9)
-            date_list.append(date)
-        return date_list
-        
-    @staticmethod
-    def format_date2(date):
-        date = date.replace('T', ' ')
-        date = date.split('.')
-        date = date[0]
-        date = dt.strptime(date, '%Y-%m-%d %H:%M:%S')
-        date = date + datetime.timedelta(hours=9)
-        return date
+        self.logger = root_logger
+        self.time_axis = time_axis
+        self.file_lines = file_lines
+        self.output_dir = output_dir
+        self.date_format = date_format
+        # 書き込み中のファイル. 閉じる際に先頭と末尾の日時のファイル名へ変更する
+        self.writing_file = os.path.join(self.output_dir, '.hloc_{}_writing.csv'.format(self.time_axis))
+        self.lines = 0
+        self.first_date = None
+        self.last_date = None
+        # 書き終えたファイルのリスト
+        self.file_list = []
+
+    def write(self, df_hloc):
+        # type: (df) -> None
+        """
+        write bars. A new file is started every file_lines.
+        :param df_hloc: finished bars in chronological order
+        :return:
+        """
+        metrics.REGISTRY.counter('hloc_bars_total', 'bars written').inc(len(df_hloc), time_axis=self.time_axis)
+        while len(df_hloc) > 0:
+            tmp_hloc = df_hloc.iloc[:self.file_lines - self.lines]
+            df_hloc = df_hloc.iloc[len(tmp_hloc):]
+
+            with metrics.REGISTRY.timer('hloc_stage_seconds', stage='save'):
+                tmp_hloc.to_csv(self.writing_file, mode='w' if self.lines == 0 else 'a', header=self.lines == 0,
+                                date_format=self.date_format)
+            if self.lines == 0:
+                self.first_date = tmp_hloc.index[0]
+            self.last_date = tmp_hloc.index[-1]
+            self.lines += len(tmp_hloc)
+
+            if self.lines >= self.file_lines:
+                self.close()
+
+    def close(self):
+        # type: () -> None
+        """
+        Rename the writing file to hloc_{time_axis}_{first}_{last}.csv
+        :return:
+        """
+        if self.lines == 0:
+            return
+
+        # 約定数, 出来高, 売買代金の足は秒未満の日時から始まるので秒までにする
+        str_first_date = self.first_date.strftime('%Y-%m-%d-%H:%M:%S')
+        str_last_date = self.last_date.strftime('%Y-%m-%d-%H:%M:%S')
+        file_name = os.path.join(self.output_dir, 'hloc_{}_{}_{}.csv'.format(self.time_axis, str_first_date, str_last_date))
+        os.rename(self.writing_file, file_name)
+        self.file_list.append(file_name)
+        self.logger.logger.info(' save on {}'.format(file_name))
+        self.lines = 0
 
 
 if __name__ == '__main__':
@@ -288,14 +530,55 @@ if __name__ == '__main__':
     parser.add_argument('-d', '--dir', help='directory name',
                         action='store',
                         required=True)
-    parser.add_argument('-t', '--time', help='time axis',
+    parser.add_argument('-t', '--time', help='time axis. comma separated for multiple time axes (ex. one_minute,15m,4h,1w,1000_tick,50_volume)',
                         action='store',
                         required=True)
+    parser.add_argument('-f', '--format', help='storage format of input data. csv or parquet',
+                        action='store',
+                        choices=['csv', 'parquet'],
+                        default='csv',
+                        required=False)
+    parser.add_argument('-s', '--stream', help='process files in chronological order with bounded memory',
+                        action='store_true',
+                        required=False)
+    parser.add_argument('-p', '--processes', help='number of processes to load and aggregate files in parallel',
+                        action='store',
+                        type=int,
+                        default=1,
+                        required=False)
+    parser.add_argument('-i', '--incremental', help='aggregate only new or changed files and rewrite affected bars',
+                        action='store_true',
+                        required=False)
+    parser.add_argument('--metrics-file', help='json file to write metrics snapshots periodically',
+                        action='store',
+                        required=False)
+    parser.add_argument('--metrics-interval', help='interval of metrics snapshots in seconds',
+                        action='store',
+                        type=float,
+                        default=10.0,
+                        required=False)
+    parser.add_argument('--metrics-port', help='port to serve prometheus metrics on /metrics',
+                        action='store',
+                        type=int,
+                        required=False)
+    parser.add_argument('--profile', help='profile the run. cprofile or tracemalloc',
+                        action='store',
+                        choices=['cprofile', 'tracemalloc'],
+                        required=False)
+    parser.add_argument('--profile-output', help='file to save the profile',
+                        action='store',
+                        required=False)
                         
     assert os.path.exists('./hloc'), 'Please make directry: hloc directory'
     
     args = parser.parse_args()
     logger = logger.Logger()
 
-    generate_hloc = GenerateHLOC(logger, args.dir, args.time)
-    generate_hloc.run()
+    generate_hloc = GenerateHLOC(logger, args.dir, args.time, args.format, args.stream, args.processes,
+                                 args.incremental)
+    exporter = metrics.MetricsExporter(logger, snapshot_file=args.metrics_file, interval=args.metrics_interval,
+                                       port=args.metrics_port).start()
+    try:
+        metrics.run_with_profile(generate_hloc.run, logger, args.profile, args.profile_output)
+    finally:
+        exporter.stop()
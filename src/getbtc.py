@@ -2,31 +2,58 @@
 # -*- coding: utf-8 -*-
 
 import os
-import requests
+import shutil
+import threading
 import argparse
 import pandas as pd
-from progressbar import ProgressBar
+from progressbar import ProgressBar, NullBar
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime as dt
-import datetime
 import time
-import random
 import logger
+import ratelimiter
+import idindex
+import storage
+import checkpoint
+import transport
+import metrics
+import realtime
+from dateconverter import DateConverter
+from ticks import TickArray
 
 
 class GetBtcDataFromBitflyer(object):
 
-    def __init__(self, start_date, finish_date, root_logger, before_id=0, count=500, file_lines=500000):
+    def __init__(self, start_date, finish_date, root_logger, before_id=0, count=500, file_lines=500000,
+                 workers=1, requests_per_window=5.0, window_seconds=1.0, index_dir='./index', storage_format='csv',
+                 is_sync=False, timeout=30.0, product_code='FX_BTC_JPY', data_dir='./data', rate_limiter=None,
+                 shared_transport=None, show_progress=True):
         self.logger = root_logger
         self.arg_before_id = before_id
         self.count = count
         self.file_lines = file_lines
+        # 並列取得のワーカ数. 1の場合は従来通り1ページずつ取得する
+        self.workers = workers
+        # 全ワーカで共有するエンドポイントごとのリクエスト数の上限. 制限されたら自動で下げる.
+        # 複数のプロダクトを取得する場合はプロダクトの間でも共有する
+        self.rate_limiter = rate_limiter or ratelimiter.RateLimiter(requests_per_window, window_seconds)
+        self.data_dir = data_dir
+        self.shard_dir = os.path.join(self.data_dir, '.shards')
+        # 取得したデータの保存形式. csv or parquet
+        self.storage = storage.BtcStorage(self.data_dir, storage_format)
         self.domain_url = 'https://api.bitflyer.jp'
         self.execution_history_url = '/v1/getexecutions'
         self.execution_history_params = {'count': self.count, 
                                             'before': self.arg_before_id, 
-                                            'product_code': 'FX_BTC_JPY'}
+                                            'product_code': product_code}
                                             
-        self.health_check_params = {'product_code': 'FX_BTC_JPY'}
+        self.health_check_params = {'product_code': product_code}
+        # 接続を使い回すHTTPクライアント. 全ワーカで共有する
+        self.transport = shared_transport or transport.BitflyerTransport(
+            self.logger, self.health_check_params, read_timeout=timeout, pool_size=max(self.workers, 10),
+            rate_limiter=self.rate_limiter)
+        # 複数のプロダクトを同時に取得する場合はプログレスバーを出さない
+        self.progress_bar = ProgressBar if show_progress else NullBar
 
         self.keys = ['id',
                      'side',
@@ -39,9 +66,22 @@ class GetBtcDataFromBitflyer(object):
         self.arg_start_date = start_date
         self.arg_finish_date = finish_date
         self.first_date = dt.strptime('2015-06-24 05:58:00', '%Y-%m-%d %H:%M:%S')
-        self.change_num_base = 500
         self.target_start_id = None
-        self.is_searching_before_id = True
+        # 直近の検索でAPIを叩いた回数
+        self.search_probe_count = 0
+        self.is_search_exact = True
+        # これまでに取得したページから作るidと日付のインデックス
+        self.id_index = idindex.IdIndex(index_dir, self.execution_history_params['product_code'])
+        # 保存済みの最新のデータより新しいデータだけを取得する
+        self.is_sync = is_sync
+        # 1ページごとに進捗を記録し、中断しても続きから取得する
+        self.checkpoint = checkpoint.FetchCheckpoint(self.data_dir, self.execution_history_params['product_code'])
+        # プロダクトごとの取得した約定数と速さ, 検索でAPIを叩いた回数
+        self.rows_counter = metrics.REGISTRY.counter('getbtc_rows_total', 'executions fetched')
+        self.rows_gauge = metrics.REGISTRY.gauge('getbtc_rows_per_second', 'executions fetched per second')
+        self.probe_counter = metrics.REGISTRY.counter('getbtc_search_probes_total', 'api requests to search ids')
+        self.product_label = {'product': product_code}
+        self.start_time = time.time()
 
     def run(self):
         # type: () -> None
@@ -49,7 +89,48 @@ class GetBtcDataFromBitflyer(object):
         指定されたデータ取得開始日と取得終了日のbefore_idを検索し、そのbefore_idでAPIを叩く
         :return:
         """
-
+        # 同じ引数で中断した実行があれば、検索せずに続きから取得する
+        checkpoint_key = self.get_checkpoint_key()
+        if self.workers <= 1 and self.checkpoint.load(checkpoint_key) is not None:
+            self.target_start_id = self.checkpoint.state['target_start_id']
+            self.logger.logger.info('resume from before id {} (start id: {})'.format(
+                self.checkpoint.state['before'], self.target_start_id))
+            with metrics.REGISTRY.timer('getbtc_stage_seconds', stage='fetch'):
+                self.run_serial()
+            self.logger.logger.info('FINISH getbtc: {}'.format(self.execution_history_params['product_code']))
+            return
+
+        # 保存済みの最新のデータより新しいデータだけを取得する
+        if self.is_sync:
+            newest_id = self.storage.get_newest_id()
+            if newest_id is None:
+                self.logger.logger.error('There is no data to sync. Please specify the start date.')
+                exit(1)
+            self.logger.logger.info('sync from the stored newest id: {}'.format(newest_id))
+            self.target_start_id = newest_id + 1
+            search_finish_id = 0
+        else:
+            with metrics.REGISTRY.timer('getbtc_stage_seconds', stage='search'):
+                search_finish_id = self.search_target_ids()
+
+        # ワーカが複数指定されていればidの範囲を分割して並列に取得する
+        if self.workers > 1:
+            with metrics.REGISTRY.timer('getbtc_stage_seconds', stage='fetch'):
+                self.run_sharded(search_finish_id)
+            self.logger.logger.info('FINISH getbtc: {}'.format(self.execution_history_params['product_code']))
+            return
+
+        self.checkpoint.start(checkpoint_key, self.target_start_id, search_finish_id)
+        with metrics.REGISTRY.timer('getbtc_stage_seconds', stage='fetch'):
+            self.run_serial()
+        self.logger.logger.info('FINISH getbtc: {}'.format(self.execution_history_params['product_code']))
+
+    def search_target_ids(self):
+        # type: () -> int
+        """
+        データ取得開始日と終了日のidを検索する
+        :return: データ取得終了日のid. 終了日が指定されていなければ0
+        """
         # データ取得開始日が最初の取引より前の場合はエラー
         if self.is_arg_date_too_past():
             self.logger.logger.error('A date in the past is specified from the first deal. '
@@ -61,33 +142,10 @@ class GetBtcDataFromBitflyer(object):
         self.logger.logger.info('finish date: {}'.format(self.arg_finish_date))
         self.logger.logger.info('Look for the before id of the start date')
 
-        # 検索開始のbefore_idを初期化
-        search_before_id = 0
-
-        # データ取得開始日のbefore_idを検索
-        while self.is_searching_before_id:
-            time.sleep(0.2)
-            try:
-                # before_idを検索し更新する
-                search_before_id = self.search_before_id_pipeline(self.arg_start_date, search_before_id)
-                # データ取得件数をリセット
-                self.execution_history_params['count'] = self.count
-            except Exception as e:
-                # before_idの前に取得件数分のデータがない場合はエラー？サーバが忙しい？
-                # または、APIを叩いた際にデータが取得できずpandasに変換してしまった場合のキャッチ
-                # スリープしcountを調整して再度ループ
-                self.logger.logger.error(e)
-                # サーバのステータスチェック
-                status = requests.get('https://api.bitflyer.jp/v1/gethealth', params=self.health_check_params)
-                self.logger.logger.error('server status: {}'.format(status.text))
-                time.sleep(10)
-                random_rate = random.random()
-                self.execution_history_params['count'] = 1 + int(self.count*random_rate)
-                self.logger.logger.error('next use count: {}'.format(self.execution_history_params['count']))
-
-        # 発見した取得開始日を保持. このidまで遡ってデータを取得する
-        self.target_start_id = search_before_id
-        self.logger.logger.info('The id of the date to be searched was found: {}'.format(self.target_start_id))
+        # データ取得開始日のidを検索. このidまで遡ってデータを取得する
+        self.target_start_id = self.search_before_id_pipeline(self.arg_start_date)
+        self.logger.logger.info('The id of the date to be searched was found: {} ({} probes)'.format(
+            self.target_start_id, self.search_probe_count))
 
         # データ取得終了日の初期化
         search_finish_id = 0
@@ -95,205 +153,353 @@ class GetBtcDataFromBitflyer(object):
         # 引数で指定されていればfinish_dateのidを探す
         if self.arg_finish_date:
             self.logger.logger.info('Look for the before id of the finish date')
-            # フラグを初期化
-            self.is_searching_before_id = True
-
-            while self.is_searching_before_id:
-                time.sleep(0.2)
-                try:
-                    search_finish_id = self.search_before_id_pipeline(self.arg_finish_date, search_finish_id)
-                    self.execution_history_params['count'] = self.count
-                except Exception as e:
-                    self.logger.logger.error(e)
-                    # サーバのステータスチェック
-                    status = requests.get('https://api.bitflyer.jp/v1/gethealth', params=self.health_check_params)
-                    self.logger.logger.error('server status: {}'.format(status.text))
-                    time.sleep(10)
-                    random_rate = random.random()
-                    self.execution_history_params['count'] = 1 + int(self.count * random_rate)
-                    self.logger.logger.error('next use count: {}'.format(self.execution_history_params['count']))
-            self.logger.logger.info('The id of the finish date to be searched was found: {}'.format(search_finish_id))
-
-        # finish_dateが指定されていれば、上の処理で探したid. 指定されていなければ0
-        self.execution_history_params['before'] = search_finish_id
+            search_finish_id = self.search_before_id_pipeline(self.arg_finish_date)
+            self.logger.logger.info('The id of the finish date to be searched was found: {} ({} probes)'.format(
+                search_finish_id, self.search_probe_count))
+
+        return search_finish_id
+
+    def run_serial(self):
+        # type: () -> None
+        """
+        チェックポイントのbefore_idからtarget_start_idまで1ページずつ遡って取得する.
+        ページを取得するたびにチェックポイントへ記録し、file_linesごとに保存する
+        :return:
+        """
+        # finish_dateが指定されていれば、検索したid. 指定されていなければ0. 再開した場合は中断したid
+        self.execution_history_params['before'] = self.checkpoint.state['before']
         self.execution_history_params['count'] = self.count
+        # before_idがtarget_start_idを下回っていれば取得は終わっている
+        is_finished = 0 < self.checkpoint.state['before'] < self.target_start_id
+
+        # 中断した実行で保存前だったページ
+        spool_df = self.checkpoint.load_spool()
 
         # 見つかったbefore_id(データ取得日)までデータを取得する.
         # データ取得終了日が指定されている場合は上記の処理で見つかったbefore_id(データ取得終了日)から取得を開始する
         while True:
-            # データ格納用データフレームの初期化
-            df = pd.DataFrame(columns=self.keys)
-            result_df = pd.DataFrame(columns=self.keys)
+            # ページごとの約定を型付きの配列で格納するリスト. 保存する際に一度だけ結合する
+            chunk_list = []
+            chunk_lines = 0
+            if spool_df is not None and len(spool_df) > 0:
+                chunk_list.append(TickArray.from_frame(spool_df))
+                chunk_lines += len(spool_df)
+            spool_df = None
             # プログレスバーの初期化
-            p = ProgressBar(len(result_df), self.file_lines)
-            while True:
-                # データ取得, データフレームへ変換
-                try:
-                    time.sleep(0.2)
-                    response = self.execute_api_request()
-                    tmp_df = pd.read_json(response.text)
-                except Exception as e:
-                    self.logger.logger.error(' An error occurred in api request: {}'.format(response))
-                    self.logger.logger.error(e)
-                    # サーバのステータスチェック
-                    status = requests.get('https://api.bitflyer.jp/v1/gethealth', params=self.health_check_params)
-                    self.logger.logger.error('server status: {}'.format(status.text))
-                    time.sleep(10)
-                    random_rate = random.random()
-                    self.execution_history_params['count'] = 1 + int(self.count * random_rate)
-                    self.logger.logger.error('next use count: {}'.format(self.execution_history_params['count']))
-                    continue
+            p = self.progress_bar(chunk_lines, self.file_lines)
+            while chunk_lines < self.file_lines and not is_finished:
+                # データ取得, データフレームへ変換. エラーの場合はtransportがリトライする
+                tmp_df = pd.DataFrame(self.execute_api_request(), columns=self.keys)
+
+                # id 0まで遡った場合は空のデータが返る
+                if tmp_df.empty:
+                    is_finished = True
+                    break
 
                 # 次のループの設定
                 next_before_id = tmp_df['id'].iloc[-1]
                 self.execution_history_params['before'] = next_before_id
-                self.execution_history_params['count'] = self.count
 
-                # 取得したデータを足し合わせる
-                df = pd.concat([df, tmp_df])
+                # 発見したbefore_id(データ取得開始日)を通り過ぎていないかは今回のページだけでチェックする
+                # 通り過ぎていたら、そこまでを格納してループを抜ける
+                if next_before_id < self.target_start_id:
+                    tmp_df = tmp_df[tmp_df['id'] >= self.target_start_id]
+                    is_finished = True
 
-                # 発見したbefore_id(データ取得開始日)を通り過ぎていないかチッェク
-                # 通り過ぎていたら、そこまでをresult_dfへ格納
-                result_df = df[df['id'] >= self.target_start_id]
+                # 取得したデータを格納し、チェックポイントへ記録する
+                chunk_list.append(TickArray.from_frame(tmp_df))
+                chunk_lines += len(tmp_df)
+                self.checkpoint.append_page(tmp_df, next_before_id)
+                self.count_rows(len(tmp_df))
 
-                # データ数がfile_linesを上回っていないかチェック
-                # また、発見したbefore_id(データ取得開始日)を通り過ぎていないかチッェクし通り過ぎていたら、ループを抜ける
-                if len(result_df) >= self.file_lines or df.shape[0] > result_df.shape[0]:
-                    p.update(self.file_lines)
-                    break
-                else:
-                    p.update(len(result_df))
+                # プログレスバーの更新
+                p.update(min(chunk_lines, self.file_lines))
 
             # 一つのファイルを作ったら保存
-            self.save_result_data(result_df)
+            if chunk_lines > 0:
+                result_ticks = TickArray.concat(chunk_list)
+                self.checkpoint.flush(self.save_result_data(result_ticks.to_frame()), int(result_ticks['id'][-1]))
 
             # 発見したbefore_id(データ取得開始日)を過ぎていたらループ自体を終了
-            if df.shape[0] > result_df.shape[0]:
+            if is_finished:
                 break
 
-        self.logger.logger.info('FINISH getbtc')
+        self.checkpoint.clear()
 
-    def search_before_id_pipeline(self, base_date, search_before_id):
-        # type: (dt, int) -> int
+    def get_checkpoint_key(self):
+        # type: () -> dict
         """
-        before_idを検索するパイプライン. APIを叩き得られたデータの日付と指定された日付の差を元にbefore_idを更新する
-        :param base_date: 検索する基準となる日付. 開始日 or 終了日
-        :param search_before_id: 検索する基準となるbefore_id
-        :return: 見つかったbefore_id
+        中断した実行と同じ引数かを判定するためのキー
+        :return: 実行の引数
+        """
+        return {'start_date': None if self.is_sync else str(self.arg_start_date),
+                'finish_date': None if self.is_sync or not self.arg_finish_date else str(self.arg_finish_date),
+                'sync': self.is_sync,
+                'storage_format': self.storage.storage_format,
+                'file_lines': self.file_lines}
+
+    def run_sharded(self, search_finish_id):
+        # type: (int) -> None
+        """
+        target_start_idからsearch_finish_idまでのidの範囲をワーカ数で分割し、並列に取得した後に順番通りに繋げて保存する
+        :param search_finish_id: データ取得終了日のid. 0の場合は最新のデータまで取得する
+        :return:
         """
-        # before_idをセット
-        self.execution_history_params['before'] = search_before_id
+        # 終了日が指定されていなければ最新のidを取得し、その次のidを上限とする
+        if search_finish_id == 0:
+            search_finish_id = self.get_latest_id() + 1
+
+        shard_ranges = self.split_id_range(self.target_start_id, search_finish_id)
+        self.logger.logger.info('fetch {} shards with {} workers'.format(len(shard_ranges), self.workers))
+
+        # 前回の中断で残ったシャードを削除
+        if os.path.exists(self.shard_dir):
+            shutil.rmtree(self.shard_dir)
+        os.makedirs(self.shard_dir)
+
+        # プログレスバーは全ワーカで共有し、取得済みのidの幅で進める
+        self.progress = self.progress_bar(0, search_finish_id - self.target_start_id)
+        self.progress_value = 0
+        self.progress_lock = threading.Lock()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(self.fetch_shard, shard_num, lower_id, upper_id)
+                       for shard_num, (lower_id, upper_id) in enumerate(shard_ranges)]
+            shard_files = [future.result() for future in futures]
+
+        # 新しいシャードから順に繋げ、file_linesごとに保存する
+        self.stitch_shards(shard_files)
+        shutil.rmtree(self.shard_dir)
+
+    def split_id_range(self, start_id, finish_id):
+        # type: (int, int) -> list
+        """
+        [start_id, finish_id)のidの範囲を分割する. 新しい(idが大きい)範囲から順に並べる
+        :param start_id: 取得する最初のid
+        :param finish_id: 取得する最後のidの次のid
+        :return: (下限id, 上限id)のリスト
+        """
+        # 1シャードが少なくとも1ページ分のidを持つように分割数を決める
+        shard_num = max(1, min(self.workers * 4, int((finish_id - start_id) / self.count)))
+        step = (finish_id - start_id) / float(shard_num)
+        bounds = [start_id + int(step * i) for i in range(shard_num)] + [finish_id]
+        shard_ranges = [(bounds[i], bounds[i + 1]) for i in range(shard_num) if bounds[i] < bounds[i + 1]]
+        return shard_ranges[::-1]
+
+    def fetch_shard(self, shard_num, lower_id, upper_id):
+        # type: (int, int, int) -> list
+        """
+        upper_idから遡りlower_idまでのデータを取得しシャード用ディレクトリへ保存する
+        :param shard_num: シャード番号. 0が最も新しい
+        :param lower_id: 取得する最初のid(含む)
+        :param upper_id: 取得する最後のidの次のid(含まない)
+        :return: 保存したファイルのリスト. 新しい順
+        """
+        # パラメータはシャードごとに持つ
+        params = dict(self.execution_history_params)
+        params['before'] = upper_id
+        params['count'] = self.count
+
+        shard_files = []
+        chunk_list = []
+        chunk_lines = 0
+        is_finished = False
+
+        while not is_finished:
+            tmp_df = pd.DataFrame(self.execute_api_request(params), columns=self.keys)
+
+            # id 0まで遡った場合は空のデータが返る
+            if tmp_df.empty:
+                next_before_id = lower_id
+            else:
+                next_before_id = max(int(tmp_df['id'].iloc[-1]), lower_id)
+                tmp_df = tmp_df[tmp_df['id'] >= lower_id]
+                chunk_list.append(TickArray.from_frame(tmp_df))
+                chunk_lines += len(tmp_df)
+                self.count_rows(len(tmp_df))
+
+            # 遡ったidの幅だけプログレスバーを進める
+            with self.progress_lock:
+                self.progress_value += params['before'] - next_before_id
+                self.progress.update(self.progress_value)
+
+            # lower_idを通り過ぎたら終了
+            is_finished = next_before_id <= lower_id
+            params['before'] = next_before_id
+
+            if chunk_lines >= self.file_lines or (is_finished and chunk_lines > 0):
+                shard_file = os.path.join(self.shard_dir, 'shard_{:05d}_{:05d}.csv'.format(shard_num, len(shard_files)))
+                TickArray.concat(chunk_list).to_frame().to_csv(shard_file, index=False)
+                shard_files.append(shard_file)
+                chunk_list = []
+                chunk_lines = 0
+
+        self.logger.logger.info('finished shard {}: {} - {}'.format(shard_num, lower_id, upper_id))
+        return shard_files
+
+    def stitch_shards(self, shard_files):
+        # type: (list) -> None
+        """
+        シャードごとに保存したファイルを新しい順に繋げ、file_linesごとに保存し直す
+        :param shard_files: シャードごとの保存ファイルのリスト
+        :return:
+        """
+        chunk_list = []
+        chunk_lines = 0
+
+        for shard_file in [x for files in shard_files for x in files]:
+            tmp_df = pd.read_csv(shard_file)
+            while len(tmp_df) > 0:
+                # file_linesに足りない分だけ取り出す
+                take_lines = self.file_lines - chunk_lines
+                chunk_list.append(tmp_df.iloc[:take_lines])
+                chunk_lines += len(chunk_list[-1])
+                tmp_df = tmp_df.iloc[take_lines:]
+
+                if chunk_lines >= self.file_lines:
+                    self.save_result_data(pd.concat(chunk_list))
+                    chunk_list = []
+                    chunk_lines = 0
+
+        if chunk_lines > 0:
+            self.save_result_data(pd.concat(chunk_list))
+
+    def get_latest_id(self):
+        # type: () -> int
+        """
+        最新の約定idを取得する
+        :return: 最新のid
+        """
+        params = dict(self.execution_history_params)
+        params['before'] = 0
+        params['count'] = 1
 
-        try:
-            # APIを叩く
-            search_response = self.execute_api_request()
-            # データをpandasに変換
-            search_btc_df = pd.read_json(search_response.text)
-        except Exception as e:
-            # 500エラーが出た際のハンドリング（pandas変換時にエラー）. 上に投げる
-            self.logger.logger.error(' An error occurred in api request: {}'.format(search_response))
-            self.logger.logger.error(e)
+        return int(self.execute_api_request(params)[0]['id'])
+
+    def search_before_id_pipeline(self, base_date):
+        # type: (dt) -> int
+        """
+        指定された日付以降で最初の約定のidを検索するパイプライン. 検索済みの日付であればインデックスから返す
+        :param base_date: 検索する基準となる日付. 開始日 or 終了日
+        :return: 見つかったid. このidをbeforeに指定すると基準日より前のデータが得られる
+        """
+        self.search_probe_count = 0
 
-        # ISOを日本時間に変換
-        search_date = self.format_date(search_btc_df['exec_date'].iloc[0])
-        self.logger.logger.info('searching for date: {}'.format(search_date))
+        found_id = self.id_index.get_exact(base_date)
+        if found_id is not None:
+            return found_id
 
-        # 基準日と今回得られた日付の差を元に次に検索するbefore_idを決定する
-        search_before_id = self.search_before_id(base_date, search_date, search_btc_df)
+        found_id = self.search_before_id(base_date)
 
-        return search_before_id
+        # 最新の約定より後の日付はデータが増えると変わるので保存しない
+        if self.is_search_exact:
+            self.id_index.add_exact(base_date, found_id)
+        return found_id
 
-    def search_before_id(self, base_date, search_date, search_btc_df):
-        # type: (dt, dt, df) -> int
+    def search_before_id(self, base_date):
+        # type: (dt) -> int
         """
-        基準日と渡された日付の大小を調べ、before_idを増減させて返す
+        約定日時はidに対して単調増加なので、既知の(id, 日付)の組を下限と上限として補間探索で絞り込み、
+        絞り込みが半分に満たなかった場合は二分探索に切り替える
         :param base_date: 検索する基準となる日付. 開始日 or 終了日
-        :param search_date: 現在のbefore_idで得られた日付
-        :param search_btc_df: 現在のbefore_idで得られたデータフレーム
-        :return: 増減させたbefore_id
-        """
-        # 基準日が未来にある場合(遡りすぎた)
-        if search_date < base_date:
-            # 日付時刻の差を求める
-            diff_second = (base_date - search_date).total_seconds()
-            # diff_secondを使ってbefore_idの増減数を決定する
-            change_id_num = self.get_change_id_num(diff_second)
-            # 次のbefore_idを決定する
-            search_before_id = int(search_btc_df['id'].iloc[0]) + change_id_num
-
-        # 基準日が過去にある場合
-        elif search_date > base_date:
-            # 日付時刻の差を求める
-            diff_second = (search_date - base_date).total_seconds()
-            # diff_secondを使ってbefore_idの増減数を決定する
-            change_id_num = self.get_change_id_num(diff_second)
-            # 次のbefore_idを決定する
-            search_before_id = int(search_btc_df['id'].iloc[-1]) - change_id_num
-
-        # 基準日まで遡った場合
-        else:
-            # 日本時刻に直し~時~分の形式に直す
-            iso_arg_date = base_date - datetime.timedelta(hours=9)
-            iso_arg_date = str(iso_arg_date.hour) + ':' + str(iso_arg_date.minute)
-
-            # 基準日（時刻）のidを調べる
-            for i, date in enumerate(search_btc_df['exec_date']):
-                if iso_arg_date in date:
-                    tmp_series = search_btc_df.iloc[i]
-                    # idを取り出す
-                    search_before_id = tmp_series['id']
-
-            # 検索終了フラグへ書き換え
-            self.is_searching_before_id = False
-
-        return search_before_id
-
-    def get_change_id_num(self, diff_second):
-        # type: (float) -> int
-        """
-        日付時刻の差を元にbefore_idの増減させる数字を決める
-        :param diff_second: 日付時刻の差
-        :return: before_idの増減数
-        """
-        # 各時間軸に直す
-        diff_minutes = diff_second/60
-        diff_hour = diff_minutes/60
-        diff_date = diff_hour/24
-        diff_week = diff_date/7
-        diff_month = diff_week/4
-        diff_year = diff_month/12
-
-        # 各時間軸で増減数を決定する. 過去になればなるほど取引量が少なくなるので、
-        # 数年前、数ヶ月前だからと言って大きく増減させるとうまくいかない
-        if diff_year >= 1:
-            # 26,280,000
-            # floatだとパラメータが認識されない
-            change_id_num = int((self.change_num_base * 60 * 24 * 365) * 0.1)
-        elif diff_month >= 1:
-            # 4,464,000
-            change_id_num = int((self.change_num_base * 60 * 24 * 31) * 0.1)
-        elif diff_week >= 1:
-            # 10080
-            change_id_num = self.change_num_base * 60 * 24 * 7
-        elif diff_date >= 1:
-            change_id_num = self.change_num_base * 60 * 24
-        elif diff_hour >= 1:
-            change_id_num = self.change_num_base * 60
-        elif diff_minutes >= 1:
-            change_id_num = self.change_num_base
-        elif diff_minutes == 0:
-            change_id_num = 0
-
-        return change_id_num
-
-    def execute_api_request(self):
-        # type: () -> str
-        """
-        bitflyerAPIを叩く
-        :return: btcデータ
+        :return: 基準日以降で最初の約定のid
+        """
+        self.is_search_exact = True
+
+        # インデックスから基準日を挟む約定を探す. 下限が無ければid 0と最初の取引日
+        lower_id, lower_date, upper_id, upper_date = self.id_index.lookup(base_date)
+        if lower_id is None:
+            lower_id, lower_date = 0, self.first_date
+
+        previous_width = None
+        is_bisection = False
+
+        while True:
+            # 上限が無ければ最新のデータを取得する
+            if upper_id is None:
+                before_id = 0
+            else:
+                self.logger.info_every('search id', 1.0, 'searching for id between {} ({}) and {} ({})',
+                                       lower_id, lower_date, upper_id, upper_date)
+
+                width = upper_id - lower_id
+                if width <= 1:
+                    return upper_id
+
+                # 前回の探索で範囲が半分以下にならなければ一度だけ二分探索で絞り込む
+                is_bisection = not is_bisection and previous_width is not None and width > previous_width // 2
+                previous_width = width
+                if is_bisection:
+                    guess_id = lower_id + width // 2
+                else:
+                    # 日付の差の割合でidを補間する
+                    rate = (base_date - lower_date).total_seconds() / max((upper_date - lower_date).total_seconds(), 1)
+                    guess_id = lower_id + int(width * rate)
+
+                # 推定したidがページの中央になるようにbefore_idを決める. 範囲が1ページに収まる場合は上限から取得する
+                if width <= self.count:
+                    before_id = upper_id
+                else:
+                    before_id = min(max(guess_id + self.count // 2, lower_id + 2), upper_id)
+
+            page = self.request_search_page(before_id)
+            self.search_probe_count += 1
+            self.probe_counter.inc(**self.product_label)
+
+            # ページの上端がbefore_id(上限のid)であれば、ページの先頭と上限は隣り合うidになる
+            above_id = upper_id if before_id == upper_id else None
+            for exec_id, exec_date in page:
+                if exec_date >= base_date:
+                    above_id = exec_id
+                    if upper_id is None or exec_id < upper_id:
+                        upper_id, upper_date = exec_id, exec_date
+                else:
+                    # 基準日より前の約定とその次の約定が見つかった
+                    if above_id is not None:
+                        return above_id
+                    if exec_id > lower_id:
+                        lower_id, lower_date = exec_id, exec_date
+                    # ページの先頭が基準日より前なので、before_idの直前までは他のプロダクトのidしか無い.
+                    # 下限を上げないと同じ範囲を探し続ける
+                    lower_id = max(lower_id, before_id - 1)
+                    break
+
+            # 最新のページが全て基準日より前の場合は最新のidの次のidを返す
+            if upper_id is None:
+                self.is_search_exact = False
+                return page[0][0] + 1 if page else before_id
+
+            # before_idより前にデータが無い場合は、before_idの直前までは基準日以降のデータが無い
+            if not page:
+                lower_id = max(lower_id, before_id - 1)
+
+    def request_search_page(self, before_id):
+        # type: (int) -> list
+        """
+        検索用にbefore_idより前のデータを取得する. エラーの場合はtransportがリトライする
+        :param before_id: 検索するbefore_id. 0の場合は最新のデータ
+        :return: (id, 日本時間の日付)のリスト. idの降順
         """
+        self.execution_history_params['before'] = before_id
+        rows = self.execute_api_request()
+        dates = DateConverter.to_jst([x['exec_date'] for x in rows], 'm').astype('datetime64[us]').tolist()
+        return [(int(x['id']), date) for x, date in zip(rows, dates)]
+
+    def execute_api_request(self, params=None):
+        # type: (dict) -> list
+        """
+        bitflyerAPIを叩く. 接続は使い回し、エラーの場合はバックオフしてリトライする
+        :param params: リクエストパラメータ. 指定がなければexecution_history_paramsを使う
+        :return: btcデータのリスト. idの降順
+        """
+        if params is None:
+            params = self.execution_history_params
         request_url = self.domain_url + self.execution_history_url
-        return requests.get(request_url, params=self.execution_history_params)
+        rows = self.transport.get_json(request_url, params)
+
+        # 取得したページの両端のidと日付をインデックスへ追加する
+        self.id_index.add_page(rows, self.format_date)
+        return rows
 
     def is_arg_date_too_past(self):
         # type: () -> bool
@@ -304,24 +510,29 @@ class GetBtcDataFromBitflyer(object):
         return self.first_date > self.arg_start_date
 
     def save_result_data(self, result_df):
-        # type: (df) -> None
+        # type: (df) -> list
         """
         btcデータを保存する
         :param result_df: データを格納したデータフレーム
+        :return: 保存したファイルのリスト
+        """
+        # 保存. parquetの場合は日付ごとに分けて保存される
+        with metrics.REGISTRY.timer('getbtc_stage_seconds', stage='save'):
+            file_list = self.storage.save(result_df)
+        for file_name in file_list:
+            self.logger.logger.info(' save on {}'.format(file_name))
+        return file_list
+
+    def count_rows(self, rows):
+        # type: (int) -> None
+        """
+        取得した約定数をメトリクスへ記録する
+        :param rows: 取得した約定数
         :return:
         """
-        # 日付フォーマット
-        first_date = self.format_date(result_df['exec_date'].iloc[0])
-        last_date = self.format_date(result_df['exec_date'].iloc[-1])
-
-        # ファイル名作成
-        str_first_date = str(first_date).replace(' ', '-').replace(':00', '')
-        str_last_date = str(last_date).replace(' ', '-').replace(':00', '')
-        file_name = './data/btc_{}_{}.csv'.format(str_first_date, str_last_date)
-
-        # 保存
-        result_df.to_csv(file_name, index=False)
-        self.logger.logger.info(' save on {}'.format(file_name))
+        self.rows_counter.inc(rows, **self.product_label)
+        total_rows = self.rows_counter.values.get(self.rows_counter.to_key(self.product_label), 0.0)
+        self.rows_gauge.set(total_rows / max(time.time() - self.start_time, 1e-9), **self.product_label)
 
     @staticmethod
     def format_date(date_line):
@@ -331,12 +542,28 @@ class GetBtcDataFromBitflyer(object):
         :param date_line: ISO形式の日付
         :return: 日本時間へ変換した日付
         """
-        tmp_date = date_line.replace('T', ' ')
-        tmp_date = tmp_date.split('.')[0]
-        date = dt.strptime(tmp_date, '%Y-%m-%d %H:%M:%S')
-        date = date.replace(second=0)
-        date = date + datetime.timedelta(hours=9)
-        return date
+        return DateConverter.to_jst_datetime(date_line, 'm')
+
+
+def run_products(get_btc_list, root_logger):
+    # type: (list, logger) -> bool
+    """
+    複数のプロダクトを別々のスレッドで同時に取得する. 一つのプロダクトが失敗しても他のプロダクトは続ける
+    :param get_btc_list: プロダクトごとのGetBtcDataFromBitflyer. レート制限と接続を共有する
+    :param root_logger: ロガー
+    :return: 全てのプロダクトを取得できればTrue
+    """
+    with ThreadPoolExecutor(max_workers=len(get_btc_list)) as executor:
+        futures = [(x.execution_history_params['product_code'], executor.submit(x.run)) for x in get_btc_list]
+
+    is_success = True
+    for product_code, future in futures:
+        try:
+            future.result()
+        except (Exception, SystemExit) as e:
+            root_logger.logger.error('Failed to fetch {}: {!r}'.format(product_code, e))
+            is_success = False
+    return is_success
 
 
 if __name__ == '__main__':
@@ -345,10 +572,71 @@ if __name__ == '__main__':
                                              'Please specify it in the following format. '
                                              'ex. 2018-04-07-22:06:00',
                         action='store',
-                        required=True)
+                        required=False)
     parser.add_argument('-f', '--finish_date', help='It is the finish date. ',
                         action='store',
                         required=False)
+    parser.add_argument('-p', '--product', help='Comma separated product codes fetched at the same time. '
+                                                'Each product is saved in ./data/<product code>.',
+                        action='store',
+                        required=False)
+    parser.add_argument('-w', '--workers', help='Number of workers for concurrent backfill.',
+                        action='store',
+                        type=int,
+                        default=1,
+                        required=False)
+    parser.add_argument('--format', help='Storage format of the data. csv or parquet.',
+                        action='store',
+                        choices=['csv', 'parquet'],
+                        default='csv',
+                        required=False)
+    parser.add_argument('-r', '--rate', help='Total requests per window shared by all workers.',
+                        action='store',
+                        type=float,
+                        default=5.0,
+                        required=False)
+    parser.add_argument('--window', help='Window of the request budget in seconds.',
+                        action='store',
+                        type=float,
+                        default=1.0,
+                        required=False)
+    parser.add_argument('--timeout', help='Read timeout of api requests in seconds.',
+                        action='store',
+                        type=float,
+                        default=30.0,
+                        required=False)
+    parser.add_argument('--sync', help='Fetch only executions newer than the newest data in ./data.',
+                        action='store_true',
+                        required=False)
+    parser.add_argument('--stream', help='Subscribe to realtime executions and build bars live.',
+                        action='store_true',
+                        required=False)
+    parser.add_argument('-t', '--time', help='Time axes of live bars. comma separated.',
+                        action='store',
+                        default='one_minute,5_minute,one_hour,one_day',
+                        required=False)
+    parser.add_argument('--replay', help='URL of the local replay server to stream from (ex. http://127.0.0.1:8080).',
+                        action='store',
+                        required=False)
+    parser.add_argument('--metrics-file', help='JSON file to write metrics snapshots periodically.',
+                        action='store',
+                        required=False)
+    parser.add_argument('--metrics-interval', help='Interval of metrics snapshots in seconds.',
+                        action='store',
+                        type=float,
+                        default=10.0,
+                        required=False)
+    parser.add_argument('--metrics-port', help='Port to serve prometheus metrics on /metrics.',
+                        action='store',
+                        type=int,
+                        required=False)
+    parser.add_argument('--profile', help='Profile the run. cprofile or tracemalloc.',
+                        action='store',
+                        choices=['cprofile', 'tracemalloc'],
+                        required=False)
+    parser.add_argument('--profile-output', help='File to save the profile.',
+                        action='store',
+                        required=False)
 
     args = parser.parse_args()
     
@@ -359,9 +647,52 @@ if __name__ == '__main__':
     logger = logger.Logger()
     logger.logger.info('START getbtc')
     
+    # プロダクトを指定した場合はプロダクトごとのディレクトリへ保存する
+    product_list = args.product.split(',') if args.product else ['FX_BTC_JPY']
+    data_dir_list = [os.path.join('./data', x) for x in product_list] if args.product else ['./data']
+    for data_dir in data_dir_list:
+        if not os.path.exists(data_dir):
+            os.makedirs(data_dir)
+
+    exporter = metrics.MetricsExporter(logger, snapshot_file=args.metrics_file, interval=args.metrics_interval,
+                                       port=args.metrics_port).start()
+
+    # リアルタイムAPIから約定を受け取り続ける
+    if args.stream:
+        if len(product_list) > 1:
+            logger.logger.error('Please specify one product with --stream.')
+            exit(1)
+        stream_kwargs = {}
+        if args.replay:
+            stream_kwargs = {'ws_url': args.replay.replace('http', 'ws', 1) + '/json-rpc', 'domain_url': args.replay}
+        try:
+            execution_stream = realtime.ExecutionStream(logger, args.time, product_code=product_list[0],
+                                                        data_dir=data_dir_list[0], storage_format=args.format,
+                                                        requests_per_window=args.rate, window_seconds=args.window,
+                                                        timeout=args.timeout, **stream_kwargs)
+        except ValueError:
+            logger.logger.error('Please specify time axis as one_minute, 5_minute, one_hour, one_day '
+                                'or a number with a unit such as 15m, 4h, 1w.')
+            exit(1)
+        try:
+            metrics.run_with_profile(execution_stream.run, logger, args.profile, args.profile_output)
+        except KeyboardInterrupt:
+            logger.logger.info('stopped')
+        finally:
+            exporter.stop()
+        exit(0)
+
+    # 同期する場合以外は開始日が必要
+    if not args.sync and not args.start_date:
+        logger.logger.error('Please specify the start date or --sync.')
+        exit(1)
+
     try:
-        arg_start_date = dt.strptime(args.start_date, '%Y-%m-%d-%H:%M:%S')
-        arg_start_date = arg_start_date.replace(second=0)
+        if args.start_date:
+            arg_start_date = dt.strptime(args.start_date, '%Y-%m-%d-%H:%M:%S')
+            arg_start_date = arg_start_date.replace(second=0)
+        else:
+            arg_start_date = None
         if args.finish_date:
             arg_finish_date = dt.strptime(args.finish_date, '%Y-%m-%d-%H:%M:%S')
             arg_finish_date = arg_finish_date.replace(second=0)
@@ -374,7 +705,7 @@ if __name__ == '__main__':
         exit(1)
 
     # 引数の日付チェック（start_dateの方が「最近」だとエラー）
-    if args.finish_date:
+    if args.finish_date and arg_start_date:
         if arg_start_date > arg_finish_date:
             logger.logger.error('Please specify the date after the start date for the finish date.')
             exit(1)
@@ -384,5 +715,35 @@ if __name__ == '__main__':
             logger.logger.error('Future date can not be specified.')
             exit(1)
 
-    get_btc = GetBtcDataFromBitflyer(arg_start_date, arg_finish_date, logger)
-    get_btc.run()
+    if len(product_list) == 1:
+        get_btc = GetBtcDataFromBitflyer(arg_start_date, arg_finish_date, logger,
+                                         workers=args.workers, requests_per_window=args.rate,
+                                         window_seconds=args.window,
+                                         storage_format=args.format, is_sync=args.sync,
+                                         timeout=args.timeout, product_code=product_list[0],
+                                         data_dir=data_dir_list[0])
+        try:
+            metrics.run_with_profile(get_btc.run, logger, args.profile, args.profile_output)
+        finally:
+            exporter.stop()
+        exit(0)
+
+    # 全プロダクトで一つのリクエストの予算と接続を共有し、プロダクトの間で順番に使う
+    shared_rate_limiter = ratelimiter.RateLimiter(args.rate, args.window)
+    # ステータスはエラーになったリクエストのプロダクトで確認する
+    shared_transport = transport.BitflyerTransport(logger, {},
+                                                   read_timeout=args.timeout,
+                                                   pool_size=max(args.workers * len(product_list), 10),
+                                                   rate_limiter=shared_rate_limiter)
+    get_btc_list = [GetBtcDataFromBitflyer(arg_start_date, arg_finish_date, logger,
+                                           workers=args.workers, storage_format=args.format, is_sync=args.sync,
+                                           product_code=product_code, data_dir=data_dir,
+                                           rate_limiter=shared_rate_limiter, shared_transport=shared_transport,
+                                           show_progress=False)
+                    for product_code, data_dir in zip(product_list, data_dir_list)]
+    try:
+        is_success = metrics.run_with_profile(lambda: run_products(get_btc_list, logger), logger, args.profile,
+                                              args.profile_output)
+    finally:
+        exporter.stop()
+    exit(0 if is_success else 1)
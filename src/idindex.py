@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This module provides a persistent sparse index between execution id and date.
+"""
+
+import os
+import bisect
+import threading
+from datetime import datetime as dt
+
+
+class IdIndex(object):
+    """
+    This class keeps (id, date) pairs seen in api responses and narrows the id search of a date.
+    """
+
+    def __init__(self, index_dir, product_code):
+        # type: (str, str) -> None
+        """
+        Class initialization.
+        :param index_dir: インデックスを保存するディレクトリ
+        :param product_code: プロダクトコード. プロダクトごとにファイルを分ける
+        """
+        if not os.path.exists(index_dir):
+            os.makedirs(index_dir)
+        self.index_file = os.path.join(index_dir, 'id_index_{}.csv'.format(product_code))
+        self.date_format = '%Y-%m-%d %H:%M:%S'
+
+        # ページの両端の約定. id -> 日本時間の日付
+        self.page_dates = {}
+        # 検索済みの日付. 日付 -> その日付以降で最初の約定のid
+        self.exact_ids = {}
+
+        # 検索用にidでソートしたリスト. ページが追加されたら作り直す
+        self.sorted_ids = []
+        self.sorted_dates = []
+        self.is_sorted = True
+
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        # type: () -> None
+        """
+        保存されたインデックスを読み込む
+        :return:
+        """
+        if not os.path.exists(self.index_file):
+            return
+
+        with open(self.index_file) as f:
+            for line in f:
+                kind, exec_id, exec_date = line.rstrip('\n').split(',')
+                exec_date = dt.strptime(exec_date, self.date_format)
+                if kind == 'exact':
+                    self.exact_ids[exec_date] = int(exec_id)
+                else:
+                    self.page_dates[int(exec_id)] = exec_date
+        self.is_sorted = False
+
+    def add_page(self, rows, format_date):
+        # type: (list, function) -> None
+        """
+        APIで取得したページの両端の約定をインデックスへ追加する
+        :param rows: APIで取得した約定のリスト. idの降順
+        :param format_date: ISO形式の日付を日本時間へ変換する関数
+        :return:
+        """
+        # エラーの場合はリスト以外が返る
+        if not isinstance(rows, list) or not rows:
+            return
+
+        lines = []
+        with self.lock:
+            for row in (rows[0], rows[-1]):
+                exec_id = int(row['id'])
+                if exec_id in self.page_dates:
+                    continue
+                exec_date = format_date(row['exec_date'])
+                self.page_dates[exec_id] = exec_date
+                lines.append('page,{},{}\n'.format(exec_id, exec_date.strftime(self.date_format)))
+                self.is_sorted = False
+
+            if lines:
+                with open(self.index_file, 'a') as f:
+                    f.writelines(lines)
+
+    def add_exact(self, base_date, exec_id):
+        # type: (dt, int) -> None
+        """
+        検索で見つかった日付とidの組を追加する
+        :param base_date: 検索した日付
+        :param exec_id: base_date以降で最初の約定のid
+        :return:
+        """
+        with self.lock:
+            if self.exact_ids.get(base_date) == exec_id:
+                return
+            self.exact_ids[base_date] = exec_id
+            with open(self.index_file, 'a') as f:
+                f.write('exact,{},{}\n'.format(exec_id, base_date.strftime(self.date_format)))
+
+    def get_exact(self, base_date):
+        # type: (dt) -> int
+        """
+        検索済みの日付であればidを返す
+        :param base_date: 検索する日付
+        :return: base_date以降で最初の約定のid. 検索済みでなければNone
+        """
+        return self.exact_ids.get(base_date)
+
+    def lookup(self, base_date):
+        # type: (dt) -> tuple
+        """
+        base_dateを挟む既知の約定を返す
+        :param base_date: 検索する日付
+        :return: (base_dateより前で最も新しい約定のid, 日付, base_date以降で最も古い約定のid, 日付).
+                 見つからない側はNone
+        """
+        with self.lock:
+            if not self.is_sorted:
+                self.sorted_ids = sorted(self.page_dates)
+                self.sorted_dates = [self.page_dates[x] for x in self.sorted_ids]
+                self.is_sorted = True
+
+            # 約定日時はidに対して単調増加なので日付で二分探索できる
+            i = bisect.bisect_left(self.sorted_dates, base_date)
+            lower = (self.sorted_ids[i - 1], self.sorted_dates[i - 1]) if i > 0 else (None, None)
+            upper = (self.sorted_ids[i], self.sorted_dates[i]) if i < len(self.sorted_ids) else (None, None)
+        return lower + upper
@@ -1,21 +1,169 @@
-from logging import getLogger, StreamHandler, FileHandler, Formatter, INFO
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
 
+"""
+This module provides the logger shared by all scripts.
+Handlers are set up only once per process, however many times Logger is constructed.
+The log file and its rotation of the first construction are kept; a later construction with different ones logs a warning.
+Records are put on a queue and written to the console and the log file by a background thread,
+so writing to disk never blocks the fetch or aggregate loops.
+The level, the log file and its rotation can be set by arguments or environment variables.
+"""
 
-class Logger():
+import os
+import time
+import queue
+import atexit
+import threading
+from logging import getLogger, StreamHandler, Formatter, INFO, ERROR
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
-    def __init__(self):
-        self.logger = getLogger("Logger")
-        self.logger.setLevel(INFO)
 
-        handler_format = Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+class Logger(object):
+    """
+    This class wraps the logger named Logger. self.logger is the logging.Logger.
+    """
 
+    name = 'Logger'
+    # 環境変数 -> 設定. 引数で指定しなかった場合に使う
+    env_names = {'level': 'BTC_LOG_LEVEL', 'log_file': 'BTC_LOG_FILE', 'max_bytes': 'BTC_LOG_MAX_BYTES',
+                 'backup_count': 'BTC_LOG_BACKUP_COUNT'}
+    handler_format = Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+
+    # プロセスで共有する. ハンドラは最初のインスタンスで一度だけ設定する
+    lock = threading.Lock()
+    listener = None  # type: QueueListener
+    # 設定したログファイル, ローテーションするサイズ, 世代数
+    config = None  # type: tuple
+    is_stopped = False
+    # キー -> [前回出力した時刻, 出力しなかった件数]
+    sample_state = {}
+
+    def __init__(self, level=None, log_file=None, max_bytes=None, backup_count=None):
+        # type: (str, str, int, int) -> None
+        """
+        Class initialization. ログファイルとローテーションはプロセスで最初の指定だけが有効で、
+        2回目以降に違う値を指定した場合は警告を出して無視する. ログレベルは毎回変えられる
+        :param level: ログレベル. 指定がなければ環境変数BTC_LOG_LEVEL, なければINFO
+        :param log_file: ログファイル. 指定がなければ環境変数BTC_LOG_FILE, なければ./log/log.log
+        :param max_bytes: このサイズを超えたらローテーションする. 0はローテーションしない(BTC_LOG_MAX_BYTES)
+        :param backup_count: ローテーションで残す世代数(BTC_LOG_BACKUP_COUNT)
+        """
+        self.logger = getLogger(self.name)
+
+        config = (log_file or os.environ.get(self.env_names['log_file'], './log/log.log'),
+                  int(max_bytes if max_bytes is not None else os.environ.get(self.env_names['max_bytes'], 0)),
+                  int(backup_count if backup_count is not None else os.environ.get(self.env_names['backup_count'], 5)))
+        with Logger.lock:
+            is_setup = Logger.config is None
+            if is_setup:
+                self.setup(*config)
+                Logger.config = config
+                self.logger.setLevel(level or os.environ.get(self.env_names['level'], INFO))
+            elif level is not None:
+                self.logger.setLevel(level)
+
+        # 指定した値が最初の設定と違っても設定し直さない
+        if not is_setup:
+            ignored = []
+            for name, argument, value, current in zip(['log_file', 'max_bytes', 'backup_count'],
+                                                      [log_file, max_bytes, backup_count], config, Logger.config):
+                if argument is not None and value != current:
+                    ignored.append('{}={} (using {})'.format(name, value, current))
+            if ignored:
+                self.logger.warning('Logger is already set up. ignored {}'.format(', '.join(ignored)))
+
+    def setup(self, log_file, max_bytes, backup_count):
+        # type: (str, int, int) -> None
+        """
+        コンソールとファイルのハンドラをキューの先で動かす
+        :param log_file: ログファイル
+        :param max_bytes: ローテーションするサイズ
+        :param backup_count: ローテーションで残す世代数
+        :return:
+        """
         stream_handler = StreamHandler()
-        stream_handler.setLevel(INFO)
-        stream_handler.setFormatter(handler_format)
+        stream_handler.setFormatter(self.handler_format)
+
+        file_handler = RotatingFileHandler(log_file, 'a', maxBytes=max_bytes, backupCount=backup_count)
+        file_handler.setFormatter(self.handler_format)
+
+        log_queue = queue.SimpleQueue()
+        self.logger.addHandler(QueueHandler(log_queue))
+        self.logger.propagate = False
+
+        Logger.listener = QueueListener(log_queue, stream_handler, file_handler)
+        Logger.listener.start()
+        # 終了時にキューに残ったログを書き出す
+        atexit.register(Logger.stop)
+
+    @classmethod
+    def stop(cls):
+        # type: () -> None
+        """
+        キューに残ったログを書き出してスレッドを止める
+        :return:
+        """
+        with cls.lock:
+            if cls.listener is not None and not cls.is_stopped:
+                cls.listener.stop()
+                cls.is_stopped = True
+
+    @classmethod
+    def after_fork(cls):
+        # type: () -> None
+        """
+        forkしたプロセスにはキューを読むスレッドが無いので、ハンドラへ直接書き込む
+        :return:
+        """
+        cls.lock = threading.Lock()
+        cls.sample_state = {}
+        if cls.listener is None:
+            return
+        logger = getLogger(cls.name)
+        for handler in list(logger.handlers):
+            if isinstance(handler, QueueHandler):
+                logger.removeHandler(handler)
+        for handler in cls.listener.handlers:
+            logger.addHandler(handler)
+        cls.listener = None
+
+    def log_every(self, level, key, interval, message, *args):
+        # type: (int, str, float, str, object) -> bool
+        """
+        ページやファイルごとのログを間引く. キーごとにinterval秒に一度だけ出力し、出力しなかった件数を付ける
+        :param level: ログレベル
+        :param key: 間引く単位
+        :param interval: 出力する間隔(秒)
+        :param message: メッセージ. 出力するときだけargsでformatする
+        :param args: メッセージの引数
+        :return: 出力したか
+        """
+        if not self.logger.isEnabledFor(level):
+            return False
+
+        now = time.monotonic()
+        with Logger.lock:
+            state = Logger.sample_state.setdefault(key, [None, 0])
+            if state[0] is not None and now - state[0] < interval:
+                state[1] += 1
+                return False
+            skipped = state[1]
+            state[0], state[1] = now, 0
+
+        message = message.format(*args)
+        if skipped:
+            message += ' ({} similar messages skipped)'.format(skipped)
+        self.logger.log(level, message)
+        return True
+
+    def info_every(self, key, interval, message, *args):
+        # type: (str, float, str, object) -> bool
+        return self.log_every(INFO, key, interval, message, *args)
+
+    def error_every(self, key, interval, message, *args):
+        # type: (str, float, str, object) -> bool
+        return self.log_every(ERROR, key, interval, message, *args)
 
-        file_handler = FileHandler('./log/log.log', 'a')
-        file_handler.setLevel(INFO)
-        file_handler.setFormatter(handler_format)
 
-        self.logger.addHandler(stream_handler)
-        self.logger.addHandler(file_handler)
+os.register_at_fork(after_in_child=Logger.after_fork)
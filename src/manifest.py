@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This module provides a manifest of raw files processed by generatehloc.
+The manifest keeps the id range, size and mtime of each raw file and the hloc partition it produced,
+so that only new or changed files are aggregated again.
+"""
+
+import os
+import json
+import pandas as pd
+
+
+class HlocManifest(object):
+    """
+    This class records raw files and their hloc partitions of a time axis.
+    """
+
+    def __init__(self, manifest_dir, time_axis):
+        # type: (str, str) -> None
+        """
+        Class initialization.
+        :param manifest_dir: マニフェストとパーティションを保存するディレクトリ
+        :param time_axis: 時間軸. 時間軸ごとにマニフェストを分ける
+        """
+        self.partition_dir = os.path.join(manifest_dir, time_axis)
+        if not os.path.exists(self.partition_dir):
+            os.makedirs(self.partition_dir)
+        self.manifest_file = os.path.join(manifest_dir, 'manifest_{}.json'.format(time_axis))
+        self.date_format = '%Y-%m-%d %H:%M:%S'
+
+        # 生ファイル名 -> {size, mtime, first_id, last_id, first_bar, last_bar, partition}
+        self.entries = {}
+        self.load()
+
+    def load(self):
+        # type: () -> None
+        """
+        保存されたマニフェストを読み込む
+        :return:
+        """
+        if not os.path.exists(self.manifest_file):
+            return
+
+        with open(self.manifest_file) as f:
+            self.entries = json.load(f)
+
+    def save(self):
+        # type: () -> None
+        """
+        マニフェストを保存する. 途中で止まっても壊れないように一時ファイルから置き換える
+        :return:
+        """
+        writing_file = self.manifest_file + '.writing'
+        with open(writing_file, 'w') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.replace(writing_file, self.manifest_file)
+
+    @staticmethod
+    def get_stat(input_path):
+        # type: (str) -> dict
+        """
+        生ファイルのサイズと更新日時
+        :param input_path: 生ファイルのパス
+        :return: {size, mtime}
+        """
+        stat = os.stat(input_path)
+        return {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+    def is_changed(self, file_name, input_path):
+        # type: (str, str) -> bool
+        """
+        前回の処理から追加, 変更された生ファイルか
+        :param file_name: data_dirからの相対パス
+        :param input_path: 生ファイルのパス
+        :return: 集計し直す必要があればTrue
+        """
+        entry = self.entries.get(file_name)
+        if entry is None or not os.path.exists(os.path.join(self.partition_dir, entry['partition'])):
+            return True
+        stat = self.get_stat(input_path)
+        return entry['size'] != stat['size'] or entry['mtime'] != stat['mtime']
+
+    def get_bar_span(self, file_name):
+        # type: (str) -> tuple
+        """
+        生ファイルから作った足の期間
+        :param file_name: data_dirからの相対パス
+        :return: (最初の足, 最後の足). 記録されていない, または足がなければ(None, None)
+        """
+        entry = self.entries.get(file_name)
+        if entry is None or entry['first_bar'] is None:
+            return None, None
+        return pd.Timestamp(entry['first_bar']), pd.Timestamp(entry['last_bar'])
+
+    def put(self, file_name, input_path, df_hloc, first_id, last_id):
+        # type: (str, str, df, int, int) -> None
+        """
+        生ファイルから作った足をパーティションとして保存し、マニフェストへ記録する
+        :param file_name: data_dirからの相対パス
+        :param input_path: 生ファイルのパス
+        :param df_hloc: 生ファイルから作った足
+        :param first_id: 生ファイルの最も古いid
+        :param last_id: 生ファイルの最も新しいid
+        :return:
+        """
+        partition = file_name.replace(os.sep, '_') + '.csv'
+        df_hloc.to_csv(os.path.join(self.partition_dir, partition))
+
+        entry = self.get_stat(input_path)
+        entry.update({'first_id': first_id, 'last_id': last_id, 'partition': partition,
+                      'first_bar': df_hloc.index[0].strftime(self.date_format) if len(df_hloc) > 0 else None,
+                      'last_bar': df_hloc.index[-1].strftime(self.date_format) if len(df_hloc) > 0 else None})
+        self.entries[file_name] = entry
+
+    def remove(self, file_name):
+        # type: (str) -> None
+        """
+        削除された生ファイルをマニフェストとパーティションから取り除く
+        :param file_name: data_dirからの相対パス
+        :return:
+        """
+        entry = self.entries.pop(file_name)
+        partition_path = os.path.join(self.partition_dir, entry['partition'])
+        if os.path.exists(partition_path):
+            os.remove(partition_path)
+
+    def load_partition(self, file_name):
+        # type: (str) -> df
+        """
+        生ファイルから作った足を読み込む
+        :param file_name: data_dirからの相対パス
+        :return: hlocのデータフレーム
+        """
+        df_hloc = pd.read_csv(os.path.join(self.partition_dir, self.entries[file_name]['partition']),
+                              index_col='datetime', parse_dates=True)
+        df_hloc.index = df_hloc.index.astype('datetime64[ns]')
+        return df_hloc
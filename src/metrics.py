@@ -0,0 +1,428 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This module provides counters, gauges, histograms and stage timers shared by getbtc and generatehloc.
+Metrics are exposed as prometheus text over http and/or written to a json snapshot file periodically.
+run can be wrapped with cProfile or tracemalloc.
+"""
+
+import os
+import json
+import time
+import bisect
+import cProfile
+import pstats
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class Metric(object):
+    """
+    This class is the base of metrics. Values are kept for each set of labels.
+    """
+
+    kind = None
+
+    def __init__(self, name, help_text, lock):
+        # type: (str, str, threading.Lock) -> None
+        """
+        Class initialization.
+        :param name: メトリクス名
+        :param help_text: 説明
+        :param lock: レジストリで共有するロック
+        """
+        self.name = name
+        self.help_text = help_text
+        self.lock = lock
+        # ラベルの組 -> 値
+        self.values = {}
+
+    @staticmethod
+    def to_key(labels):
+        # type: (dict) -> tuple
+        """
+        ラベルを辞書のキーにする
+        :param labels: ラベル
+        :return: (名前, 値)のタプル
+        """
+        return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    @staticmethod
+    def format_labels(key, extra=()):
+        # type: (tuple, tuple) -> str
+        """
+        ラベルをprometheusの形式にする
+        :param key: ラベルのキー
+        :param extra: 追加するラベル
+        :return: {name="value",...}. ラベルが無ければ空文字
+        """
+        labels = list(key) + list(extra)
+        if not labels:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(k, v.replace('"', '\\"')) for k, v in labels) + '}'
+
+
+class Counter(Metric):
+    """
+    This class counts events.
+    """
+
+    kind = 'counter'
+
+    def inc(self, value=1.0, **labels):
+        # type: (float, **str) -> None
+        """
+        値を増やす
+        :param value: 増やす値
+        :param labels: ラベル
+        :return:
+        """
+        key = self.to_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + value
+
+    def to_prometheus(self):
+        # type: () -> list
+        return ['{}{} {}'.format(self.name, self.format_labels(k), v) for k, v in sorted(self.values.items())]
+
+    def snapshot(self):
+        # type: () -> list
+        return [{'labels': dict(k), 'value': v} for k, v in sorted(self.values.items())]
+
+
+class Gauge(Counter):
+    """
+    This class keeps the latest value.
+    """
+
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        # type: (float, **str) -> None
+        """
+        値を設定する
+        :param value: 値
+        :param labels: ラベル
+        :return:
+        """
+        key = self.to_key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    """
+    This class counts observations in buckets.
+    """
+
+    kind = 'histogram'
+    # 秒を測る場合のバケットの上限
+    default_buckets = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+
+    def __init__(self, name, help_text, lock, buckets=None):
+        # type: (str, str, threading.Lock, list) -> None
+        """
+        Class initialization.
+        :param name: メトリクス名
+        :param help_text: 説明
+        :param lock: レジストリで共有するロック
+        :param buckets: バケットの上限のリスト. 昇順
+        """
+        super(Histogram, self).__init__(name, help_text, lock)
+        self.buckets = buckets or self.default_buckets
+
+    def observe(self, value, **labels):
+        # type: (float, **str) -> None
+        """
+        値を記録する
+        :param value: 値
+        :param labels: ラベル
+        :return:
+        """
+        key = self.to_key(labels)
+        with self.lock:
+            if key not in self.values:
+                # バケットごとの数(最後は上限なし), 合計, 件数
+                self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            value_list = self.values[key]
+            value_list[0][bisect.bisect_left(self.buckets, value)] += 1
+            value_list[1] += value
+            value_list[2] += 1
+
+    def get_quantile(self, key, quantile):
+        # type: (tuple, float) -> float
+        """
+        バケットから分位点を求める. バケットの上限を返すので近似値
+        :param key: ラベルのキー
+        :param quantile: 0から1
+        :return: 分位点. 上限なしのバケットに入る場合はinf
+        """
+        counts, _, count = self.values[key]
+        cumulative = 0
+        for upper, bucket_count in zip(self.buckets + [float('inf')], counts):
+            cumulative += bucket_count
+            if cumulative >= quantile * count:
+                return upper
+        return float('inf')
+
+    def to_prometheus(self):
+        # type: () -> list
+        lines = []
+        for key, (counts, total, count) in sorted(self.values.items()):
+            cumulative = 0
+            for upper, bucket_count in zip(self.buckets + [float('inf')], counts):
+                cumulative += bucket_count
+                le = '+Inf' if upper == float('inf') else repr(upper)
+                lines.append('{}_bucket{} {}'.format(self.name, self.format_labels(key, (('le', le), )), cumulative))
+            lines.append('{}_sum{} {}'.format(self.name, self.format_labels(key), total))
+            lines.append('{}_count{} {}'.format(self.name, self.format_labels(key), count))
+        return lines
+
+    def snapshot(self):
+        # type: () -> list
+        return [{'labels': dict(key), 'count': count, 'sum': total,
+                 'p50': self.get_quantile(key, 0.5), 'p90': self.get_quantile(key, 0.9),
+                 'p99': self.get_quantile(key, 0.99)}
+                for key, (counts, total, count) in sorted(self.values.items())]
+
+
+class MetricsRegistry(object):
+    """
+    This class keeps all metrics of the process.
+    """
+
+    def __init__(self):
+        # type: () -> None
+        """
+        Class initialization.
+        """
+        self.metrics = {}
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+
+    def get_metric(self, metric_class, name, help_text, **kwargs):
+        # type: (type, str, str, **object) -> Metric
+        """
+        メトリクスを返す. 無ければ作る
+        :param metric_class: Counter, Gauge or Histogram
+        :param name: メトリクス名
+        :param help_text: 説明
+        :return: メトリクス
+        """
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = metric_class(name, help_text, self.lock, **kwargs)
+            return self.metrics[name]
+
+    def counter(self, name, help_text=''):
+        # type: (str, str) -> Counter
+        return self.get_metric(Counter, name, help_text)
+
+    def gauge(self, name, help_text=''):
+        # type: (str, str) -> Gauge
+        return self.get_metric(Gauge, name, help_text)
+
+    def histogram(self, name, help_text='', buckets=None):
+        # type: (str, str, list) -> Histogram
+        return self.get_metric(Histogram, name, help_text, buckets=buckets)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        # type: (str, **str) -> None
+        """
+        with文の中の処理にかかった秒数をヒストグラムへ記録する
+        :param name: ヒストグラムのメトリクス名
+        :param labels: ラベル. ステージ名等
+        :return:
+        """
+        histogram = self.histogram(name, 'seconds spent in the stage')
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            histogram.observe(time.perf_counter() - start_time, **labels)
+
+    def to_prometheus(self):
+        # type: () -> str
+        """
+        prometheusのテキスト形式にする
+        :return: テキスト
+        """
+        lines = []
+        with self.lock:
+            for name, metric in sorted(self.metrics.items()):
+                if metric.help_text:
+                    lines.append('# HELP {} {}'.format(name, metric.help_text))
+                lines.append('# TYPE {} {}'.format(name, metric.kind))
+                lines += metric.to_prometheus()
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        # type: () -> dict
+        """
+        JSONで保存するスナップショット
+        :return: 辞書
+        """
+        with self.lock:
+            return {'time': time.time(), 'uptime_seconds': time.time() - self.start_time,
+                    'metrics': {name: {'type': metric.kind, 'values': metric.snapshot()}
+                                for name, metric in sorted(self.metrics.items())}}
+
+
+# プロセスで共有するレジストリ
+REGISTRY = MetricsRegistry()
+
+
+class MetricsExporter(object):
+    """
+    This class serves prometheus text over http and writes json snapshots periodically.
+    """
+
+    def __init__(self, root_logger, registry=REGISTRY, snapshot_file=None, interval=10.0, port=None):
+        # type: (logger, MetricsRegistry, str, float, int) -> None
+        """
+        Class initialization.
+        :param root_logger: ロガー
+        :param registry: メトリクスのレジストリ
+        :param snapshot_file: JSONのスナップショットを書き出すファイル. Noneの場合は書き出さない
+        :param interval: スナップショットを書き出す間隔(秒)
+        :param port: /metricsを返すポート. Noneの場合はサーバを起動しない
+        """
+        self.logger = root_logger
+        self.registry = registry
+        self.snapshot_file = snapshot_file
+        self.interval = interval
+        self.port = port
+        self.httpd = None
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        # type: () -> MetricsExporter
+        """
+        サーバとスナップショットの書き出しを開始する
+        :return: self
+        """
+        if self.port is not None:
+            registry = self.registry
+
+            class MetricsHandler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    body = registry.to_prometheus().encode('utf-8')
+                    self.send_response(200 if self.path.startswith('/metrics') else 404)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, *args):
+                    pass
+
+            self.httpd = ThreadingHTTPServer(('', self.port), MetricsHandler)
+            self.httpd.daemon_threads = True
+            threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+            self.logger.logger.info('serve metrics on http://localhost:{}/metrics'.format(self.port))
+
+        if self.snapshot_file is not None:
+            self.thread = threading.Thread(target=self.write_periodically, daemon=True)
+            self.thread.start()
+        return self
+
+    def write_periodically(self):
+        # type: () -> None
+        """
+        interval秒ごとにスナップショットを書き出す
+        :return:
+        """
+        while not self.stop_event.wait(self.interval):
+            self.write_snapshot()
+
+    def write_snapshot(self):
+        # type: () -> None
+        """
+        スナップショットを書き出す. 途中の内容を読まれないように一時ファイルから置き換える
+        :return:
+        """
+        writing_file = self.snapshot_file + '.writing'
+        with open(writing_file, 'w') as f:
+            json.dump(self.registry.snapshot(), f, indent=1)
+        os.replace(writing_file, self.snapshot_file)
+
+    def stop(self):
+        # type: () -> None
+        """
+        最後のスナップショットを書き出して止める
+        :return:
+        """
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.write_snapshot()
+            self.logger.logger.info(' save on {}'.format(self.snapshot_file))
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+
+
+def run_with_profile(function, root_logger, mode=None, output=None, limit=20):
+    # type: (function, logger, str, str, int) -> object
+    """
+    cProfileまたはtracemallocで関数を実行する
+    :param function: 実行する関数. runメソッド等
+    :param root_logger: ロガー
+    :param mode: cprofile, tracemalloc or None(そのまま実行する)
+    :param output: 結果を保存するファイル. cprofileはpstatsの形式, tracemallocはテキスト
+    :param limit: ログへ出力する行数
+    :return: 関数の戻り値
+    """
+    if mode is None:
+        return function()
+
+    if mode == 'cprofile':
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(function)
+        finally:
+            stats = pstats.Stats(profiler).sort_stats('cumulative')
+            if output:
+                stats.dump_stats(output)
+                root_logger.logger.info(' save on {}'.format(output))
+            for line in get_profile_lines(stats, limit):
+                root_logger.logger.info(line)
+
+    if mode == 'tracemalloc':
+        tracemalloc.start(25)
+        try:
+            return function()
+        finally:
+            current, peak = tracemalloc.get_traced_memory()
+            lines = ['traced memory: current {:.1f} MB, peak {:.1f} MB'.format(current / 2.0 ** 20, peak / 2.0 ** 20)]
+            lines += [str(x) for x in tracemalloc.take_snapshot().statistics('lineno')[:limit]]
+            tracemalloc.stop()
+            if output:
+                with open(output, 'w') as f:
+                    f.write('\n'.join(lines) + '\n')
+                root_logger.logger.info(' save on {}'.format(output))
+            for line in lines:
+                root_logger.logger.info(line)
+
+    raise ValueError('Unexpected profile mode is specified: {}'.format(mode))
+
+
+def get_profile_lines(stats, limit):
+    # type: (pstats.Stats, int) -> list
+    """
+    cProfileの結果の上位を行のリストにする
+    :param stats: pstats.Stats
+    :param limit: 行数
+    :return: 行のリスト
+    """
+    lines = []
+    for (file_name, line_number, function_name), (_, calls, total, cumulative, _) in sorted(
+            stats.stats.items(), key=lambda x: x[1][3], reverse=True)[:limit]:
+        lines.append('{:>10.3f} cum {:>10.3f} tot {:>9} calls {}:{}({})'.format(
+            cumulative, total, calls, os.path.basename(file_name), line_number, function_name))
+    return lines
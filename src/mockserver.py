@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This module provides a local stand-in of the bitflyer http api for offline tests and benchmarks.
+/v1/getexecutions and /v1/gethealth are served from a deterministic synthetic history
+with injectable latency, errors and throttling.
+Each product returns only its own ids, which are interleaved with the other products' ids like bitflyer.
+"""
+
+import json
+import time
+import random
+import argparse
+import threading
+import logger
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from synthetic import SyntheticExecutions
+
+
+class MockBitflyerServer(object):
+    """
+    This class serves the synthetic history over http.
+    """
+
+    # APIのcountの上限
+    max_count = 500
+    # リクエストを受けるハンドラ. サブクラスで差し替える
+    handler_class = None
+
+    def __init__(self, executions, host='127.0.0.1', port=0, latency=0.0, error_rate=0.0, empty_rate=0.0,
+                 requests_per_window=0, window_seconds=1.0, seed=0):
+        # type: (SyntheticExecutions, str, int, float, float, float, int, float, int) -> None
+        """
+        Class initialization.
+        :param executions: 返す約定の履歴
+        :param host: ホスト
+        :param port: ポート. 0の場合は空いているポート
+        :param latency: レスポンスまでの平均の遅延(秒). 0から2倍の間でばらつく
+        :param error_rate: 500エラーを返す割合
+        :param empty_rate: 空のボディを返す割合
+        :param requests_per_window: window_secondsあたりに許可するリクエスト数. 超えると429を返す. 0の場合は制限しない
+        :param window_seconds: 制限の期間(秒)
+        :param seed: エラーを返すかを決める乱数のシード
+        """
+        self.executions = executions
+        self.latency = latency
+        self.error_rate = error_rate
+        self.empty_rate = empty_rate
+        self.requests_per_window = requests_per_window
+        self.window_seconds = window_seconds
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+        # 制限の期間ごとのリクエスト数
+        self.window_start = time.time()
+        self.window_count = 0
+        # ステータスごとのリクエスト数
+        self.request_count = 0
+        self.status_count = {}
+
+        handler_class = self.handler_class or MockBitflyerHandler
+        handler = type(handler_class.__name__, (handler_class, ), {'mock': self})
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        # type: () -> str
+        """
+        サーバのURL. getbtcのdomain_urlに指定する
+        :return: URL
+        """
+        host, port = self.httpd.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self):
+        # type: () -> MockBitflyerServer
+        """
+        別スレッドでサーバを起動する
+        :return: self
+        """
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        # type: () -> None
+        """
+        サーバを止める
+        :return:
+        """
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def reset_count(self):
+        # type: () -> None
+        """
+        リクエスト数の集計を初期化する
+        :return:
+        """
+        with self.lock:
+            self.request_count = 0
+            self.status_count = {}
+
+    def handle(self, path, query):
+        # type: (str, dict) -> tuple
+        """
+        リクエストに対するレスポンスを作る
+        :param path: パス
+        :param query: クエリパラメータ
+        :return: (ステータスコード, ヘッダの辞書, ボディのバイト列)
+        """
+        with self.lock:
+            self.request_count += 1
+            now = time.time()
+            if now - self.window_start >= self.window_seconds:
+                self.window_start = now
+                self.window_count = 0
+            self.window_count += 1
+            headers = {}
+            if self.requests_per_window > 0:
+                reset_time = self.window_start + self.window_seconds
+                headers = {'X-RateLimit-Remaining': str(max(self.requests_per_window - self.window_count, 0)),
+                           'X-RateLimit-Reset': '{:.3f}'.format(reset_time)}
+                if self.window_count > self.requests_per_window:
+                    headers['Retry-After'] = '{:.3f}'.format(reset_time - now)
+                    return 429, headers, self.to_body({'status': -1, 'error_message': 'Over API limit per period'})
+            draw = self.random.random()
+
+        if self.latency > 0:
+            time.sleep(self.random.uniform(0, self.latency * 2))
+
+        if path == '/v1/gethealth':
+            return 200, headers, self.to_body({'status': 'BUSY' if self.error_rate > 0 else 'NORMAL'})
+        if path != '/v1/getexecutions':
+            return 404, headers, self.to_body({'status': -1, 'error_message': 'Not found'})
+
+        if draw < self.error_rate:
+            return 500, headers, self.to_body({'status': -500, 'error_message': 'Internal server error'})
+        if draw < self.error_rate + self.empty_rate:
+            return 200, headers, b''
+
+        try:
+            product_code = query.get('product_code', ['BTC_JPY'])[0]
+            before = int(query.get('before', ['0'])[0])
+            after = int(query.get('after', ['0'])[0])
+            count = min(int(query.get('count', ['100'])[0]), self.max_count)
+        except ValueError:
+            return 400, headers, self.to_body({'status': -100, 'error_message': 'Invalid parameter'})
+        if product_code not in self.executions.product_list or count <= 0:
+            return 400, headers, self.to_body({'status': -100, 'error_message': 'Invalid parameter'})
+
+        return 200, headers, self.to_body(self.executions.get_page(before, after, count, product_code))
+
+    @staticmethod
+    def to_body(data):
+        # type: (object) -> bytes
+        """
+        JSONのボディにする
+        :param data: データ
+        :return: バイト列
+        """
+        return json.dumps(data).encode('utf-8')
+
+
+class MockBitflyerHandler(BaseHTTPRequestHandler):
+    """
+    This class passes http requests to MockBitflyerServer.
+    """
+
+    mock = None
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        # type: () -> None
+        url = urlsplit(self.path)
+        status_code, headers, body = self.mock.handle(url.path, parse_qs(url.query))
+        with self.mock.lock:
+            self.mock.status_count[status_code] = self.mock.status_count.get(status_code, 0) + 1
+
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        # アクセスログは出さない
+        pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--port', help='port number', action='store', type=int, default=8080)
+    parser.add_argument('-n', '--executions', help='number of synthetic executions', action='store', type=int,
+                        default=2000000)
+    parser.add_argument('--seed', help='random seed of the history', action='store', type=int, default=0)
+    parser.add_argument('--products', help='products sharing the ids (comma separated)', action='store', type=str,
+                        default='FX_BTC_JPY,BTC_JPY,ETH_JPY')
+    parser.add_argument('--latency', help='mean latency in seconds', action='store', type=float, default=0.0)
+    parser.add_argument('--error-rate', help='rate of 500 responses', action='store', type=float, default=0.0)
+    parser.add_argument('--empty-rate', help='rate of empty bodies', action='store', type=float, default=0.0)
+    parser.add_argument('--limit', help='requests per window before 429. 0 is unlimited', action='store', type=int,
+                        default=0)
+    parser.add_argument('--window', help='window of the limit in seconds', action='store', type=float, default=1.0)
+
+    args = parser.parse_args()
+    logger = logger.Logger()
+
+    executions = SyntheticExecutions(args.executions, args.seed, product_list=args.products.split(','))
+    server = MockBitflyerServer(executions, port=args.port,
+                                latency=args.latency, error_rate=args.error_rate, empty_rate=args.empty_rate,
+                                requests_per_window=args.limit, window_seconds=args.window)
+    logger.logger.info('serving {} executions on {}'.format(args.executions, server.url))
+    server.httpd.serve_forever()
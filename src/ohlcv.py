@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This module provides single pass aggregation of btc executions into HLOC and volume.
+Bars are bucketed by time, or by activity (every N trades, V BTC or Y JPY) with VWAP.
+"""
+
+import re
+import numpy as np
+import pandas as pd
+
+
+class OhlcvAggregator(object):
+    """
+    This class aggregates typed execution arrays into bars of any width.
+    Columns follow generatehloc: min(low), max(high), first(open), last(close), size(volume) and count(trades).
+    """
+
+    columns = ['min', 'max', 'first', 'last', 'size', 'count']
+    # 足の幅の単位(ナノ秒)
+    unit_ns = {'s': 10 ** 9, 'm': 60 * 10 ** 9, 'h': 60 * 60 * 10 ** 9, 'd': 24 * 60 * 60 * 10 ** 9,
+               'w': 7 * 24 * 60 * 60 * 10 ** 9}
+    # 週足は月曜日から始める(1970-01-01は木曜日)
+    week_offset_ns = 4 * 24 * 60 * 60 * 10 ** 9
+    # 同じ足をまとめる際の集計方法. 始値は古い方, 終値は新しい方を使う
+    merge_rule = {'min': 'min', 'max': 'max', 'first': 'first', 'last': 'last', 'size': 'sum', 'count': 'sum'}
+    # 出来高の小数の桁数(数量の最小単位は1e-8 BTC). 足し合わせる順番で変わる誤差を丸め、
+    # ファイルごとの足をまとめた場合も全ての約定から一度に求めた場合と同じ値にする
+    size_decimals = 8
+    # 前のデータの続きとして順に集計する必要があるか. 時間の足はファイルごとに独立して集計できる
+    is_sequential = False
+    # 出力するcsvの日時の形式. Noneはpandasの既定
+    date_format = None
+
+    def __init__(self, width_ns, offset_ns=0):
+        # type: (int, int) -> None
+        """
+        Class initialization.
+        :param width_ns: 足の幅(ナノ秒)
+        :param offset_ns: 足の区切りをずらす幅(ナノ秒)
+        """
+        self.width_ns = width_ns
+        self.offset_ns = offset_ns
+
+    @classmethod
+    def from_spec(cls, spec):
+        # type: (str) -> OhlcvAggregator
+        """
+        15m, 4h, 1wのような足の指定から作る
+        :param spec: 数字と単位(s, m, h, d, w)
+        :return: OhlcvAggregator
+        """
+        match = re.match(r'^([1-9][0-9]*)([smhdw])$', spec)
+        if match is None:
+            raise ValueError('Unexpected bar spec is specified: {}'.format(spec))
+
+        number, unit = int(match.group(1)), match.group(2)
+        return cls(number * cls.unit_ns[unit], cls.week_offset_ns if unit == 'w' else 0)
+
+    def aggregate(self, exec_id, date_ns, price, size):
+        # type: (ndarray, ndarray, ndarray, ndarray) -> df
+        """
+        約定を足ごとにまとめ、高値, 安値, 始値, 終値, 出来高, 約定数を一度に求める.
+        APIのデータはidの降順なので、idの昇順に並べてから足の境界を探す
+        :param exec_id: int64のid
+        :param date_ns: 日本時間のエポックナノ秒
+        :param price: 価格
+        :param size: 数量
+        :return: datetimeをインデックスとしたhlocのデータフレーム
+        """
+        exec_id = np.asarray(exec_id)
+        if len(exec_id) == 0:
+            return self.empty()
+
+        order = self.get_order(exec_id)
+        exec_id = exec_id[order]
+        price = np.asarray(price)[order]
+        size = np.asarray(size)[order]
+
+        bucket = self.get_bucket(np.asarray(date_ns, dtype=np.int64)[order])
+
+        # 約定日時がidの順に並んでいない場合は足, idの順に並べる
+        if np.any(bucket[1:] < bucket[:-1]):
+            order = np.lexsort((exec_id, bucket))
+            bucket, price, size = bucket[order], price[order], size[order]
+
+        return self.build(bucket, price, price, price, price, size)
+
+    @staticmethod
+    def get_order(exec_id):
+        # type: (ndarray) -> object
+        """
+        idの昇順に並べる順番. 降順で並んでいれば反転するだけで済む
+        :param exec_id: int64のid
+        :return: スライスまたはインデックスの配列
+        """
+        if exec_id[0] >= exec_id[-1] and np.all(exec_id[1:] <= exec_id[:-1]):
+            return slice(None, None, -1)
+        elif np.all(exec_id[1:] >= exec_id[:-1]):
+            return slice(None)
+        return np.argsort(exec_id, kind='stable')
+
+    def rollup(self, df_hloc):
+        # type: (df) -> df
+        """
+        短い足をこの足の幅にまとめる. 足の幅と区切りは元の足の倍数であること
+        :param df_hloc: 時系列順のhlocのデータフレーム
+        :return: まとめたhlocのデータフレーム
+        """
+        if len(df_hloc) == 0:
+            return self.empty()
+
+        bucket = self.get_bucket(df_hloc.index.values.astype('datetime64[ns]').view(np.int64))
+        return self.build(bucket, df_hloc['min'].values, df_hloc['max'].values, df_hloc['first'].values,
+                          df_hloc['last'].values, df_hloc['size'].values, df_hloc['count'].values)
+
+    def build(self, bucket, low, high, first, last, size, count=None):
+        # type: (ndarray, ndarray, ndarray, ndarray, ndarray, ndarray, ndarray) -> df
+        """
+        足の境界で区切り、区間ごとに安値, 高値, 始値, 終値, 出来高, 約定数をまとめる
+        :param bucket: 足の開始日時のエポックナノ秒. 昇順
+        :param low: 安値
+        :param high: 高値
+        :param first: 始値
+        :param last: 終値
+        :param size: 出来高
+        :param count: 約定数. 指定がなければ1行を1約定とする
+        :return: hlocのデータフレーム
+        """
+        starts = np.flatnonzero(np.r_[True, bucket[1:] != bucket[:-1]])
+        ends = np.r_[starts[1:], len(bucket)]
+
+        df_hloc = pd.DataFrame({'min': np.minimum.reduceat(low, starts),
+                                'max': np.maximum.reduceat(high, starts),
+                                'first': first[starts],
+                                'last': last[ends - 1],
+                                'size': np.round(np.add.reduceat(size, starts), self.size_decimals),
+                                'count': ends - starts if count is None else np.add.reduceat(count, starts)},
+                               index=pd.DatetimeIndex(bucket[starts].view('datetime64[ns]'), name='datetime'),
+                               columns=self.columns)
+        return df_hloc
+
+    def merge(self, df_hloc_list):
+        # type: (list) -> df
+        """
+        時系列順に並んだ複数のhlocをまとめる. 境界で同じ足があれば一つの足にまとめる
+        :param df_hloc_list: hlocのデータフレームのリスト. 古い順
+        :return: まとめたhlocのデータフレーム
+        """
+        df_hloc_list = [x for x in df_hloc_list if len(x) > 0]
+        if not df_hloc_list:
+            return self.empty()
+
+        df_hloc = pd.concat(df_hloc_list)
+        if df_hloc.index.is_unique and df_hloc.index.is_monotonic_increasing:
+            return df_hloc
+        df_hloc = df_hloc.groupby(level=0, sort=True).agg(self.merge_rule)[self.columns]
+        df_hloc['size'] = df_hloc['size'].round(self.size_decimals)
+        return df_hloc
+
+    def get_bucket(self, date_ns):
+        # type: (ndarray) -> ndarray
+        """
+        約定日時を足の開始日時へ切り捨てる
+        :param date_ns: 日本時間のエポックナノ秒
+        :return: 足の開始日時のエポックナノ秒
+        """
+        shifted = date_ns - self.offset_ns
+        return shifted - shifted % self.width_ns + self.offset_ns
+
+    def empty(self):
+        # type: () -> df
+        """
+        空のhlocのデータフレームを返す
+        :return: 空のデータフレーム
+        """
+        return pd.DataFrame(columns=self.columns,
+                            index=pd.DatetimeIndex(np.zeros(0, dtype='datetime64[ns]'), name='datetime'))
+
+
+class ActivityAggregator(object):
+    """
+    This class aggregates executions into tick, volume or dollar bars.
+    A bar is closed when the cumulative number of trades, size or notional from the first execution
+    reaches the next multiple of the threshold, so the boundaries are found with a cumulative sum in one pass.
+    Executions must be given in id order across calls because the cumulative sum is carried over.
+    """
+
+    columns = OhlcvAggregator.columns + ['notional', 'vwap', 'bar']
+    # 足の種類 -> 重みの単位. 累積和を整数で求め、ファイルの区切り方で境界が変わらないようにする
+    # tick: 1約定, volume: 1e-8 BTC(最小の数量), dollar: 0.01円
+    unit_scale = {'tick': 1, 'volume': 10 ** 8, 'dollar': 10 ** 2}
+    spec_pattern = re.compile(r'^([0-9]+(?:\.[0-9]+)?)_(tick|volume|dollar)$')
+    merge_rule = dict(OhlcvAggregator.merge_rule, notional='sum', datetime='first')
+    is_sequential = True
+    # 足は約定の日時から始まるので、どの出力ファイルもマイクロ秒まで同じ形式で書く
+    date_format = '%Y-%m-%d %H:%M:%S.%f'
+
+    def __init__(self, kind, threshold):
+        # type: (str, float) -> None
+        """
+        Class initialization.
+        :param kind: tick(約定数), volume(出来高), dollar(売買代金)
+        :param threshold: 足を区切る約定数, BTC または 円
+        """
+        self.kind = kind
+        self.threshold = threshold
+        self.threshold_units = int(round(threshold * self.unit_scale[kind]))
+        if self.threshold_units <= 0:
+            raise ValueError('Too small threshold is specified: {}'.format(threshold))
+        # これまでに集計した重みの合計
+        self.total = 0
+
+    @classmethod
+    def from_spec(cls, spec):
+        # type: (str) -> ActivityAggregator
+        """
+        1000_tick, 50_volume, 100000000_dollarのような足の指定から作る
+        :param spec: 数字と種類(tick, volume, dollar)
+        :return: ActivityAggregator
+        """
+        match = cls.spec_pattern.match(spec)
+        if match is None:
+            raise ValueError('Unexpected bar spec is specified: {}'.format(spec))
+        return cls(match.group(2), float(match.group(1)))
+
+    def get_weight(self, price, size):
+        # type: (ndarray, ndarray) -> ndarray
+        """
+        約定ごとの重み
+        :param price: 価格
+        :param size: 数量
+        :return: int64の重み
+        """
+        if self.kind == 'tick':
+            return np.ones(len(size), dtype=np.int64)
+        elif self.kind == 'volume':
+            return np.rint(size * self.unit_scale['volume']).astype(np.int64)
+        return np.rint(price * size * self.unit_scale['dollar']).astype(np.int64)
+
+    def aggregate(self, exec_id, date_ns, price, size):
+        # type: (ndarray, ndarray, ndarray, ndarray) -> df
+        """
+        約定を前回の続きから足ごとにまとめ、高値, 安値, 始値, 終値, 出来高, 約定数, 売買代金, VWAPを一度に求める.
+        最後の足は次の約定に続く場合があるのでmergeでまとめる
+        :param exec_id: int64のid
+        :param date_ns: 日本時間のエポックナノ秒
+        :param price: 価格
+        :param size: 数量
+        :return: 足の最初の約定の日時をインデックスとしたhlocのデータフレーム
+        """
+        exec_id = np.asarray(exec_id)
+        if len(exec_id) == 0:
+            return self.empty()
+
+        order = OhlcvAggregator.get_order(exec_id)
+        date_ns = np.asarray(date_ns, dtype=np.int64)[order]
+        price = np.asarray(price, dtype=np.float64)[order]
+        size = np.asarray(size, dtype=np.float64)[order]
+
+        # 約定の前までの累積の重みを閾値で割った商が足の番号になる
+        weight = self.get_weight(price, size)
+        cumulative = np.cumsum(weight)
+        bar = (cumulative - weight + self.total) // self.threshold_units
+        self.total += int(cumulative[-1])
+
+        starts = np.flatnonzero(np.r_[True, bar[1:] != bar[:-1]])
+        ends = np.r_[starts[1:], len(bar)]
+        notional = np.add.reduceat(price * size, starts)
+        volume = np.add.reduceat(size, starts)
+
+        df_hloc = pd.DataFrame({'min': np.minimum.reduceat(price, starts),
+                                'max': np.maximum.reduceat(price, starts),
+                                'first': price[starts],
+                                'last': price[ends - 1],
+                                'size': volume,
+                                'count': ends - starts,
+                                'notional': notional,
+                                'vwap': notional / volume,
+                                'bar': bar[starts]},
+                               index=pd.DatetimeIndex(date_ns[starts].view('datetime64[ns]'), name='datetime'),
+                               columns=self.columns)
+        return df_hloc
+
+    def merge(self, df_hloc_list):
+        # type: (list) -> df
+        """
+        順に並んだ複数のhlocをまとめる. 境界で同じ番号の足があれば一つの足にまとめる
+        :param df_hloc_list: hlocのデータフレームのリスト. 古い順
+        :return: まとめたhlocのデータフレーム
+        """
+        df_hloc_list = [x for x in df_hloc_list if len(x) > 0]
+        if not df_hloc_list:
+            return self.empty()
+
+        df_hloc = pd.concat(df_hloc_list)
+        if df_hloc['bar'].is_unique and df_hloc['bar'].is_monotonic_increasing:
+            return df_hloc
+
+        df_hloc = df_hloc.reset_index().groupby('bar', sort=True).agg(self.merge_rule)
+        df_hloc['vwap'] = df_hloc['notional'] / df_hloc['size']
+        return df_hloc.reset_index().set_index('datetime')[self.columns]
+
+    def empty(self):
+        # type: () -> df
+        """
+        空のhlocのデータフレームを返す
+        :return: 空のデータフレーム
+        """
+        return pd.DataFrame(columns=self.columns,
+                            index=pd.DatetimeIndex(np.zeros(0, dtype='datetime64[ns]'), name='datetime'))
@@ -3,14 +3,23 @@
 
 """
 This module plots hloc data.
+Candles are re-aggregated to the pixel width of the figure before drawing, so long histories draw as fast
+as short ones. Charts are shown on screen or saved as png/svg without a display.
 """
 
 import os
+import time
 import argparse
+import datetime
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-from matplotlib.finance import candlestick2_ohlc, volume_overlay
+from datetime import datetime as dt
+import matplotlib
+from matplotlib.ticker import FuncFormatter
 import logger
+import metrics
+import query
+from ohlcv import OhlcvAggregator
 
 
 class PlotChart(object):
@@ -18,14 +27,44 @@ class PlotChart(object):
     This class plot the hloc btc data.
     """
 
-    def __init__(self, root_logger, input_file):
-        # type: (logger, str) -> None
+    # 保存できる画像の形式
+    image_format_list = ['png', 'svg']
+    # 時間軸ごとの足の指定. 15m, 4h, 1wのように数字と単位でも指定できる
+    time_axis_spec = {'one_minute': '1m', '5_minute': '5m', 'one_hour': '1h', 'one_day': '1d'}
+
+    def __init__(self, root_logger, input_file=None, time_axis=None, start_date=None, end_date=None, output=None,
+                 hloc_dir='./hloc', width=1800, height=900, dpi=100, candle_pixels=3):
+        # type: (logger, str, str, dt, dt, str, str, int, int, int, int) -> None
         """
         Class initialization
+        :param root_logger: ロガー
+        :param input_file: hlocファイルのパス. 指定がなければhloc_dirからtime_axisの足を読み込む
+        :param time_axis: 時間軸. generatehlocの-tと同じ名前
+        :param start_date: 描画する期間の始まり(含む). 指定がなければ最初の足から
+        :param end_date: 描画する期間の終わり(含まない). 指定がなければ最後の足まで
+        :param output: 保存する画像のパス(.png or .svg). 指定がなければ画面に表示する
+        :param hloc_dir: hlocデータのディレクトリ
+        :param width: 画像の幅(ピクセル)
+        :param height: 画像の高さ(ピクセル)
+        :param dpi: 解像度
+        :param candle_pixels: ローソク足1本あたりの最小の幅(ピクセル). 足の数がこれを超える場合はまとめる
         """
 
         self.logger = root_logger
         self.input_file = input_file
+        self.time_axis = time_axis
+        self.start_date = start_date
+        self.end_date = end_date
+        self.output = output
+        self.hloc_dir = hloc_dir
+        self.width = width
+        self.height = height
+        self.dpi = dpi
+        self.candle_pixels = candle_pixels
+        # 実際に読み込んだ時間軸. 期間が長い場合はtime_axisより長い足を読む
+        self.plot_axis = time_axis
+        # 図の幅のうちローソク足を描く領域の割合
+        self.axes_rect = [0.07, 0.2, 0.86, 0.75]
 
     def run(self):
         # type: () -> None
@@ -35,22 +74,66 @@ class PlotChart(object):
         """
 
         # ファイル存在チェック
-        if not os.path.exists(self.input_file):
+        if self.input_file is not None and not os.path.exists(self.input_file):
             self.logger.logger.error('Does not exist input file: {}'.format(self.input_file))
             exit(1)
 
+        start_time = time.perf_counter()
+
         # hlocデータをロード
-        df_btc = self.load_btc_data()
+        with metrics.REGISTRY.timer('plot_stage_seconds', stage='load'):
+            df_btc = self.load_btc_data()
+        if len(df_btc) == 0:
+            self.logger.logger.error('No bars to plot: {}'.format(self.get_title()))
+            return
+
+        # 描画するピクセル数に合わせて足をまとめる
+        with metrics.REGISTRY.timer('plot_stage_seconds', stage='downsample'):
+            df_plot = self.downsample(df_btc, self.get_max_candles())
+
+        with metrics.REGISTRY.timer('plot_stage_seconds', stage='draw'):
+            fig = self.draw(df_plot)
+
+        if self.output is None:
+            self.logger.logger.info('plot {} bars as {} candles in {:.3f} sec'.format(
+                len(df_btc), len(df_plot), time.perf_counter() - start_time))
+            import matplotlib.pyplot as plt
+            plt.show()
+            return
+
+        with metrics.REGISTRY.timer('plot_stage_seconds', stage='save'):
+            fig.savefig(self.output, dpi=self.dpi)
+        self.logger.logger.info('save {} bars as {} candles on {} in {:.3f} sec'.format(
+            len(df_btc), len(df_plot), self.output, time.perf_counter() - start_time))
+
+    def draw(self, df_btc):
+        # type: (df) -> Figure
+        """
+        ローソク足と出来高を描画する. ローソク足は1本ずつではなくまとめて描く
+        :param df_btc: hlocのデータフレーム
+        :return: Figure
+        """
+        fig = self.new_figure()
+        ax = fig.add_axes(self.axes_rect)
+        ax.set_title(self.get_title())
 
         # 参考 http://www.madopro.net/entry/bitcoin_chart
-        # ローソク足をプロット
-        fig = plt.figure(figsize=(18, 9))
-        ax = plt.subplot(1, 1, 1)
-        candlestick2_ohlc(ax, df_btc["first"], df_btc["max"], df_btc["min"], df_btc["last"], width=0.9, colorup="b", colordown="r")
-
-        # 横軸のセット
-        ax.set_xticklabels([(df_btc.index[int(x)] if x < df_btc.shape[0] else x) for x in ax.get_xticks()], rotation=90)
-        ax.set_xlim([0, df_btc.shape[0]])
+        # ローソク足をプロット. 陽線は青, 陰線は赤
+        # 実体は足の幅の90%の太さの線で描く. 線の太さはポイント単位
+        x = np.arange(len(df_btc))
+        first, last = df_btc['first'].values, df_btc['last'].values
+        color = np.where(last >= first, 'b', 'r')
+        candle_width = self.width * self.axes_rect[2] / len(df_btc) * 72.0 / self.dpi
+        ax.vlines(x, df_btc['min'].values, df_btc['max'].values, colors=color, linewidth=min(candle_width, 1))
+        ax.vlines(x, np.minimum(first, last), np.maximum(first, last), colors=color,
+                  linewidth=candle_width * 0.9)
+
+        # 横軸のセット. 目盛りの位置の足の日時を表示する
+        index = df_btc.index
+        ax.xaxis.set_major_formatter(FuncFormatter(
+            lambda value, position: str(index[int(value)]) if 0 <= value < len(index) else ''))
+        ax.tick_params(axis='x', labelrotation=90)
+        ax.set_xlim([-0.5, len(df_btc) - 0.5])
         ax.set_ylabel("Price")
         ax.grid()
 
@@ -60,14 +143,100 @@ class PlotChart(object):
 
         # 出来高を上からプロット
         ax2 = ax.twinx()
-        volume_overlay(ax2, df_btc["first"], df_btc["last"], df_btc["size"], width=1, colorup="g", colordown="g")
-        ax2.set_xlim([0, df_btc.shape[0]])
+        ax2.vlines(x, 0, df_btc['size'].values, colors='g', alpha=0.5, linewidth=candle_width)
+        ax2.set_xlim([-0.5, len(df_btc) - 0.5])
 
         # 出来高のサイズ調整
         ax2.set_ylim([0, df_btc["size"].max() * 4])
         ax2.set_ylabel("Volume")
 
-        plt.show()
+        return fig
+
+    def new_figure(self):
+        # type: () -> Figure
+        """
+        図を作る. 保存する場合はpyplotを使わないので、画面が無くても描画でき、複数描画してもメモリに残らない
+        :return: Figure
+        """
+        figsize = (self.width / self.dpi, self.height / self.dpi)
+        if self.output is None:
+            import matplotlib.pyplot as plt
+            return plt.figure(figsize=figsize, dpi=self.dpi)
+
+        from matplotlib.figure import Figure
+        return Figure(figsize=figsize, dpi=self.dpi)
+
+    def get_max_candles(self):
+        # type: () -> int
+        """
+        ローソク足を描く領域の幅から、描画するローソク足の最大の本数を求める
+        :return: 本数
+        """
+        return max(int(self.width * self.axes_rect[2] / self.candle_pixels), 1)
+
+    def get_title(self):
+        # type: () -> str
+        """
+        図のタイトル
+        :return: ファイル名または時間軸と期間
+        """
+        source = os.path.basename(self.input_file) if self.input_file is not None else self.plot_axis
+        if self.start_date is None and self.end_date is None:
+            return source
+        return '{} {} - {}'.format(source, self.start_date or '', self.end_date or '')
+
+    def select_time_axis(self, span):
+        # type: (datetime.timedelta) -> str
+        """
+        期間を描画するのに十分な本数がある中で最も長い足の時間軸を選ぶ. 読み込む足が少ないほど速い
+        :param span: 描画する期間
+        :return: hloc_dirにある時間軸. time_axisより短い足は選ばない
+        """
+        span_ns = span.total_seconds() * 10 ** 9
+        max_candles = self.get_max_candles()
+        try:
+            width_ns = self.get_width_ns(self.time_axis)
+        except ValueError:
+            # 約定数, 出来高, 売買代金の足は幅が決まっていないのでそのまま使う
+            return self.time_axis
+
+        plot_axis = self.time_axis
+        for time_axis in list_time_axis(self.hloc_dir):
+            try:
+                axis_width_ns = self.get_width_ns(time_axis)
+            except ValueError:
+                continue
+            if width_ns < axis_width_ns and span_ns / axis_width_ns >= max_candles:
+                plot_axis, width_ns = time_axis, axis_width_ns
+        return plot_axis
+
+    def get_width_ns(self, time_axis):
+        # type: (str) -> int
+        """
+        時間軸の足の幅
+        :param time_axis: one_minute, 5_minute, one_hour, one_day or a spec such as 15m, 4h, 1w
+        :return: ナノ秒
+        """
+        return OhlcvAggregator.from_spec(self.time_axis_spec.get(time_axis, time_axis)).width_ns
+
+    @staticmethod
+    def downsample(df_btc, max_candles):
+        # type: (df, int) -> df
+        """
+        連続するk本の足を1本にまとめ、max_candles本以下にする. 日時は各まとまりの最初の足の日時
+        :param df_btc: 時系列順のhlocのデータフレーム
+        :param max_candles: 最大の本数
+        :return: まとめたhlocのデータフレーム. max_candles本以下であればそのまま
+        """
+        if len(df_btc) <= max_candles:
+            return df_btc
+
+        bars_per_candle = -(-len(df_btc) // max_candles)
+        date_ns = df_btc.index.values.astype('datetime64[ns]').view(np.int64)
+        bucket = date_ns[np.arange(len(df_btc)) // bars_per_candle * bars_per_candle]
+        count = df_btc['count'].values if 'count' in df_btc.columns else np.ones(len(df_btc), dtype=np.int64)
+        return OhlcvAggregator(1).build(bucket, df_btc['min'].values, df_btc['max'].values, df_btc['first'].values,
+                                        df_btc['last'].values, df_btc['size'].values, count)
 
     def load_btc_data(self):
         # type: () -> df
@@ -76,20 +245,110 @@ class PlotChart(object):
         :return: hloc btc data frame
         """
 
-        df_btc = pd.read_csv(self.input_file, index_col='datetime')
+        columns = ['min', 'max', 'first', 'last', 'size']
+        if self.input_file is None:
+            # 期間と重なるファイルだけを読み込む
+            start_date, end_date = self.start_date, self.end_date
+            if start_date is None or end_date is None:
+                file_list = query.list_hloc_files(self.hloc_dir, self.time_axis)
+                if not file_list:
+                    return pd.DataFrame(columns=columns)
+                start_date = start_date or file_list[0][0]
+                end_date = end_date or file_list[-1][1] + datetime.timedelta(seconds=1)
+            self.plot_axis = self.select_time_axis(end_date - start_date)
+            df_btc = query.load(start_date, end_date, self.plot_axis, columns, hloc_dir=self.hloc_dir)
+            self.logger.logger.info('Load {} bars of {}'.format(len(df_btc), self.plot_axis))
+            return df_btc
+
+        df_btc = pd.read_csv(self.input_file, index_col='datetime', usecols=['datetime'] + columns, parse_dates=True)
+        if self.start_date is not None:
+            df_btc = df_btc[df_btc.index >= self.start_date]
+        if self.end_date is not None:
+            df_btc = df_btc[df_btc.index < self.end_date]
         self.logger.logger.info('Load btc file: {}'.format(self.input_file))
         return df_btc
 
 
+def list_time_axis(hloc_dir):
+    # type: (str) -> list
+    """
+    hloc_dirにあるhlocファイルの時間軸
+    :param hloc_dir: hlocデータのディレクトリ
+    :return: 時間軸のリスト
+    """
+    # hloc_{時間軸}_{最初の足}_{最後の足}.csv
+    return sorted(set(x[len('hloc_'):].rsplit('_', 2)[0] for x in os.listdir(hloc_dir)
+                      if x.startswith('hloc_') and x.endswith('.csv')))
+
+
+def get_output_list(source_list, output, image_format):
+    # type: (list, str, str) -> list
+    """
+    描画するものごとに保存する画像のパスを決める
+    :param source_list: hlocファイルのパスまたは時間軸のリスト
+    :param output: 1つであれば画像のパス, 複数であればディレクトリ. 指定がなければ画面に表示する
+    :param image_format: ディレクトリに保存する画像の形式
+    :return: 画像のパスのリスト
+    """
+    if output is None:
+        return [None] * len(source_list)
+    if len(source_list) == 1 and not os.path.isdir(output):
+        return [output]
+    return [os.path.join(output, '{}.{}'.format(os.path.splitext(os.path.basename(x))[0], image_format))
+            for x in source_list]
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('-f', '--file', help='file name(including directory path).',
+    parser.add_argument('-f', '--file', help='file names(including directory path). several files are plotted in turn',
+                        action='store', nargs='+',
+                        required=False)
+    parser.add_argument('-t', '--time', help='comma separated time axis loaded from --hloc-dir instead of files',
                         action='store',
-                        required=True)
+                        required=False)
+    parser.add_argument('-s', '--start', help='start date, included (ex. 2018-04-01-00:00:00)', action='store',
+                        required=False)
+    parser.add_argument('-e', '--end', help='end date, not included (ex. 2018-04-02-00:00:00)', action='store',
+                        required=False)
+    parser.add_argument('-o', '--output', help='png or svg file to save. a directory for several charts',
+                        action='store', required=False)
+    parser.add_argument('--image-format', help='image format saved in the directory of --output', action='store',
+                        choices=PlotChart.image_format_list, default='png')
+    parser.add_argument('--hloc-dir', help='directory of hloc data', action='store', default='./hloc')
+    parser.add_argument('--width', help='width of the image in pixels', action='store', type=int, default=1800)
+    parser.add_argument('--height', help='height of the image in pixels', action='store', type=int, default=900)
+    parser.add_argument('--dpi', help='dots per inch of the image', action='store', type=int, default=100)
+    parser.add_argument('--candle-pixels', help='minimum width of a candle in pixels', action='store', type=int,
+                        default=3)
 
     args = parser.parse_args()
     logger = logger.Logger()
     logger.logger.info('START plotchart')
 
-    plot_chart = PlotChart(logger, args.file)
-    plot_chart.run()
+    if args.file is None and args.time is None:
+        logger.logger.error('Please specify hloc files by -f or time axis by -t')
+        exit(1)
+
+    try:
+        arg_start_date = dt.strptime(args.start, '%Y-%m-%d-%H:%M:%S') if args.start else None
+        arg_end_date = dt.strptime(args.end, '%Y-%m-%d-%H:%M:%S') if args.end else None
+    except ValueError:
+        logger.logger.error('The format of the date is incorrect. Please specify it in the following format.')
+        logger.logger.error('ex. 2018-04-07-22:06:00')
+        exit(1)
+
+    if args.output is not None:
+        # 画面が無くても保存できるようにする
+        matplotlib.use('Agg')
+
+    source_list = args.file if args.file is not None else args.time.split(',')
+    output_list = get_output_list(source_list, args.output, args.image_format)
+    if args.output is not None and len(source_list) > 1:
+        assert os.path.isdir(args.output), 'Please make directry: {}'.format(args.output)
+
+    # 1つのプロセスで続けて描画する
+    for source, output in zip(source_list, output_list):
+        plot_chart = PlotChart(logger, source if args.file is not None else None,
+                               None if args.file is not None else source, arg_start_date, arg_end_date, output,
+                               args.hloc_dir, args.width, args.height, args.dpi, args.candle_pixels)
+        plot_chart.run()
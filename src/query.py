@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This module loads stored ticks and bars in a time range.
+Time spans of files are taken from the file names (btc_{newest}_{oldest}.csv, date= partitions of parquet
+and hloc_{axis}_{first}_{last}.csv), so only the files overlapping the range are opened.
+"""
+
+import os
+import time
+import bisect
+import argparse
+import datetime
+import numpy as np
+import pandas as pd
+from datetime import datetime as dt
+import logger
+import storage
+from dateconverter import DateConverter
+
+
+class SpanIndex(object):
+    """
+    This class keeps the time spans of files sorted by the first date.
+    The index is rebuilt only when the directories are modified.
+    """
+
+    def __init__(self, list_function, dir_function):
+        # type: (function, function) -> None
+        """
+        Class initialization.
+        :param list_function: (最初の日時, 最後の日時, パス)のリストを古い順に返す関数
+        :param dir_function: 監視するディレクトリのリストを返す関数
+        """
+        self.list_function = list_function
+        self.dir_function = dir_function
+        self.signature = None
+        self.span_list = []
+        self.first_list = []
+
+    def get_signature(self):
+        # type: () -> tuple
+        """
+        ディレクトリの更新日時. ファイルが追加, 削除されると変わる
+        :return: (ディレクトリ, 更新日時)のタプル
+        """
+        return tuple((x, os.stat(x).st_mtime_ns) for x in self.dir_function())
+
+    def select(self, start, end, margin=datetime.timedelta(0)):
+        # type: (dt, dt, datetime.timedelta) -> list
+        """
+        期間と重なるファイルを古い順に返す
+        :param start: 期間の始まり(含む)
+        :param end: 期間の終わり(含まない)
+        :param margin: ファイル名の最後の日時に足す幅. ファイル名が分単位であれば1分
+        :return: (最初の日時, 最後の日時, パス)のリスト
+        """
+        signature = self.get_signature()
+        if signature != self.signature:
+            self.span_list = self.list_function()
+            self.first_list = [x[0] for x in self.span_list]
+            self.signature = signature
+
+        # 最初の日時が期間の終わりより後のファイルは読まない
+        stop = bisect.bisect_left(self.first_list, end)
+        return [x for x in self.span_list[:stop] if x[1] + margin > start]
+
+
+class BtcQuery(object):
+    """
+    This class loads ticks or bars between two dates (Japan time) with pruning by file spans.
+    """
+
+    def __init__(self, data_dir='./data', hloc_dir='./hloc', storage_format='csv'):
+        # type: (str, str, str) -> None
+        """
+        Class initialization.
+        :param data_dir: btcデータのディレクトリ
+        :param hloc_dir: hlocデータのディレクトリ
+        :param storage_format: btcデータの保存形式. csv or parquet
+        """
+        self.storage = storage.BtcStorage(data_dir, storage_format)
+        self.hloc_dir = hloc_dir
+        # csvのファイル名は分単位なので、最後の日時の1分後までを含む. parquetの期間はそれより細かい
+        self.tick_margin = datetime.timedelta(minutes=1)
+        self.tick_index = SpanIndex(self.list_tick_files, self.list_tick_dirs)
+        # 時間軸 -> SpanIndex
+        self.bar_index = {}
+        # 直近のloadで読んだファイル数
+        self.read_count = 0
+
+    def load(self, start, end, axis=None, columns=None):
+        # type: (dt, dt, str, list) -> df
+        """
+        期間の約定または足を読み込む
+        :param start: 期間の始まり(含む). 日本時間
+        :param end: 期間の終わり(含まない). 日本時間
+        :param axis: 時間軸. 指定がなければ約定を読み込む
+        :param columns: 読み込む列. 指定がなければ全て
+        :return: データフレーム. 約定はidの昇順, 足は日時をインデックスとした時系列順
+        """
+        if axis is None:
+            return self.load_ticks(start, end, columns)
+        return self.load_bars(start, end, axis, columns)
+
+    def load_ticks(self, start, end, columns=None):
+        # type: (dt, dt, list) -> df
+        """
+        期間の約定を読み込む. 期間に全体が含まれるファイルは日時で絞り込まない
+        :param start: 期間の始まり(含む)
+        :param end: 期間の終わり(含まない)
+        :param columns: 読み込む列. 指定がなければ全て
+        :return: btcデータフレーム. idの昇順
+        """
+        read_columns = None if columns is None else list(dict.fromkeys(list(columns) + ['id', 'exec_date']))
+        # 日本時間をUTCのエポックナノ秒にする
+        start_ns = to_ns(start) - DateConverter.jst_offset_ns
+        end_ns = to_ns(end) - DateConverter.jst_offset_ns
+
+        df_list = []
+        file_list = self.tick_index.select(start, end, self.tick_margin)
+        for first_date, last_date, file_name in file_list:
+            is_inside = start <= first_date and last_date + self.tick_margin <= end
+            if file_name.endswith('.parquet'):
+                # parquetは行グループの統計で読み飛ばす
+                filters = None if is_inside else [('exec_date', '>=', start_ns), ('exec_date', '<', end_ns)]
+                df_btc = self.storage.load(file_name, read_columns, filters)
+            else:
+                df_btc = self.storage.load(file_name, read_columns)
+                if not is_inside:
+                    epoch_ns = DateConverter.to_epoch_ns(df_btc['exec_date'])
+                    df_btc = df_btc[(epoch_ns >= start_ns) & (epoch_ns < end_ns)]
+            df_list.append(df_btc)
+        self.read_count = len(file_list)
+
+        if not df_list:
+            return pd.DataFrame(columns=columns)
+        df_btc = pd.concat(df_list).sort_values('id').reset_index(drop=True)
+        return df_btc if columns is None else df_btc[list(columns)]
+
+    def load_bars(self, start, end, axis, columns=None):
+        # type: (dt, dt, str, list) -> df
+        """
+        期間の足を読み込む. 足の開始日時が期間に含まれる足を返す
+        :param start: 期間の始まり(含む)
+        :param end: 期間の終わり(含まない)
+        :param axis: 時間軸. generatehlocの-tと同じ名前
+        :param columns: 読み込む列. 指定がなければ全て
+        :return: hlocのデータフレーム
+        """
+        if axis not in self.bar_index:
+            self.bar_index[axis] = SpanIndex(lambda: list_hloc_files(self.hloc_dir, axis), lambda: [self.hloc_dir])
+        read_columns = None if columns is None else ['datetime'] + list(columns)
+
+        df_list = []
+        file_list = self.bar_index[axis].select(start, end)
+        for first_date, last_date, file_name in file_list:
+            df_hloc = pd.read_csv(file_name, index_col='datetime', usecols=read_columns, parse_dates=True)
+            if not (start <= first_date and last_date < end):
+                df_hloc = df_hloc[(df_hloc.index >= start) & (df_hloc.index < end)]
+            df_list.append(df_hloc)
+        self.read_count = len(file_list)
+
+        if not df_list:
+            return pd.DataFrame(columns=columns, index=pd.DatetimeIndex([], name='datetime'))
+        return pd.concat(df_list)
+
+    def list_tick_files(self):
+        # type: () -> list
+        """
+        btcファイルの期間のリスト
+        :return: (最も古い日時, 最も新しい日時, data_dirからの相対パス)のリスト. 古い順
+        """
+        if self.storage.storage_format == 'parquet':
+            # parquetはパーティションが日単位なので、フッタの統計からファイルの期間を求める
+            return sorted(self.get_parquet_span(x) + (x, ) for x in self.storage.list_files())
+        return [self.storage.get_file_span(x) + (x, ) for x in self.storage.list_files()]
+
+    def get_parquet_span(self, file_name):
+        # type: (str) -> tuple
+        """
+        parquetのフッタにあるexec_dateの最小値と最大値からファイルの期間を求める. データは読まない
+        :param file_name: data_dirからの相対パス
+        :return: (最も古い日時, 最も新しい日時). 日本時間. 統計が無ければパーティションの日付の範囲
+        """
+        import pyarrow.parquet as pq
+        metadata = pq.read_metadata(os.path.join(self.storage.data_dir, file_name))
+        column = metadata.schema.names.index('exec_date')
+        min_list, max_list = [], []
+        for i in range(metadata.num_row_groups):
+            statistics = metadata.row_group(i).column(column).statistics
+            if statistics is None or not statistics.has_min_max:
+                return self.storage.get_file_span(file_name)
+            min_list.append(statistics.min)
+            max_list.append(statistics.max)
+        if not min_list:
+            return self.storage.get_file_span(file_name)
+        first_date, last_date = DateConverter.to_jst([min(min_list), max(max_list)]).astype('datetime64[us]').tolist()
+        return first_date, last_date
+
+    def list_tick_dirs(self):
+        # type: () -> list
+        """
+        btcファイルのディレクトリ. parquetは日付ごとのディレクトリも含む
+        :return: ディレクトリのリスト
+        """
+        dir_list = [self.storage.data_dir]
+        if self.storage.storage_format == 'parquet':
+            dir_list += [os.path.join(self.storage.data_dir, x) for x in sorted(os.listdir(self.storage.data_dir))
+                         if x.startswith(self.storage.partition_prefix)]
+        return dir_list
+
+
+def list_hloc_files(hloc_dir, time_axis):
+    # type: (str, str) -> list
+    """
+    時間軸のhlocファイルの期間のリスト
+    :param hloc_dir: hlocデータのディレクトリ
+    :param time_axis: 時間軸
+    :return: (最初の足, 最後の足, パス)のリスト. 古い順
+    """
+    prefix = 'hloc_{}_'.format(time_axis)
+    output_list = []
+    for file_name in os.listdir(hloc_dir):
+        if not file_name.startswith(prefix) or not file_name.endswith('.csv'):
+            continue
+        first_date, last_date = file_name[len(prefix):-len('.csv')].split('_')
+        output_list.append((dt.strptime(first_date, '%Y-%m-%d-%H:%M:%S'),
+                            dt.strptime(last_date, '%Y-%m-%d-%H:%M:%S'),
+                            os.path.join(hloc_dir, file_name)))
+    return sorted(output_list)
+
+
+def to_ns(date):
+    # type: (dt) -> int
+    """
+    datetimeをエポックナノ秒にする. タイムゾーンは変換しない
+    :param date: datetime
+    :return: エポックナノ秒
+    """
+    return int((np.datetime64(date, 'ns') - np.datetime64(0, 'ns')).astype(np.int64))
+
+
+# (data_dir, hloc_dir, storage_format) -> BtcQuery. ファイルの期間のインデックスを使い回す
+query_cache = {}
+
+
+def load(start, end, axis=None, columns=None, data_dir='./data', hloc_dir='./hloc', storage_format='csv'):
+    # type: (dt, dt, str, list, str, str, str) -> df
+    """
+    期間の約定または足を読み込む. 同じディレクトリであればファイルの期間のインデックスを使い回す
+    :param start: 期間の始まり(含む). 日本時間
+    :param end: 期間の終わり(含まない). 日本時間
+    :param axis: 時間軸. 指定がなければ約定を読み込む
+    :param columns: 読み込む列. 指定がなければ全て
+    :param data_dir: btcデータのディレクトリ
+    :param hloc_dir: hlocデータのディレクトリ
+    :param storage_format: btcデータの保存形式. csv or parquet
+    :return: データフレーム
+    """
+    key = (data_dir, hloc_dir, storage_format)
+    if key not in query_cache:
+        query_cache[key] = BtcQuery(data_dir, hloc_dir, storage_format)
+    return query_cache[key].load(start, end, axis, columns)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--start_date', help='start date (ex. 2018-04-01-00:00:00)', action='store',
+                        required=True)
+    parser.add_argument('-e', '--end_date', help='end date, not included (ex. 2018-04-02-00:00:00)', action='store',
+                        required=True)
+    parser.add_argument('-t', '--time', help='time axis of bars. ticks are loaded if not specified', action='store',
+                        required=False)
+    parser.add_argument('-c', '--columns', help='comma separated columns to load', action='store', required=False)
+    parser.add_argument('-d', '--dir', help='directory of btc data', action='store', default='./data')
+    parser.add_argument('--hloc-dir', help='directory of hloc data', action='store', default='./hloc')
+    parser.add_argument('-f', '--format', help='storage format of btc data. csv or parquet', action='store',
+                        choices=['csv', 'parquet'], default='csv')
+    parser.add_argument('-o', '--output', help='csv file to write the result', action='store', required=False)
+
+    args = parser.parse_args()
+    assert os.path.exists('./log'), 'Please make directry: log dirctory'
+    logger = logger.Logger()
+
+    try:
+        arg_start_date = dt.strptime(args.start_date, '%Y-%m-%d-%H:%M:%S')
+        arg_end_date = dt.strptime(args.end_date, '%Y-%m-%d-%H:%M:%S')
+    except ValueError:
+        logger.logger.error('The format of the date is incorrect. Please specify it in the following format.')
+        logger.logger.error('ex. 2018-04-07-22:06:00')
+        exit(1)
+
+    btc_query = BtcQuery(args.dir, args.hloc_dir, args.format)
+    start_time = time.perf_counter()
+    df_result = btc_query.load(arg_start_date, arg_end_date, args.time,
+                               args.columns.split(',') if args.columns else None)
+    logger.logger.info('{} rows from {} files in {:.3f} sec'.format(len(df_result), btc_query.read_count,
+                                                                   time.perf_counter() - start_time))
+
+    if args.output:
+        df_result.to_csv(args.output, index=args.time is not None)
+        logger.logger.info(' save on {}'.format(args.output))
+    else:
+        print(df_result)
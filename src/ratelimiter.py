@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This module provides a request budget shared by threads.
+Each endpoint has a token bucket whose rate adapts to throttling responses and rate limit headers.
+Clients (products) sharing the budget take tokens in turn.
+"""
+
+import threading
+import time
+import metrics
+
+
+class TokenBucket(object):
+    """
+    This class hands out tokens at a rate with a burst of capacity tokens.
+    """
+
+    def __init__(self, rate, capacity):
+        # type: (float, float) -> None
+        """
+        Class initialization.
+        :param rate: 1秒あたりに補充するトークン数
+        :param capacity: 貯められるトークン数の上限
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        # 最後に補充した時刻. 止めている間は未来の時刻になる
+        self.last_time = time.time()
+
+    def refill(self, now):
+        # type: (float) -> None
+        """
+        前回から経過した時間の分だけトークンを補充する
+        :param now: 現在時刻
+        :return:
+        """
+        self.tokens = min(self.capacity, self.tokens + max(now - self.last_time, 0.0) * self.rate)
+        self.last_time = max(self.last_time, now)
+
+    def reserve(self, now):
+        # type: (float) -> float
+        """
+        トークンを一つ予約する. 足りない場合は借りて、補充されるまでの時間を返す
+        :param now: 現在時刻
+        :return: 待つ時間(秒)
+        """
+        self.refill(now)
+        self.tokens -= 1
+        # 借りたトークンは補充を再開する時刻から順に返す
+        return max(self.last_time - now, 0.0) + (-self.tokens / self.rate if self.tokens < 0 else 0.0)
+
+    def block(self, until):
+        # type: (float) -> None
+        """
+        指定した時刻までトークンを渡さない. 貯まっていたトークンは捨てる
+        :param until: 再開する時刻
+        :return:
+        """
+        self.last_time = max(self.last_time, until)
+        self.tokens = min(self.tokens, 0.0)
+
+
+class RateLimiter(object):
+    """
+    This class keeps the request rate of each endpoint under the budget.
+    The rate is halved on 429 and 5xx responses and recovers gradually up to the budget on success (AIMD).
+    """
+
+    # bitflyerが返すレート制限のヘッダ
+    remaining_header = 'X-RateLimit-Remaining'
+    reset_header = 'X-RateLimit-Reset'
+
+    def __init__(self, requests_per_window, window_seconds=1.0, min_rate=0.1, increase_rate=0.05):
+        # type: (float, float, float, float) -> None
+        """
+        Class initialization.
+        :param requests_per_window: 全スレッド合計でwindow_secondsあたりに許可するリクエスト数(エンドポイントごと)
+        :param window_seconds: 予算の期間(秒)
+        :param min_rate: 1秒あたりのリクエスト数の下限
+        :param increase_rate: 成功するたびに予算に対して戻す割合
+        """
+        self.max_rate = requests_per_window / float(window_seconds)
+        self.capacity = max(1.0, float(requests_per_window))
+        self.min_rate = min(min_rate, self.max_rate)
+        self.increase_rate = increase_rate
+        # エンドポイント -> TokenBucket
+        self.buckets = {}
+        # クライアント -> 予約中のスレッドを一つにするロック
+        self.client_locks = {}
+        self.lock = threading.Lock()
+        self.wait_counter = metrics.REGISTRY.counter('ratelimiter_wait_seconds_total', 'seconds waited for tokens')
+        self.rate_gauge = metrics.REGISTRY.gauge('ratelimiter_rate', 'current requests per second')
+
+    def get_bucket(self, endpoint):
+        # type: (str) -> TokenBucket
+        """
+        エンドポイントのトークンバケット. ロックを取ってから呼ぶ
+        :param endpoint: エンドポイント
+        :return: TokenBucket
+        """
+        if endpoint not in self.buckets:
+            self.buckets[endpoint] = TokenBucket(self.max_rate, self.capacity)
+        return self.buckets[endpoint]
+
+    def get_client_lock(self, client):
+        # type: (str) -> threading.Lock
+        """
+        クライアントのロック. ロックを取ってから呼ぶ
+        :param client: クライアント
+        :return: Lock
+        """
+        if client not in self.client_locks:
+            self.client_locks[client] = threading.Lock()
+        return self.client_locks[client]
+
+    def wait(self, endpoint='', client=None):
+        # type: (str, str) -> None
+        """
+        次のリクエストが許可されるまで待つ.
+        clientを指定した場合はクライアントごとに予約を一つまでにするので、予算を使い切っている間は
+        スレッド数に関係なくクライアントの間で順番にトークンを受け取る
+        :param endpoint: エンドポイント
+        :param client: クライアント. プロダクトコード等
+        :return:
+        """
+        if client is None:
+            self.acquire(endpoint)
+            return
+
+        with self.lock:
+            client_lock = self.get_client_lock(client)
+        with client_lock:
+            self.acquire(endpoint, client)
+
+    def acquire(self, endpoint, client=None):
+        # type: (str, str) -> None
+        """
+        トークンを予約し、受け取れる時刻まで待つ
+        :param endpoint: エンドポイント
+        :param client: クライアント. 待った秒数のラベル
+        :return:
+        """
+        # 呼び出し順にトークンを予約し、ロックの外でスリープする
+        with self.lock:
+            wait_second = self.get_bucket(endpoint).reserve(time.time())
+
+        if wait_second > 0:
+            if client is None:
+                self.wait_counter.inc(wait_second, endpoint=endpoint)
+            else:
+                self.wait_counter.inc(wait_second, endpoint=endpoint, client=client)
+            time.sleep(wait_second)
+
+    def update(self, endpoint, status_code, headers=None):
+        # type: (str, int, dict) -> None
+        """
+        レスポンスに応じてエンドポイントのレートを調整する
+        :param endpoint: エンドポイント
+        :param status_code: ステータスコード. 接続エラーの場合はNone
+        :param headers: レスポンスヘッダ
+        :return:
+        """
+        headers = headers or {}
+        with self.lock:
+            bucket = self.get_bucket(endpoint)
+            now = time.time()
+            # 変更前のレートで補充しておく
+            bucket.refill(now)
+
+            if status_code == 429 or (status_code is not None and status_code >= 500):
+                # 制限されたらレートを半分にする
+                bucket.rate = max(self.min_rate, bucket.rate / 2.0)
+            elif status_code is not None and status_code < 400:
+                # 成功したら予算まで少しずつ戻す
+                bucket.rate = min(self.max_rate, bucket.rate + self.max_rate * self.increase_rate)
+
+            # ヘッダで残りのリクエスト数が分かれば、リセットまでに使い切らない速さにする
+            remaining, reset_time = self.parse_headers(headers)
+            if remaining is not None and reset_time is not None and reset_time > now:
+                if remaining <= 0:
+                    bucket.block(reset_time)
+                else:
+                    bucket.rate = max(self.min_rate, min(bucket.rate, remaining / (reset_time - now)))
+            self.rate_gauge.set(bucket.rate, endpoint=endpoint)
+
+    def block(self, endpoint, seconds):
+        # type: (str, float) -> None
+        """
+        Retry-After等で指定された時間だけエンドポイントへのリクエストを全スレッドで止める
+        :param endpoint: エンドポイント
+        :param seconds: 止める時間(秒)
+        :return:
+        """
+        with self.lock:
+            self.get_bucket(endpoint).block(time.time() + seconds)
+
+    def parse_headers(self, headers):
+        # type: (dict) -> tuple
+        """
+        レート制限のヘッダを読む
+        :param headers: レスポンスヘッダ
+        :return: (残りのリクエスト数, リセットされるエポック秒). 無ければNone
+        """
+        try:
+            remaining = float(headers[self.remaining_header])
+            reset_time = float(headers[self.reset_header])
+        except (KeyError, TypeError, ValueError):
+            return None, None
+        return remaining, reset_time
+
+    def get_rate(self, endpoint=''):
+        # type: (str) -> float
+        """
+        現在のレート
+        :param endpoint: エンドポイント
+        :return: 1秒あたりのリクエスト数
+        """
+        with self.lock:
+            return self.get_bucket(endpoint).rate
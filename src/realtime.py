@@ -0,0 +1,488 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This module ingests executions from the bitflyer realtime api (lightning_executions channel).
+Ticks are appended to storage continuously and the current bar of each time axis is updated on every tick.
+A bar is written as soon as its bucket closes, without waiting for the next batch of generatehloc.
+"""
+
+import os
+import json
+import time
+import pandas as pd
+import metrics
+import storage
+import transport
+import ratelimiter
+from dateconverter import DateConverter
+from generatehloc import HlocWriter
+from ohlcv import OhlcvAggregator
+
+try:
+    import websocket
+except ImportError:
+    websocket = None
+
+
+class BarBuilder(object):
+    """
+    This class keeps the current bar of a time axis and updates it in O(1) on every tick.
+    """
+
+    def __init__(self, time_axis, aggregator):
+        # type: (str, OhlcvAggregator) -> None
+        """
+        Class initialization.
+        :param time_axis: 時間軸
+        :param aggregator: 足の幅と区切り
+        """
+        self.time_axis = time_axis
+        self.aggregator = aggregator
+        # 現在の足の開始日時(日本時間のエポックナノ秒). 足が無ければNone
+        self.bucket = None
+        self.low = self.high = self.first = self.last = None
+        self.size = 0.0
+        self.count = 0
+        # 最後に確定した足の開始日時. これ以前の約定は遅れて届いた約定
+        self.closed_bucket = None
+        # 遅れて届き、足に含めなかった約定数
+        self.late_count = 0
+
+    def update(self, date_ns, price, size):
+        # type: (int, float, float) -> tuple
+        """
+        約定で現在の足を更新する. 次の足の約定であれば現在の足を確定する
+        :param date_ns: 日本時間のエポックナノ秒
+        :param price: 価格
+        :param size: 数量
+        :return: 確定した足. (開始日時, 安値, 高値, 始値, 終値, 出来高, 約定数). 確定しなければNone
+        """
+        bucket = int(self.aggregator.get_bucket(date_ns))
+        if bucket == self.bucket:
+            self.low = min(self.low, price)
+            self.high = max(self.high, price)
+            self.last = price
+            self.size += size
+            self.count += 1
+            return None
+        if self.is_late(bucket):
+            self.late_count += 1
+            return None
+
+        closed_bar = self.pop()
+        self.bucket = bucket
+        self.low = self.high = self.first = self.last = price
+        self.size = size
+        self.count = 1
+        return closed_bar
+
+    def is_late(self, bucket):
+        # type: (int) -> bool
+        """
+        確定済みの足の約定か
+        :param bucket: 約定の足の開始日時
+        :return: bool
+        """
+        return (self.closed_bucket is not None and bucket <= self.closed_bucket) or \
+               (self.bucket is not None and bucket < self.bucket)
+
+    def close(self, now_ns):
+        # type: (int) -> tuple
+        """
+        足の終わりの日時を過ぎていれば、次の約定を待たずに現在の足を確定する
+        :param now_ns: 現在の日本時間のエポックナノ秒
+        :return: 確定した足. 確定しなければNone
+        """
+        if self.bucket is None or self.bucket + self.aggregator.width_ns > now_ns:
+            return None
+        return self.pop()
+
+    def pop(self):
+        # type: () -> tuple
+        """
+        現在の足を確定して返す
+        :return: 確定した足. 足が無ければNone
+        """
+        if self.bucket is None:
+            return None
+        closed_bar = (self.bucket, self.low, self.high, self.first, self.last, self.size, self.count)
+        self.closed_bucket = self.bucket
+        self.bucket = None
+        return closed_bar
+
+    def current(self):
+        # type: () -> tuple
+        """
+        確定していない現在の足
+        :return: 足. 無ければNone
+        """
+        if self.bucket is None:
+            return None
+        return self.bucket, self.low, self.high, self.first, self.last, self.size, self.count
+
+    def get_state(self):
+        # type: () -> dict
+        """
+        再開するための状態
+        :return: 辞書
+        """
+        return {'bar': self.current(), 'closed_bucket': self.closed_bucket}
+
+    def set_state(self, state):
+        # type: (dict) -> None
+        """
+        保存した状態から再開する
+        :param state: get_stateの辞書
+        :return:
+        """
+        self.closed_bucket = state['closed_bucket']
+        if state['bar'] is not None:
+            self.bucket, self.low, self.high, self.first, self.last, self.size, self.count = state['bar']
+
+    def to_frame(self, bar_list):
+        # type: (list) -> df
+        """
+        足のリストをgeneratehlocと同じ列のデータフレームにする
+        :param bar_list: 足のリスト. 時系列順
+        :return: hlocのデータフレーム
+        """
+        df_hloc = pd.DataFrame([x[1:] for x in bar_list], columns=self.aggregator.columns,
+                               index=pd.DatetimeIndex([pd.Timestamp(x[0]) for x in bar_list], name='datetime'))
+        return df_hloc
+
+
+class ExecutionStream(object):
+    """
+    This class subscribes to the executions feed, stores ticks and builds bars of each time axis live.
+    Missed executions while disconnected are fetched from the http api after reconnecting.
+    """
+
+    # 時間軸ごとの足の指定
+    time_axis_spec = {'one_minute': '1m', '5_minute': '5m', 'one_hour': '1h', 'one_day': '1d'}
+    keys = ['id', 'side', 'price', 'size', 'exec_date', 'buy_child_order_acceptance_id',
+            'sell_child_order_acceptance_id']
+
+    def __init__(self, root_logger, time_axis='one_minute,5_minute,one_hour,one_day', product_code='FX_BTC_JPY',
+                 ws_url='wss://ws.lightstream.bitflyer.com/json-rpc', domain_url='https://api.bitflyer.jp',
+                 data_dir='./data', output_dir='./hloc/live', storage_format='csv', file_lines=500000,
+                 close_delay=0.5, idle_timeout=30.0, requests_per_window=5.0, window_seconds=1.0, timeout=30.0):
+        # type: (logger, str, str, str, str, str, str, str, int, float, float, float, float, float) -> None
+        """
+        Class initialization.
+        :param root_logger: ロガー
+        :param time_axis: 作る足. カンマ区切りで複数指定できる
+        :param product_code: プロダクトコード
+        :param ws_url: リアルタイムAPIのURL
+        :param domain_url: 切断中の約定を取得するAPIのURL
+        :param data_dir: 約定を保存するディレクトリ
+        :param output_dir: 確定した足を保存するディレクトリ
+        :param storage_format: csv or parquet
+        :param file_lines: 一つのファイルの行数. 溜まるまでスプールへ追記する
+        :param close_delay: 足の終わりからこの秒数だけ遅れて届く約定を待ってから確定する
+        :param idle_timeout: この秒数だけ約定が届かなければ再接続する
+        :param requests_per_window: 切断中の約定を取得する際のリクエスト数の上限
+        :param window_seconds: 上限の期間(秒)
+        :param timeout: APIの読み込みのタイムアウト(秒)
+        """
+        self.logger = root_logger
+        self.time_axis_list = time_axis.split(',')
+        self.product_code = product_code
+        self.channel = 'lightning_executions_{}'.format(product_code)
+        self.ws_url = ws_url
+        self.domain_url = domain_url
+        self.execution_history_url = '/v1/getexecutions'
+        self.output_dir = output_dir
+        self.file_lines = file_lines
+        self.close_delay_ns = int(close_delay * 10 ** 9)
+        self.idle_timeout = idle_timeout
+        # 足を確定するか確認する間隔(秒)
+        self.receive_timeout = 0.1
+
+        self.storage = storage.BtcStorage(data_dir, storage_format)
+        # file_linesに達するまで約定を追記するファイル
+        self.spool_file = os.path.join(data_dir, '.stream_{}.spool.csv'.format(product_code))
+        self.spool_lines = 0
+        # 保存済みの最新のid. これより新しい約定だけを受け付ける
+        self.last_id = None
+        # 止めた時点の確定していない足. 次の実行で続きから作る
+        self.state_file = os.path.join(output_dir, '.stream_{}.json'.format(product_code))
+
+        self.transport = transport.BitflyerTransport(self.logger, {'product_code': product_code},
+                                                     read_timeout=timeout,
+                                                     rate_limiter=ratelimiter.RateLimiter(requests_per_window,
+                                                                                          window_seconds))
+        self.builders = [BarBuilder(x, OhlcvAggregator.from_spec(self.time_axis_spec.get(x, x)))
+                         for x in self.time_axis_list]
+        self.writers = []
+        self.is_stopped = False
+
+        self.tick_counter = metrics.REGISTRY.counter('realtime_ticks_total', 'executions received')
+        self.late_counter = metrics.REGISTRY.counter('realtime_late_ticks_total', 'executions of closed bars')
+        self.gap_counter = metrics.REGISTRY.counter('realtime_gap_rows_total', 'executions fetched after reconnect')
+        self.reconnect_counter = metrics.REGISTRY.counter('realtime_reconnects_total', 'reconnections')
+        self.bar_counter = metrics.REGISTRY.counter('realtime_bars_total', 'bars closed')
+        self.tick_latency = metrics.REGISTRY.histogram('realtime_tick_latency_seconds',
+                                                       'seconds from execution to receive')
+        self.bar_latency = metrics.REGISTRY.histogram('realtime_bar_latency_seconds',
+                                                      'seconds from the end of a bar to write')
+
+    def run(self):
+        # type: () -> None
+        """
+        購読し、止められるまで約定を受け取る. 切断された場合はバックオフして再接続する
+        :return:
+        """
+        if websocket is None:
+            self.logger.logger.error('Please install websocket-client to stream executions.')
+            exit(1)
+
+        self.logger.logger.info('START stream {}'.format(self.channel))
+        self.open()
+        attempt = 0
+        try:
+            while not self.is_stopped:
+                try:
+                    self.receive(self.connect())
+                    attempt = 0
+                except (websocket.WebSocketException, OSError, ValueError) as e:
+                    attempt += 1
+                    wait_seconds = self.transport.get_backoff(attempt)
+                    self.reconnect_counter.inc()
+                    self.logger.logger.error(' An error occurred in stream ({}). reconnect in {:.1f} seconds'.format(
+                        e, wait_seconds))
+                    time.sleep(wait_seconds)
+        finally:
+            self.close()
+        self.logger.logger.info('FINISH stream')
+
+    def stop(self):
+        # type: () -> None
+        """
+        受信を止める. 別スレッドから呼ぶ
+        :return:
+        """
+        self.is_stopped = True
+
+    def open(self):
+        # type: () -> None
+        """
+        中断した実行のスプールと書き込み中の足を読み込み、続きから受け付ける
+        :return:
+        """
+        if os.path.exists(self.spool_file):
+            spool_df = pd.read_csv(self.spool_file, usecols=['id'])
+            self.spool_lines = len(spool_df)
+            if self.spool_lines > 0:
+                self.last_id = int(spool_df['id'].max())
+        if self.last_id is None:
+            self.last_id = self.storage.get_newest_id()
+        self.logger.logger.info('last id: {}'.format(self.last_id))
+
+        if not os.path.exists(self.output_dir):
+            os.makedirs(self.output_dir)
+        for builder in self.builders:
+            writer = HlocWriter(self.logger, builder.time_axis, self.file_lines, self.output_dir)
+            # 書き込み中のファイルがあれば追記し、書き込み済みの足は作り直さない
+            if os.path.exists(writer.writing_file):
+                df_hloc = pd.read_csv(writer.writing_file, index_col=0, parse_dates=True)
+                if len(df_hloc) > 0:
+                    writer.lines = len(df_hloc)
+                    writer.first_date = df_hloc.index[0]
+                    writer.last_date = df_hloc.index[-1]
+                    builder.closed_bucket = int(pd.Timestamp(writer.last_date).value)
+            self.writers.append(writer)
+
+        # 止めた時点から続いていれば確定していない足を引き継ぐ
+        if os.path.exists(self.state_file):
+            with open(self.state_file) as f:
+                state = json.load(f)
+            if state['last_id'] == self.last_id:
+                for builder in self.builders:
+                    if builder.time_axis in state['builders']:
+                        builder.set_state(state['builders'][builder.time_axis])
+            else:
+                self.logger.logger.info('The first bars may lack executions before id {}.'.format(self.last_id))
+            os.remove(self.state_file)
+
+    def connect(self):
+        # type: () -> websocket.WebSocket
+        """
+        接続してチャンネルを購読する
+        :return: websocket
+        """
+        ws = websocket.create_connection(self.ws_url, timeout=self.receive_timeout + 5.0)
+        ws.send(json.dumps({'jsonrpc': '2.0', 'method': 'subscribe', 'params': {'channel': self.channel},
+                            'id': 1}))
+        ws.settimeout(self.receive_timeout)
+        self.logger.logger.info('subscribed {} on {}'.format(self.channel, self.ws_url))
+        return ws
+
+    def receive(self, ws):
+        # type: (websocket.WebSocket) -> None
+        """
+        約定を受け取り続ける. 接続して最初の約定の前に、切断中の約定をAPIから取得する
+        :param ws: websocket
+        :return:
+        """
+        is_gap_filled = False
+        receive_time = time.time()
+        try:
+            while not self.is_stopped:
+                try:
+                    message = ws.recv()
+                except websocket.WebSocketTimeoutException:
+                    self.close_bars()
+                    if time.time() - receive_time > self.idle_timeout:
+                        raise websocket.WebSocketTimeoutException('no message in {} seconds'.format(
+                            self.idle_timeout))
+                    continue
+                if not message:
+                    raise websocket.WebSocketConnectionClosedException('connection is closed')
+                receive_time = time.time()
+
+                rows = self.parse_message(message)
+                if not rows:
+                    continue
+                if not is_gap_filled:
+                    self.fill_gap(rows[0]['id'])
+                    is_gap_filled = True
+                self.add_ticks(rows)
+                self.close_bars()
+        finally:
+            ws.close()
+
+    def parse_message(self, message):
+        # type: (str) -> list
+        """
+        購読したチャンネルのメッセージから約定を取り出す
+        :param message: json-rpcのメッセージ
+        :return: 約定の辞書のリスト. idの昇順. 約定でなければNone
+        """
+        body = json.loads(message)
+        if body.get('method') != 'channelMessage' or body['params'].get('channel') != self.channel:
+            return None
+        return sorted(body['params']['message'], key=lambda x: x['id'])
+
+    def fill_gap(self, first_id):
+        # type: (int) -> None
+        """
+        保存済みの最新のidからfirst_idの前までの約定をAPIから取得する
+        :param first_id: 受信した最初の約定のid
+        :return:
+        """
+        if self.last_id is None or first_id <= self.last_id + 1:
+            return
+
+        self.logger.logger.info('fetch missed executions: {} - {}'.format(self.last_id + 1, first_id - 1))
+        params = {'product_code': self.product_code, 'count': 500, 'before': first_id, 'after': self.last_id}
+        page_list = []
+        while True:
+            rows = self.transport.get_json(self.domain_url + self.execution_history_url, params)
+            if not rows:
+                break
+            page_list.append(rows)
+            params['before'] = rows[-1]['id']
+            if params['before'] <= self.last_id + 1:
+                break
+
+        rows = sorted([x for page in page_list for x in page], key=lambda x: x['id'])
+        self.gap_counter.inc(len(rows))
+        self.add_ticks(rows)
+
+    def add_ticks(self, rows):
+        # type: (list) -> None
+        """
+        約定をスプールへ追記し、各時間軸の足を更新する
+        :param rows: 約定の辞書のリスト. idの昇順
+        :return:
+        """
+        # 再接続で重複した約定は捨てる
+        if self.last_id is not None:
+            rows = [x for x in rows if x['id'] > self.last_id]
+        if not rows:
+            return
+
+        tick_df = pd.DataFrame(rows, columns=self.keys)
+        tick_df.to_csv(self.spool_file, mode='a', header=not os.path.exists(self.spool_file), index=False)
+        self.spool_lines += len(tick_df)
+        self.last_id = int(tick_df['id'].iloc[-1])
+        self.tick_counter.inc(len(tick_df))
+
+        epoch_ns = DateConverter.to_epoch_ns(tick_df['exec_date'])
+        self.tick_latency.observe(max(time.time() - float(epoch_ns[-1]) / 10.0 ** 9, 0.0))
+        jst_ns = (epoch_ns + DateConverter.jst_offset_ns).tolist()
+        for builder, writer in zip(self.builders, self.writers):
+            bar_list = []
+            late_count = builder.late_count
+            for date_ns, price, size in zip(jst_ns, tick_df['price'].tolist(), tick_df['size'].tolist()):
+                closed_bar = builder.update(date_ns, price, size)
+                if closed_bar is not None:
+                    bar_list.append(closed_bar)
+            if builder.late_count > late_count:
+                self.late_counter.inc(builder.late_count - late_count, time_axis=builder.time_axis)
+            self.write_bars(builder, writer, bar_list)
+
+        if self.spool_lines >= self.file_lines:
+            self.flush_spool()
+
+    def close_bars(self):
+        # type: () -> None
+        """
+        足の終わりからclose_delayを過ぎた足を確定する
+        :return:
+        """
+        now_ns = time.time_ns() + DateConverter.jst_offset_ns - self.close_delay_ns
+        for builder, writer in zip(self.builders, self.writers):
+            closed_bar = builder.close(now_ns)
+            if closed_bar is not None:
+                self.write_bars(builder, writer, [closed_bar])
+
+    def write_bars(self, builder, writer, bar_list):
+        # type: (BarBuilder, HlocWriter, list) -> None
+        """
+        確定した足を保存する
+        :param builder: 足を作った時間軸
+        :param writer: 時間軸の書き込み
+        :param bar_list: 確定した足のリスト
+        :return:
+        """
+        if not bar_list:
+            return
+        writer.write(builder.to_frame(bar_list))
+        now_ns = time.time_ns() + DateConverter.jst_offset_ns
+        for closed_bar in bar_list:
+            self.bar_counter.inc(time_axis=builder.time_axis)
+            self.bar_latency.observe(max(now_ns - closed_bar[0] - builder.aggregator.width_ns, 0) / 10.0 ** 9,
+                                     time_axis=builder.time_axis)
+        self.logger.logger.info('{} bar: {}'.format(builder.time_axis, ', '.join(
+            str(pd.Timestamp(x[0])) for x in bar_list)))
+
+    def flush_spool(self):
+        # type: () -> None
+        """
+        スプールの約定をidの降順でストレージへ保存する
+        :return:
+        """
+        if not os.path.exists(self.spool_file):
+            return
+        spool_df = pd.read_csv(self.spool_file)
+        if len(spool_df) > 0:
+            spool_df = spool_df.drop_duplicates('id').sort_values('id', ascending=False).reset_index(drop=True)
+            for file_name in self.storage.save(spool_df):
+                self.logger.logger.info(' save on {}'.format(file_name))
+        os.remove(self.spool_file)
+        self.spool_lines = 0
+
+    def close(self):
+        # type: () -> None
+        """
+        スプールを保存し、書き込み中の足のファイルを閉じる. 確定していない足は次の実行へ引き継ぐ
+        :return:
+        """
+        self.flush_spool()
+        for writer in self.writers:
+            writer.close()
+        with open(self.state_file, 'w') as f:
+            json.dump({'last_id': self.last_id,
+                       'builders': {x.time_axis: x.get_state() for x in self.builders}}, f)
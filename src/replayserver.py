@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This module provides a local stand-in of the bitflyer realtime api for offline tests.
+The synthetic history is replayed on the wall clock and published to lightning_executions channels
+over json-rpc websocket (/json-rpc). /v1/getexecutions returns only executions published so far.
+"""
+
+import json
+import time
+import base64
+import select
+import struct
+import hashlib
+import argparse
+import numpy as np
+import logger
+import mockserver
+from synthetic import SyntheticExecutions
+
+
+class ReplayBitflyerHandler(mockserver.MockBitflyerHandler):
+    """
+    This class passes websocket upgrades to ReplayBitflyerServer and other requests to MockBitflyerServer.
+    """
+
+    def do_GET(self):
+        # type: () -> None
+        if self.headers.get('Upgrade', '').lower() == 'websocket' and self.path.startswith('/json-rpc'):
+            try:
+                self.mock.serve_websocket(self)
+            except (OSError, ValueError):
+                # クライアントが切断した
+                pass
+            return
+        super(ReplayBitflyerHandler, self).do_GET()
+
+
+class ReplayBitflyerServer(mockserver.MockBitflyerServer):
+    """
+    This class replays the synthetic history from start_id as if the executions happened now.
+    """
+
+    channel_prefix = 'lightning_executions_'
+    handler_class = ReplayBitflyerHandler
+
+    def __init__(self, executions, host='127.0.0.1', port=0, start_id=1, speed=1.0, interval=0.1,
+                 disconnect_interval=0.0, **kwargs):
+        # type: (SyntheticExecutions, str, int, int, float, float, float, **object) -> None
+        """
+        Class initialization.
+        :param executions: 再生する約定の履歴
+        :param host: ホスト
+        :param port: ポート. 0の場合は空いているポート
+        :param start_id: 起動した時点で約定したことにするid. これより前の約定は過去の約定になる
+        :param speed: 再生の速さ. 2であれば2倍の速さで約定し、日時の間隔も半分になる
+        :param interval: 約定を配信する間隔(秒)
+        :param disconnect_interval: websocketを切断する間隔(秒). 再接続のテストに使う. 0の場合は切断しない
+        :param kwargs: MockBitflyerServerの引数
+        """
+        super(ReplayBitflyerServer, self).__init__(executions, host, port, **kwargs)
+        self.raw_date_ms = executions.date_ms
+        self.start_id = start_id
+        self.speed = speed
+        self.interval = interval
+        self.disconnect_interval = disconnect_interval
+        self.is_stopped = False
+        self.shift_dates(time.time())
+
+    def shift_dates(self, start_time):
+        # type: (float) -> None
+        """
+        start_idの約定がstart_timeに起きたように日時をずらす
+        :param start_time: エポック秒
+        :return:
+        """
+        start_ms = self.raw_date_ms[self.start_id - 1]
+        self.executions.date_ms = (int(start_time * 1000)
+                                   + ((self.raw_date_ms - start_ms) / self.speed).astype(np.int64))
+
+    def start(self):
+        # type: () -> ReplayBitflyerServer
+        """
+        再生を開始する
+        :return: self
+        """
+        self.shift_dates(time.time())
+        return super(ReplayBitflyerServer, self).start()
+
+    def stop(self):
+        # type: () -> None
+        self.is_stopped = True
+        super(ReplayBitflyerServer, self).stop()
+
+    @property
+    def head_id(self):
+        # type: () -> int
+        """
+        現在までに約定したidの最大値
+        :return: id
+        """
+        return int(np.searchsorted(self.executions.date_ms, int(time.time() * 1000), side='right'))
+
+    def handle(self, path, query):
+        # type: (str, dict) -> tuple
+        # まだ約定していないidは返さない
+        head_id = self.head_id
+        try:
+            before = int(query.get('before', ['0'])[0])
+        except ValueError:
+            before = 0
+        if before <= 0 or before > head_id + 1:
+            query = dict(query, before=[str(head_id + 1)])
+        return super(ReplayBitflyerServer, self).handle(path, query)
+
+    def serve_websocket(self, handler):
+        # type: (ReplayBitflyerHandler) -> None
+        """
+        websocketのハンドシェイクをし、購読されたチャンネルへ新しい約定を配信する
+        :param handler: リクエストのハンドラ
+        :return:
+        """
+        key = handler.headers.get('Sec-WebSocket-Key', '')
+        accept = base64.b64encode(hashlib.sha1((key + '258EAFA5-E914-47DA-95CA-C5AB0DC85B11').encode()).digest())
+        handler.send_response(101)
+        handler.send_header('Upgrade', 'websocket')
+        handler.send_header('Connection', 'Upgrade')
+        handler.send_header('Sec-WebSocket-Accept', accept.decode())
+        handler.end_headers()
+        handler.wfile.flush()
+        handler.close_connection = True
+
+        connection = handler.connection
+        connection.settimeout(None)
+        connect_time = time.time()
+        channel_list = []
+        last_id = None
+
+        while not self.is_stopped:
+            if self.disconnect_interval > 0 and time.time() - connect_time >= self.disconnect_interval:
+                send_frame(connection, 0x8, struct.pack('!H', 1001))
+                return
+
+            readable, _, _ = select.select([connection], [], [], self.interval)
+            if readable:
+                opcode, payload = read_frame(connection)
+                if opcode is None or opcode == 0x8:
+                    return
+                if opcode == 0x9:
+                    send_frame(connection, 0xA, payload)
+                    continue
+                if opcode != 0x1:
+                    continue
+
+                request = json.loads(payload.decode('utf-8'))
+                if request.get('method') == 'subscribe':
+                    channel = request.get('params', {}).get('channel', '')
+                    is_valid = channel[len(self.channel_prefix):] in self.product_list
+                    if is_valid and channel.startswith(self.channel_prefix) and channel not in channel_list:
+                        channel_list.append(channel)
+                        # 購読した時点より後の約定から配信する
+                        if last_id is None:
+                            last_id = self.head_id
+                    send_frame(connection, 0x1, self.to_body({'jsonrpc': '2.0', 'id': request.get('id'),
+                                                              'result': is_valid}))
+
+            if last_id is None:
+                continue
+            head_id = self.head_id
+            if head_id <= last_id:
+                continue
+            # idの昇順で配信する
+            message = self.executions.get_frame(last_id + 1, head_id).iloc[::-1].to_dict('records')
+            last_id = head_id
+            for channel in channel_list:
+                send_frame(connection, 0x1, self.to_body({'jsonrpc': '2.0', 'method': 'channelMessage',
+                                                          'params': {'channel': channel, 'message': message}}))
+
+
+def send_frame(connection, opcode, payload):
+    # type: (socket.socket, int, bytes) -> None
+    """
+    websocketのフレームを送る. サーバからはマスクしない
+    :param connection: ソケット
+    :param opcode: 1: テキスト, 8: 切断, 9: ping, 10: pong
+    :param payload: 本文
+    :return:
+    """
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('!BB', 0x80 | opcode, length)
+    elif length < 2 ** 16:
+        header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+    connection.sendall(header + payload)
+
+
+def read_frame(connection):
+    # type: (socket.socket) -> tuple
+    """
+    クライアントからのwebsocketのフレームを一つ読む. クライアントのフレームはマスクされている
+    :param connection: ソケット
+    :return: (opcode, 本文). 切断された場合は(None, None)
+    """
+    header = read_exact(connection, 2)
+    if header is None:
+        return None, None
+    opcode, length = header[0] & 0x0F, header[1] & 0x7F
+    if length == 126:
+        length = struct.unpack('!H', read_exact(connection, 2))[0]
+    elif length == 127:
+        length = struct.unpack('!Q', read_exact(connection, 8))[0]
+    mask = read_exact(connection, 4) if header[1] & 0x80 else b'\x00' * 4
+    payload = read_exact(connection, length) if length > 0 else b''
+    if mask is None or payload is None:
+        return None, None
+    return opcode, bytes(x ^ mask[i % 4] for i, x in enumerate(payload))
+
+
+def read_exact(connection, size):
+    # type: (socket.socket, int) -> bytes
+    """
+    ソケットから指定したバイト数を読む
+    :param connection: ソケット
+    :param size: バイト数
+    :return: バイト列. 切断された場合はNone
+    """
+    data = b''
+    while len(data) < size:
+        chunk = connection.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--port', help='port number', action='store', type=int, default=8080)
+    parser.add_argument('-n', '--executions', help='number of synthetic executions', action='store', type=int,
+                        default=2000000)
+    parser.add_argument('--seed', help='random seed of the history', action='store', type=int, default=0)
+    parser.add_argument('--start-id', help='id of the execution which happens at the start', action='store',
+                        type=int, default=1000000)
+    parser.add_argument('--speed', help='replay speed', action='store', type=float, default=1.0)
+    parser.add_argument('--disconnect', help='disconnect websockets every this seconds. 0 never disconnects',
+                        action='store', type=float, default=0.0)
+
+    args = parser.parse_args()
+    logger = logger.Logger()
+
+    server = ReplayBitflyerServer(SyntheticExecutions(args.executions, args.seed), port=args.port,
+                                  start_id=args.start_id, speed=args.speed, disconnect_interval=args.disconnect)
+    logger.logger.info('replaying {} executions from id {} on {}'.format(args.executions, args.start_id,
+                                                                         server.url))
+    server.shift_dates(time.time())
+    server.httpd.serve_forever()
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This module provides storage of btc execution data.
+csv keeps the api response as it is.
+parquet stores typed columns (int64 id and exec_date) partitioned by day.
+"""
+
+import os
+import argparse
+import pandas as pd
+from datetime import datetime as dt
+import datetime
+import logger
+from dateconverter import DateConverter
+
+
+class BtcStorage(object):
+    """
+    This class saves and loads btc execution data.
+    """
+
+    def __init__(self, data_dir, storage_format='csv'):
+        # type: (str, str) -> None
+        """
+        Class initialization.
+        :param data_dir: 保存先のディレクトリ
+        :param storage_format: csv or parquet
+        """
+        self.data_dir = data_dir
+        self.storage_format = storage_format
+        self.format_list = ['csv', 'parquet']
+        self.compression = 'zstd'
+        # 日単位のパーティションのディレクトリ名
+        self.partition_prefix = 'date='
+
+        if self.storage_format not in self.format_list:
+            raise ValueError('Unexpected storage format is specified: {}'.format(self.storage_format))
+
+    def save(self, result_df):
+        # type: (df) -> list
+        """
+        btcデータを保存する. parquetの場合は日本時間の日付ごとのディレクトリに分けて保存する
+        :param result_df: データを格納したデータフレーム. idの降順
+        :return: 保存したファイルのリスト
+        """
+        if self.storage_format == 'csv':
+            # 日付フォーマット
+            first_date = DateConverter.to_jst_datetime(result_df['exec_date'].iloc[0], 'm')
+            last_date = DateConverter.to_jst_datetime(result_df['exec_date'].iloc[-1], 'm')
+
+            # ファイル名作成
+            str_first_date = str(first_date).replace(' ', '-').replace(':00', '')
+            str_last_date = str(last_date).replace(' ', '-').replace(':00', '')
+            file_name = os.path.join(self.data_dir, 'btc_{}_{}.csv'.format(str_first_date, str_last_date))
+
+            # ファイル名は分単位なので、同じ範囲のファイルがあれば上書きせずにまとめる
+            if os.path.exists(file_name):
+                result_df = pd.concat([pd.read_csv(file_name), result_df]).drop_duplicates('id')
+                result_df = result_df.sort_values('id', ascending=False)
+
+            result_df.to_csv(file_name, index=False)
+            return [file_name]
+
+        typed_df = self.to_typed(result_df)
+        partition_dates = pd.Series(DateConverter.to_jst(typed_df['exec_date'], 'd')).dt.strftime('%Y-%m-%d')
+
+        file_list = []
+        for partition_date, partition_df in typed_df.groupby(partition_dates.values, sort=False):
+            partition_dir = os.path.join(self.data_dir, self.partition_prefix + partition_date)
+            if not os.path.exists(partition_dir):
+                os.makedirs(partition_dir)
+
+            # ファイル名は先頭と末尾のid
+            file_name = os.path.join(partition_dir, 'btc_{}_{}.parquet'.format(
+                partition_df['id'].iloc[0], partition_df['id'].iloc[-1]))
+            partition_df.to_parquet(file_name, index=False, compression=self.compression)
+            file_list.append(file_name)
+
+        return file_list
+
+    def list_files(self):
+        # type: () -> list
+        """
+        保存されているファイルを古い順に返す. 順番はファイル名の日付(parquetはディレクトリの日付とid)で決める
+        :return: data_dirからの相対パスのリスト
+        """
+        if self.storage_format == 'csv':
+            file_list = [x for x in os.listdir(self.data_dir) if x.startswith('btc_') and x.endswith('.csv')]
+        else:
+            file_list = []
+            for partition in os.listdir(self.data_dir):
+                if not partition.startswith(self.partition_prefix):
+                    continue
+                partition_dir = os.path.join(self.data_dir, partition)
+                file_list += [os.path.join(partition, x) for x in os.listdir(partition_dir) if x.endswith('.parquet')]
+
+        return sorted(file_list, key=self.get_sort_key)
+
+    def get_file_span(self, file_name):
+        # type: (str) -> tuple
+        """
+        ファイル名からファイルに含まれるデータの期間を求める
+        :param file_name: data_dirからの相対パス
+        :return: (最も古い日時, 最も新しい日時). 日本時間. csvは分単位, parquetは日単位
+        """
+        if file_name.endswith('.parquet'):
+            partition = os.path.dirname(file_name)[len(self.partition_prefix):]
+            first_date = dt.strptime(partition, '%Y-%m-%d')
+            return first_date, first_date + datetime.timedelta(days=1) - datetime.timedelta(minutes=1)
+
+        # btc_{最も新しい日時}_{最も古い日時}.csv. 0分は時までに省略されている
+        newest, oldest = os.path.basename(file_name)[len('btc_'):-len('.csv')].split('_')
+        return self.parse_file_date(oldest), self.parse_file_date(newest)
+
+    def get_sort_key(self, file_name):
+        # type: (str) -> tuple
+        """
+        ファイルを古い順に並べるためのキー
+        :param file_name: data_dirからの相対パス
+        :return: (最も古い日時, 最も新しい日時, 最も古いid)
+        """
+        first_date, last_date = self.get_file_span(file_name)
+        if file_name.endswith('.parquet'):
+            # btc_{先頭(最も新しい)id}_{末尾(最も古い)id}.parquet
+            return first_date, last_date, int(os.path.basename(file_name)[:-len('.parquet')].split('_')[2])
+        return first_date, last_date, 0
+
+    def get_newest_id(self):
+        # type: () -> int
+        """
+        保存されているデータで最も新しいidを返す
+        :return: 最も新しいid. データが無ければNone
+        """
+        file_list = self.list_files()
+        if not file_list:
+            return None
+        return int(self.load(file_list[-1], columns=['id'])['id'].max())
+
+    @staticmethod
+    def parse_file_date(str_date):
+        # type: (str) -> dt
+        """
+        ファイル名の日時を変換する
+        :param str_date: YYYY-MM-DD-HH:MM or YYYY-MM-DD-HH
+        :return: datetime
+        """
+        if ':' in str_date:
+            return dt.strptime(str_date, '%Y-%m-%d-%H:%M')
+        return dt.strptime(str_date, '%Y-%m-%d-%H')
+
+    def load(self, file_name, columns=None, filters=None):
+        # type: (str, list, list) -> df
+        """
+        btcデータを読み込む
+        :param file_name: data_dirからの相対パス
+        :param columns: 読み込む列. 指定がなければ全て
+        :param filters: parquetで読み込む行の条件. pyarrowの形式. csvでは使わない
+        :return: btcデータフレーム
+        """
+        input_path = os.path.join(self.data_dir, file_name)
+        if input_path.endswith('.parquet'):
+            return pd.read_parquet(input_path, columns=columns, filters=filters)
+        return pd.read_csv(input_path, usecols=columns)
+
+    @staticmethod
+    def to_typed(result_df):
+        # type: (df) -> df
+        """
+        APIのデータをparquetで保存する型へ変換する. exec_dateはUTCのエポックナノ秒
+        :param result_df: APIのデータを格納したデータフレーム
+        :return: 型を変換したデータフレーム
+        """
+        typed_df = result_df.reset_index(drop=True).copy()
+        typed_df['id'] = typed_df['id'].astype('int64')
+        typed_df['price'] = typed_df['price'].astype('float64')
+        typed_df['size'] = typed_df['size'].astype('float64')
+        typed_df['exec_date'] = DateConverter.to_epoch_ns(typed_df['exec_date'])
+        return typed_df
+
+    @staticmethod
+    def to_csv_frame(typed_df):
+        # type: (df) -> df
+        """
+        parquetで保存したデータをcsvと同じ形式へ戻す
+        :param typed_df: 型を変換したデータフレーム
+        :return: exec_dateをISO形式の文字列に戻したデータフレーム
+        """
+        csv_df = typed_df.copy()
+        csv_df['exec_date'] = DateConverter.to_iso(csv_df['exec_date'].values)
+        return csv_df
+
+
+if __name__ == '__main__':
+    # parquetで保存したデータをcsvへ書き出す
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--dir', help='directory of parquet data.',
+                        action='store',
+                        required=True)
+    parser.add_argument('-o', '--output', help='directory to export csv.',
+                        action='store',
+                        required=True)
+
+    args = parser.parse_args()
+    logger = logger.Logger()
+    logger.logger.info('START export csv')
+
+    assert os.path.exists(args.output), 'Please make directry: {}'.format(args.output)
+
+    parquet_storage = BtcStorage(args.dir, 'parquet')
+    csv_storage = BtcStorage(args.output, 'csv')
+    for file_name in parquet_storage.list_files():
+        for saved_file in csv_storage.save(BtcStorage.to_csv_frame(parquet_storage.load(file_name))):
+            logger.logger.info(' save on {}'.format(saved_file))
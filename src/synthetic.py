@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This module provides a deterministic synthetic execution history for offline tests and benchmarks.
+The same seed and size always give the same executions.
+Like bitflyer, all products share one id space and each product has an interleaved subsequence of the ids.
+"""
+
+import numpy as np
+import pandas as pd
+from datetime import datetime as dt
+from dateconverter import DateConverter
+
+
+class SyntheticExecutions(object):
+    """
+    This class generates executions with ids from 1 to size in the bitflyer format.
+    Each id belongs to one of product_list.
+    """
+
+    keys = ['id', 'side', 'price', 'size', 'exec_date', 'buy_child_order_acceptance_id',
+            'sell_child_order_acceptance_id']
+
+    def __init__(self, size=2000000, seed=0, start_date=dt(2018, 1, 1), mean_interval=0.5, start_price=1000000.0,
+                 product_list=None, product_weights=None):
+        # type: (int, int, dt, float, float, list, list) -> None
+        """
+        Class initialization.
+        :param size: 約定数. idは1からsizeまで
+        :param seed: 乱数のシード
+        :param start_date: 最初の約定の日時(UTC)
+        :param mean_interval: 約定の平均間隔(秒)
+        :param start_price: 最初の価格
+        :param product_list: idを分け合うプロダクト. 指定がなければFX_BTC_JPYが全てのidを持つ
+        :param product_weights: プロダクトごとの約定の割合. 指定がなければ等分
+        """
+        self.size = size
+        random_state = np.random.RandomState(seed)
+        start_ms = int((np.datetime64(start_date, 'ms') - np.datetime64(0, 'ms')).astype(np.int64))
+        self.date_ms, self.price, self.exec_size, self.is_buy = self.generate(
+            random_state, size, start_ms, start_price, mean_interval)
+
+        # idごとのプロダクト. 約定の内容とは別の乱数で決め、プロダクトを変えても同じ履歴にする
+        self.product_list = product_list or ['FX_BTC_JPY']
+        if len(self.product_list) == 1:
+            product_index = np.zeros(size, dtype=np.int8)
+        else:
+            product_index = np.random.RandomState(seed + 1).choice(
+                len(self.product_list), size, p=product_weights).astype(np.int8)
+        # プロダクト -> idの昇順の配列
+        self.product_ids = {x: np.flatnonzero(product_index == i) + 1 for i, x in enumerate(self.product_list)}
+
+    @staticmethod
+    def generate(random_state, size, start_ms, start_price, mean_interval=0.5):
+        # type: (RandomState, int, int, float, float) -> tuple
+        """
+        約定を生成する. 前回の最後の日時と価格から続けて生成できる
+        :param random_state: 乱数
+        :param size: 約定数
+        :param start_ms: 直前の約定の日時(UTCのエポックミリ秒)
+        :param start_price: 直前の価格
+        :param mean_interval: 約定の平均間隔(秒)
+        :return: (日時のエポックミリ秒, 価格, 数量, 買いか)
+        """
+        # 約定の間隔は指数分布, ミリ秒単位に丸めるので日時は単調増加(同じ日時は有り得る)
+        interval_ms = np.round(random_state.exponential(mean_interval * 1000, size)).astype(np.int64)
+        date_ms = start_ms + np.cumsum(interval_ms)
+
+        # 価格は1円単位のランダムウォーク
+        steps = np.round(random_state.normal(0, 200.0, size))
+        price = np.maximum(start_price + np.cumsum(steps), 1.0)
+        exec_size = np.round(random_state.exponential(0.05, size), 8) + 0.00000001
+        is_buy = random_state.rand(size) < 0.5
+        return date_ms, price, exec_size, is_buy
+
+    def get_page_ids(self, before=0, after=0, count=100, product_code=None):
+        # type: (int, int, int, str) -> ndarray
+        """
+        APIと同じ意味のbefore, after, countから返すidを求める. 他のプロダクトのidは飛ばす
+        :param before: このidより前(含まない). 0の場合は最新から
+        :param after: このidより後(含まない)
+        :param count: 件数
+        :param product_code: プロダクト. 指定がなければ最初のプロダクト
+        :return: idの降順の配列
+        """
+        product_ids = self.product_ids[product_code or self.product_list[0]]
+        newest = len(product_ids) if before <= 0 else int(np.searchsorted(product_ids, before, side='left'))
+        oldest = max(newest - count, int(np.searchsorted(product_ids, after, side='right')), 0)
+        return product_ids[oldest:newest][::-1]
+
+    def get_page(self, before=0, after=0, count=100, product_code=None):
+        # type: (int, int, int, str) -> list
+        """
+        APIと同じ形式のページを返す
+        :param before: このidより前(含まない). 0の場合は最新から
+        :param after: このidより後(含まない)
+        :param count: 件数
+        :param product_code: プロダクト. 指定がなければ最初のプロダクト
+        :return: 約定の辞書のリスト. idの降順
+        """
+        exec_id = self.get_page_ids(before, after, count, product_code)
+        if len(exec_id) == 0:
+            return []
+        return self.get_frame_of_ids(exec_id).to_dict('records')
+
+    def get_frame(self, first_id, last_id, product_code=None):
+        # type: (int, int, str) -> df
+        """
+        idの範囲の約定をデータフレームで返す
+        :param first_id: 最も古いid(含む)
+        :param last_id: 最も新しいid(含む)
+        :param product_code: プロダクト. 指定がなければ全てのプロダクトのid
+        :return: getbtcで保存するのと同じ列のデータフレーム. idの降順
+        """
+        if product_code is None:
+            return self.get_frame_of_ids(np.arange(last_id, first_id - 1, -1))
+        product_ids = self.product_ids[product_code]
+        return self.get_frame_of_ids(product_ids[np.searchsorted(product_ids, first_id, side='left'):
+                                                 np.searchsorted(product_ids, last_id, side='right')][::-1])
+
+    def get_frame_of_ids(self, exec_id):
+        # type: (ndarray) -> df
+        """
+        idの約定をデータフレームで返す
+        :param exec_id: idの配列
+        :return: getbtcで保存するのと同じ列のデータフレーム. exec_idの順
+        """
+        index = exec_id - 1
+        return self.build_frame(exec_id, self.date_ms[index], self.price[index], self.exec_size[index],
+                                self.is_buy[index])
+
+    @classmethod
+    def build_frame(cls, exec_id, date_ms, price, exec_size, is_buy):
+        # type: (ndarray, ndarray, ndarray, ndarray, ndarray) -> df
+        """
+        約定の配列をAPIと同じ列のデータフレームにする
+        :param exec_id: id
+        :param date_ms: 日時(UTCのエポックミリ秒)
+        :param price: 価格
+        :param exec_size: 数量
+        :param is_buy: 買いか
+        :return: データフレーム
+        """
+        str_id = pd.Series(exec_id).astype(str).str.zfill(10)
+        return pd.DataFrame({'id': exec_id,
+                             'side': np.where(is_buy, 'BUY', 'SELL'),
+                             'price': price,
+                             'size': exec_size,
+                             'exec_date': cls.format_date(date_ms),
+                             'buy_child_order_acceptance_id': ('JRF' + str_id + 'B').values,
+                             'sell_child_order_acceptance_id': ('JRF' + str_id + 'S').values},
+                            columns=cls.keys)
+
+    def find_id(self, base_date):
+        # type: (dt) -> int
+        """
+        指定された日時(UTC)以降で最初の約定のid
+        :param base_date: 日時
+        :return: id. 全ての約定がそれより前であればsize + 1
+        """
+        base_ms = int((np.datetime64(base_date, 'ms') - np.datetime64(0, 'ms')).astype(np.int64))
+        return int(np.searchsorted(self.date_ms, base_ms, side='left')) + 1
+
+    @staticmethod
+    def format_date(date_ms):
+        # type: (ndarray) -> ndarray
+        """
+        エポックミリ秒をbitflyerと同じ形式(ミリ秒まで, 末尾の0を省く, タイムゾーン無し)の文字列にする
+        :param date_ms: エポックミリ秒
+        :return: 文字列の配列
+        """
+        return DateConverter.to_iso(date_ms.astype(np.int64) * 10 ** 6)
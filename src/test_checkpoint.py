@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the checkpoint of getbtc. A restarted run has to resume from the last recorded page.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+from checkpoint import FetchCheckpoint
+
+key = {'start_date': '2018-01-01T00:00:00', 'finish_date': None, 'count': 3}
+
+
+def get_page(before_id, count=3):
+    # type: (int, int) -> df
+    exec_id = np.arange(before_id - 1, before_id - count - 1, -1)
+    return pd.DataFrame({'id': exec_id, 'price': 1000000.0, 'size': 0.01})
+
+
+def test_resume_from_cursor(tmp_path):
+    checkpoint = FetchCheckpoint(str(tmp_path), 'FX_BTC_JPY')
+    checkpoint.start(key, 1, 101)
+    checkpoint.append_page(get_page(101), 98)
+    checkpoint.append_page(get_page(98), 95)
+    checkpoint.flush(['btc_1.csv'], 95)
+
+    # ページごとにはチェックポイントを書き直さない
+    modified_time = os.stat(checkpoint.checkpoint_file).st_mtime_ns
+    checkpoint.append_page(get_page(95), 92)
+    checkpoint.append_page(get_page(92), 89)
+    assert os.stat(checkpoint.checkpoint_file).st_mtime_ns == modified_time
+
+    # 止まった実行の続きから再開する
+    resumed = FetchCheckpoint(str(tmp_path), 'FX_BTC_JPY')
+    assert resumed.load(dict(key, count=4)) is None
+    state = resumed.load(key)
+    assert state['before'] == 89
+    assert state['files'] == ['btc_1.csv']
+    assert resumed.load_spool()['id'].tolist() == list(range(94, 88, -1))
+
+    # 保存したらページとカーソルは破棄する
+    resumed.flush(['btc_2.csv'], 89)
+    assert not os.path.exists(resumed.spool_file)
+    assert not os.path.exists(resumed.cursor_file)
+    state = FetchCheckpoint(str(tmp_path), 'FX_BTC_JPY').load(key)
+    assert state['before'] == 89 and state['files'] == ['btc_1.csv', 'btc_2.csv']
+
+    resumed.clear()
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_start_discards_previous_run(tmp_path):
+    checkpoint = FetchCheckpoint(str(tmp_path), 'FX_BTC_JPY')
+    checkpoint.start(key, 1, 101)
+    checkpoint.append_page(get_page(101), 98)
+
+    # 引数が違う実行は前回のページとカーソルを使わない
+    other_key = dict(key, count=4)
+    restarted = FetchCheckpoint(str(tmp_path), 'FX_BTC_JPY')
+    assert restarted.load(other_key) is None
+    restarted.start(other_key, 1, 201)
+    assert restarted.load(other_key)['before'] == 201
+    assert restarted.load_spool() is None
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the exec_date conversion. Dates from the api have to come back unchanged.
+"""
+
+import numpy as np
+import pandas as pd
+
+from dateconverter import DateConverter
+from storage import BtcStorage
+from ticks import TickArray
+
+# APIと同じ形式の日付. 小数点以下の末尾の0は省かれ、桁数は行ごとに違う
+api_dates = ['2018-01-01T00:57:42.588', '2018-01-01T00:57:59.97', '2018-01-01T00:58:00.1', '2018-01-01T00:58:01',
+             '2018-01-01T00:58:01.000001', '2018-01-01T00:58:01.123456789']
+
+
+def test_to_iso_round_trip():
+    epoch_ns = DateConverter.to_epoch_ns(api_dates)
+    expected = pd.to_datetime(pd.Series(api_dates), format='ISO8601').values.astype(np.int64)
+    assert np.array_equal(epoch_ns, expected)
+    assert DateConverter.to_iso(epoch_ns).tolist() == api_dates
+
+
+def test_to_iso_normalizes_other_forms():
+    dates = ['2018-01-01T00:57:59.970', '2018-01-01T00:58:01.000Z', '2018-01-01T09:58:02+09:00']
+    assert DateConverter.to_iso(DateConverter.to_epoch_ns(dates)).tolist() == \
+        ['2018-01-01T00:57:59.97', '2018-01-01T00:58:01', '2018-01-01T00:58:02']
+
+
+def test_frame_round_trip():
+    df_btc = pd.DataFrame({'id': np.arange(len(api_dates), 0, -1), 'side': ['BUY', 'SELL', '', 'BUY', 'SELL', 'BUY'],
+                           'price': 1000000.0, 'size': 0.01, 'exec_date': api_dates,
+                           'buy_child_order_acceptance_id': 'JRF20180101-000000-000001',
+                           'sell_child_order_acceptance_id': 'JRF20180101-000000-000002'})
+
+    # TickArrayを経由しても保存するデータは変わらない
+    frame = TickArray.from_frame(df_btc).to_frame()
+    assert frame['exec_date'].tolist() == api_dates
+    assert frame.to_csv(index=False) == df_btc[frame.columns].to_csv(index=False)
+
+    # parquetの型からcsvへ戻しても変わらない
+    assert BtcStorage.to_csv_frame(BtcStorage.to_typed(df_btc))['exec_date'].tolist() == api_dates
+
+
+def test_to_epoch_ns_with_offset():
+    # 小数点以下の後にタイムゾーンの表記がある場合も正しく変換する
+    dates = ['2018-01-01T09:57:42.588+09:00', '2018-01-01T00:57:42.588Z', '2018-01-01T00:57:42.588',
+             '2018-01-01T00:57:42.5880000001', '2018-01-01T05:57:42.588+05:00']
+    expected = pd.to_datetime(pd.Series(dates), format='ISO8601', utc=True).dt.tz_localize(None)
+    assert np.array_equal(DateConverter.to_epoch_ns(dates), expected.values.astype('datetime64[ns]').astype(np.int64))
+    for date in dates:
+        assert DateConverter.to_epoch_ns([date])[0] == DateConverter.to_epoch_ns(dates[2:3])[0]
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the id search of getbtc against the mock server.
+"""
+
+import os
+from datetime import datetime as dt, timedelta as td
+
+import numpy as np
+import pytest
+
+import getbtc
+import logger
+from mockserver import MockBitflyerServer
+from synthetic import SyntheticExecutions
+
+
+@pytest.fixture(scope='module')
+def executions():
+    # ETH_JPYのidは1-3000と15000-20000だけ. その間は全てFX_BTC_JPYのid
+    executions = SyntheticExecutions(20000, product_list=['FX_BTC_JPY', 'ETH_JPY'])
+    executions.product_ids['ETH_JPY'] = np.concatenate([np.arange(1, 3001), np.arange(15000, 20001)])
+    executions.product_ids['FX_BTC_JPY'] = np.arange(3001, 15000)
+    return executions
+
+
+@pytest.fixture(scope='module')
+def mock(executions):
+    mock = MockBitflyerServer(executions).start()
+    yield mock
+    mock.stop()
+
+
+def search(mock, tmp_path, base_date, max_probes=100):
+    # type: (MockBitflyerServer, str, dt, int) -> tuple
+    """
+    ETH_JPYで基準日のidを検索する. 検索が終わらない場合はmax_probesで打ち切る
+    """
+    get_btc = getbtc.GetBtcDataFromBitflyer(None, None, logger.Logger(level='WARNING', log_file=os.devnull),
+                                            index_dir=str(tmp_path), data_dir=str(tmp_path), product_code='ETH_JPY',
+                                            show_progress=False)
+    get_btc.domain_url = mock.url
+    request_search_page = get_btc.request_search_page
+
+    def request_with_limit(before_id):
+        assert get_btc.search_probe_count < max_probes, 'search does not converge'
+        return request_search_page(before_id)
+
+    get_btc.request_search_page = request_with_limit
+    return get_btc.search_before_id(base_date), get_btc.search_probe_count
+
+
+@pytest.mark.parametrize('date_id', [2000, 3001, 5000, 9000, 14999, 17000])
+def test_search_sparse_ids(executions, mock, tmp_path, date_id):
+    # 分の境界の基準日(日本時間)
+    date_ms = executions.date_ms[date_id - 1] // 60000 * 60000 + 60000
+    base_date = dt(1970, 1, 1) + td(milliseconds=int(date_ms)) + td(hours=9)
+
+    product_ids = executions.product_ids['ETH_JPY']
+    expected_id = int(product_ids[np.searchsorted(executions.date_ms[product_ids - 1], date_ms)])
+
+    found_id, probe_count = search(mock, tmp_path, base_date)
+    assert found_id == expected_id
+    assert probe_count < 20
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the mock server. Each product has to return only its own ids.
+"""
+
+import json
+
+import numpy as np
+
+from mockserver import MockBitflyerServer
+from synthetic import SyntheticExecutions
+
+
+def get_ids(mock, product_code, before=0, after=0, count=500):
+    # type: (MockBitflyerServer, str, int, int, int) -> list
+    query = {'product_code': [product_code], 'before': [str(before)], 'after': [str(after)], 'count': [str(count)]}
+    status_code, _, body = mock.handle('/v1/getexecutions', query)
+    assert status_code == 200
+    return [x['id'] for x in json.loads(body)]
+
+
+def test_products_share_interleaved_ids():
+    executions = SyntheticExecutions(3000, product_list=['FX_BTC_JPY', 'BTC_JPY', 'ETH_JPY'])
+    mock = MockBitflyerServer(executions)
+    try:
+        id_list = {}
+        for product_code in executions.product_list:
+            before, exec_id = 0, []
+            while True:
+                page = get_ids(mock, product_code, before=before)
+                if not page:
+                    break
+                assert page == sorted(page, reverse=True)
+                exec_id += page
+                before = page[-1]
+            id_list[product_code] = exec_id
+
+        # 全てのidがどれか一つのプロダクトに属する
+        all_id = np.concatenate([x for x in id_list.values()])
+        assert len(all_id) == 3000
+        assert np.array_equal(np.sort(all_id), np.arange(1, 3001))
+        # 各プロダクトのidは飛び飛び
+        assert all((np.diff(x) < -1).any() for x in id_list.values())
+    finally:
+        mock.httpd.server_close()
+
+
+def test_paging_skips_other_products():
+    executions = SyntheticExecutions(3000, product_list=['FX_BTC_JPY', 'BTC_JPY'])
+    mock = MockBitflyerServer(executions)
+    try:
+        product_ids = executions.product_ids['BTC_JPY']
+        before, after = int(product_ids[100]), int(product_ids[40])
+        # before, afterが他のプロダクトのidでも、その間の自分のidだけを返す
+        assert get_ids(mock, 'BTC_JPY', before=before + 1, after=after - 1) == \
+            product_ids[40:101][::-1].tolist()
+        assert get_ids(mock, 'BTC_JPY', before=before, count=10) == product_ids[90:100][::-1].tolist()
+        assert get_ids(mock, 'BTC_JPY', after=after, count=10) == product_ids[-10:][::-1].tolist()
+        # 履歴の無いプロダクトはエラー
+        assert mock.handle('/v1/getexecutions', {'product_code': ['ETH_JPY']})[0] == 400
+    finally:
+        mock.httpd.server_close()
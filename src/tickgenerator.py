@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This module generates raw execution files of any size in the same layout as getbtc saves.
+Executions are generated file by file, so 100M rows can be written with bounded memory.
+"""
+
+import os
+import argparse
+import numpy as np
+from datetime import datetime as dt
+import logger
+import storage
+from synthetic import SyntheticExecutions
+
+
+class TickGenerator(object):
+    """
+    This class writes synthetic executions to btc files.
+    """
+
+    def __init__(self, root_logger, output_dir, storage_format='csv', file_lines=500000, seed=0,
+                 start_date=dt(2018, 1, 1), mean_interval=0.5, start_price=1000000.0):
+        # type: (logger, str, str, int, int, dt, float, float) -> None
+        """
+        Class initialization.
+        :param root_logger: ロガー
+        :param output_dir: 保存先のディレクトリ
+        :param storage_format: csv or parquet
+        :param file_lines: 一つのファイルの行数
+        :param seed: 乱数のシード
+        :param start_date: 最初の約定の日時(UTC)
+        :param mean_interval: 約定の平均間隔(秒)
+        :param start_price: 最初の価格
+        """
+        self.logger = root_logger
+        self.storage = storage.BtcStorage(output_dir, storage_format)
+        self.file_lines = file_lines
+        self.seed = seed
+        self.start_ms = int((np.datetime64(start_date, 'ms') - np.datetime64(0, 'ms')).astype(np.int64))
+        self.mean_interval = mean_interval
+        self.start_price = start_price
+
+    def run(self, rows):
+        # type: (int) -> list
+        """
+        idが1からrowsまでの約定をfile_linesごとにidの降順で保存する
+        :param rows: 約定数
+        :return: 保存したファイルのリスト
+        """
+        random_state = np.random.RandomState(self.seed)
+        last_ms, last_price = self.start_ms, self.start_price
+        file_list = []
+
+        for first_id in range(1, rows + 1, self.file_lines):
+            size = min(self.file_lines, rows - first_id + 1)
+            date_ms, price, exec_size, is_buy = SyntheticExecutions.generate(
+                random_state, size, last_ms, last_price, self.mean_interval)
+            last_ms, last_price = int(date_ms[-1]), float(price[-1])
+
+            # APIと同じidの降順にする
+            exec_id = np.arange(first_id, first_id + size, dtype=np.int64)
+            result_df = SyntheticExecutions.build_frame(exec_id[::-1], date_ms[::-1], price[::-1],
+                                                        exec_size[::-1], is_buy[::-1])
+            for file_name in self.storage.save(result_df):
+                self.logger.logger.info(' save on {}'.format(file_name))
+                file_list.append(file_name)
+
+        return file_list
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--rows', help='number of executions', action='store', type=int, required=True)
+    parser.add_argument('-o', '--output', help='directory to save btc files', action='store', required=True)
+    parser.add_argument('-f', '--format', help='storage format. csv or parquet', action='store',
+                        choices=['csv', 'parquet'], default='csv')
+    parser.add_argument('-l', '--lines', help='lines of a file', action='store', type=int, default=500000)
+    parser.add_argument('--seed', help='random seed', action='store', type=int, default=0)
+
+    args = parser.parse_args()
+    assert os.path.exists(args.output), 'Please make directry: {}'.format(args.output)
+    logger = logger.Logger()
+    logger.logger.info('START generate ticks')
+
+    TickGenerator(logger, args.output, args.format, args.lines, args.seed).run(args.rows)
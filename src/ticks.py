@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This module provides a compact in-memory representation of btc executions.
+Each column is a typed numpy array (int64 id and epoch nanoseconds, float64 price and size, int8 side)
+and acceptance ids are dictionary encoded, so a tick takes tens of bytes instead of python objects.
+Only the columns asked for are converted, e.g. hloc never materializes side and acceptance ids.
+"""
+
+import numpy as np
+import pandas as pd
+from dateconverter import DateConverter
+
+
+class TickArray(object):
+    """
+    This class holds executions as typed arrays of the same length.
+    """
+
+    # 保持できる列. date_nsはUTCのエポックナノ秒
+    columns = ['id', 'date_ns', 'price', 'size', 'side', 'buy_child_order_acceptance_id',
+               'sell_child_order_acceptance_id']
+    # 辞書で符号化する列
+    encoded_columns = ['buy_child_order_acceptance_id', 'sell_child_order_acceptance_id']
+    # 列 -> 保存したデータの列
+    source_columns = {'date_ns': 'exec_date'}
+    dtypes = {'id': np.int64, 'date_ns': np.int64, 'price': np.float64, 'size': np.float64, 'side': np.int8}
+    # 売買の符号. 板寄せ等で空の場合は0
+    side_codes = {'BUY': 1, 'SELL': -1}
+    side_names = np.array(['', 'BUY', 'SELL'], dtype=object)
+
+    def __init__(self, arrays):
+        # type: (dict) -> None
+        """
+        Class initialization.
+        :param arrays: 列 -> 配列. 辞書で符号化する列は(int32の符号, バイト列の辞書)のタプル
+        """
+        self.arrays = arrays
+
+    @classmethod
+    def get_source_columns(cls, columns=None):
+        # type: (list) -> list
+        """
+        列を読み込むのに必要な保存したデータの列
+        :param columns: TickArrayの列. 指定がなければ全て
+        :return: 保存したデータの列のリスト
+        """
+        return [cls.source_columns.get(x, x) for x in (columns or cls.columns)]
+
+    @classmethod
+    def from_frame(cls, df_btc, columns=None):
+        # type: (df, list) -> TickArray
+        """
+        保存したデータやAPIのデータフレームから作る. exec_dateはISO形式でもエポックナノ秒でもよい
+        :param df_btc: btcデータフレーム
+        :param columns: 残す列. 指定がなければデータフレームにある列を全て
+        :return: TickArray
+        """
+        if columns is None:
+            columns = [x for x in cls.columns if cls.source_columns.get(x, x) in df_btc.columns]
+
+        arrays = {}
+        for column in columns:
+            values = df_btc[cls.source_columns.get(column, column)].values
+            if column == 'date_ns':
+                arrays[column] = DateConverter.to_epoch_ns(values)
+            elif column == 'side':
+                arrays[column] = cls.encode_side(values)
+            elif column in cls.encoded_columns:
+                arrays[column] = cls.encode(values)
+            else:
+                arrays[column] = values.astype(cls.dtypes[column], copy=False)
+        return cls(arrays)
+
+    @classmethod
+    def from_rows(cls, rows, columns=None):
+        # type: (list, list) -> TickArray
+        """
+        APIのレスポンスから作る
+        :param rows: 約定の辞書のリスト
+        :param columns: 残す列. 指定がなければ全て
+        :return: TickArray
+        """
+        source_columns = cls.get_source_columns(columns)
+        return cls.from_frame(pd.DataFrame(rows, columns=source_columns), columns)
+
+    @classmethod
+    def concat(cls, tick_list):
+        # type: (list) -> TickArray
+        """
+        同じ列を持つTickArrayを繋げる. 辞書で符号化した列は辞書を作り直す
+        :param tick_list: TickArrayのリスト
+        :return: TickArray
+        """
+        tick_list = [x for x in tick_list if len(x) > 0] or tick_list[:1]
+        if len(tick_list) == 1:
+            return tick_list[0]
+
+        arrays = {}
+        for column in tick_list[0].arrays:
+            if column in cls.encoded_columns:
+                arrays[column] = cls.encode(np.concatenate([x.decode(column) for x in tick_list]))
+            else:
+                arrays[column] = np.concatenate([x.arrays[column] for x in tick_list])
+        return cls(arrays)
+
+    @staticmethod
+    def encode(values):
+        # type: (ndarray) -> tuple
+        """
+        文字列を辞書で符号化する. 同じ注文の約定は同じ受付idを持つ
+        :param values: 文字列またはバイト列の配列
+        :return: (int32の符号, バイト列の辞書)
+        """
+        values = np.asarray(values)
+        if values.dtype.kind not in 'SU':
+            values = pd.Series(values).fillna('').astype(str).values
+        categories, codes = np.unique(values.astype('S'), return_inverse=True)
+        return codes.astype(np.int32), categories
+
+    @classmethod
+    def encode_side(cls, values):
+        # type: (ndarray) -> ndarray
+        """
+        売買を符号にする
+        :param values: BUY, SELL または空
+        :return: int8の配列. BUY: 1, SELL: -1, 空: 0
+        """
+        values = np.asarray(values)
+        return (np.where(values == 'BUY', 1, 0) - np.where(values == 'SELL', 1, 0)).astype(np.int8)
+
+    def decode(self, column):
+        # type: (str) -> ndarray
+        """
+        辞書で符号化した列を戻す
+        :param column: 列
+        :return: バイト列の配列
+        """
+        codes, categories = self.arrays[column]
+        return categories[codes]
+
+    def __len__(self):
+        # type: () -> int
+        return len(self.arrays['id']) if 'id' in self.arrays else len(next(iter(self.arrays.values()), ()))
+
+    def __getitem__(self, index):
+        # type: (object) -> object
+        """
+        列の配列, または行を絞り込んだTickArray
+        :param index: 列名, スライス, 真偽値またはインデックスの配列
+        :return: 列名であれば配列(符号化した列は戻した配列), それ以外はTickArray
+        """
+        if isinstance(index, str):
+            return self.decode(index) if index in self.encoded_columns else self.arrays[index]
+
+        arrays = {}
+        for column, values in self.arrays.items():
+            if column in self.encoded_columns:
+                arrays[column] = (values[0][index], values[1])
+            else:
+                arrays[column] = values[index]
+        return TickArray(arrays)
+
+    @property
+    def nbytes(self):
+        # type: () -> int
+        """
+        配列のバイト数
+        :return: バイト数
+        """
+        total = 0
+        for column, values in self.arrays.items():
+            total += values[0].nbytes + values[1].nbytes if column in self.encoded_columns else values.nbytes
+        return total
+
+    def to_frame(self):
+        # type: () -> df
+        """
+        保存するデータと同じ形式(exec_dateはISO形式, sideはBUY/SELL)のデータフレームに戻す
+        :return: btcデータフレーム
+        """
+        data = {}
+        for column in self.columns:
+            if column not in self.arrays:
+                continue
+            if column == 'date_ns':
+                data['exec_date'] = DateConverter.to_iso(self.arrays[column])
+            elif column == 'side':
+                data[column] = self.side_names[self.arrays[column]]
+            elif column in self.encoded_columns:
+                data[column] = self.decode(column).astype(str).astype(object)
+            else:
+                data[column] = self.arrays[column]
+        return pd.DataFrame(data, columns=[x for x in self.get_source_columns() if x in data])
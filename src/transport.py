@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This module provides the http transport of bitflyer api.
+Connections are kept alive in a pooled session and failed requests are retried
+with exponential backoff and jitter according to the kind of the error.
+"""
+
+import time
+import random
+import requests
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit, urlunsplit
+from datetime import datetime as dt
+from requests.adapters import HTTPAdapter
+import metrics
+
+
+class TransportError(Exception):
+    """
+    リトライしても解決しないエラー. 4xx等
+    """
+    pass
+
+
+class BitflyerTransport(object):
+    """
+    This class sends requests to bitflyer api with a pooled session.
+    """
+
+    # リトライする前にRetry-Afterを確認するステータス
+    retry_after_status = [429, 503]
+
+    def __init__(self, root_logger, health_check_params=None, connect_timeout=5.0, read_timeout=30.0,
+                 backoff_base=0.5, backoff_max=60.0, max_retries=None, pool_size=10, rate_limiter=None):
+        # type: (logger, dict, float, float, float, float, int, int, RateLimiter) -> None
+        """
+        Class initialization.
+        :param root_logger: ロガー
+        :param health_check_params: サーバエラーの際にステータスを確認するパラメータ. リクエストのproduct_codeで上書きする
+        :param connect_timeout: 接続のタイムアウト(秒)
+        :param read_timeout: 読み込みのタイムアウト(秒)
+        :param backoff_base: 最初のリトライまでの待ち時間(秒). リトライごとに倍になる
+        :param backoff_max: リトライまでの待ち時間の上限(秒)
+        :param max_retries: リトライ回数の上限. Noneの場合は成功するまでリトライする
+        :param pool_size: 保持する接続数. 並列に取得する場合はワーカ数以上にする
+        :param rate_limiter: エンドポイントごとのリクエスト数の制限. 全てのリクエストの前に待つ
+        """
+        self.logger = root_logger
+        self.health_check_path = '/v1/gethealth'
+        self.health_check_params = health_check_params
+        self.timeout = (connect_timeout, read_timeout)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_retries = max_retries
+        self.rate_limiter = rate_limiter
+
+        # 接続を使い回すセッション. 圧縮したレスポンスを受け取る
+        self.session = requests.Session()
+        self.session.headers.update({'Accept-Encoding': 'gzip, deflate', 'Connection': 'keep-alive'})
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        # リトライした回数の合計
+        self.retry_count = 0
+        self.request_counter = metrics.REGISTRY.counter('bitflyer_requests_total', 'api requests by endpoint and status')
+        self.latency_histogram = metrics.REGISTRY.histogram('bitflyer_request_seconds', 'latency of api requests')
+        self.retry_counter = metrics.REGISTRY.counter('bitflyer_retries_total', 'retried api requests by kind')
+        self.backoff_counter = metrics.REGISTRY.counter('bitflyer_backoff_seconds_total', 'seconds slept before retry')
+
+    def get_json(self, url, params=None):
+        # type: (str, dict) -> list
+        """
+        APIを叩きJSONを返す. 接続エラー, 5xx, 429, 空のレスポンス, APIのエラーはバックオフしてリトライし,
+        それ以外の4xxは例外を投げる
+        :param url: APIのURL
+        :param params: リクエストパラメータ
+        :return: レスポンスのJSON
+        """
+        attempt = 0
+        while True:
+            retry_after = None
+            try:
+                response = self.send(url, params)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                kind = 'connection'
+                reason = 'connection error: {}'.format(e)
+            else:
+                kind = str(response.status_code)
+                if response.status_code in self.retry_after_status:
+                    reason = 'status {}'.format(response.status_code)
+                    retry_after = self.parse_retry_after(response.headers.get('Retry-After'))
+                    # 他のスレッドも同じ時間だけ止める
+                    if retry_after is not None and self.rate_limiter is not None:
+                        self.rate_limiter.block(urlsplit(url).path, retry_after)
+                elif response.status_code >= 500:
+                    reason = 'status {}'.format(response.status_code)
+                    self.check_health(url, params)
+                elif response.status_code >= 400:
+                    # リクエストが誤っているのでリトライしない
+                    raise TransportError('status {}: {}'.format(response.status_code, response.text[:200]))
+                else:
+                    try:
+                        body = response.json()
+                    except ValueError:
+                        # 空や途中で切れたレスポンス
+                        kind = 'invalid_body'
+                        reason = 'invalid body: {!r}'.format(response.text[:200])
+                    else:
+                        # bitflyerのエラーは負のstatusを持つオブジェクトで返る
+                        if not (isinstance(body, dict) and body.get('status', 0) < 0):
+                            return body
+                        kind = 'api_error'
+                        reason = 'api error: {}'.format(body.get('error_message'))
+
+            attempt += 1
+            if self.max_retries is not None and attempt > self.max_retries:
+                raise TransportError('gave up after {} retries: {}'.format(self.max_retries, reason))
+
+            wait_seconds = retry_after if retry_after is not None else self.get_backoff(attempt)
+            self.retry_count += 1
+            self.retry_counter.inc(kind=kind)
+            self.backoff_counter.inc(wait_seconds)
+            self.logger.error_every('api retry', 1.0,
+                                    ' An error occurred in api request ({}). retry {} in {:.1f} seconds',
+                                    reason, attempt, wait_seconds)
+            time.sleep(wait_seconds)
+
+    def send(self, url, params=None):
+        # type: (str, dict) -> requests.Response
+        """
+        レート制限を守ってリクエストを送り、レスポンスに応じてレートを調整する
+        :param url: APIのURL
+        :param params: リクエストパラメータ
+        :return: レスポンス
+        """
+        endpoint = urlsplit(url).path
+        if self.rate_limiter is not None:
+            # プロダクトごとに順番に予算を使う
+            self.rate_limiter.wait(endpoint, (params or {}).get('product_code'))
+
+        start_time = time.perf_counter()
+        try:
+            response = self.session.get(url, params=params, timeout=self.timeout)
+        except (requests.ConnectionError, requests.Timeout):
+            self.request_counter.inc(endpoint=endpoint, status='error')
+            if self.rate_limiter is not None:
+                self.rate_limiter.update(endpoint, None)
+            raise
+        self.latency_histogram.observe(time.perf_counter() - start_time, endpoint=endpoint)
+        self.request_counter.inc(endpoint=endpoint, status=response.status_code)
+        if self.rate_limiter is not None:
+            self.rate_limiter.update(endpoint, response.status_code, response.headers)
+        return response
+
+    def get_backoff(self, attempt):
+        # type: (int) -> float
+        """
+        リトライまでの待ち時間. 上限までの指数バックオフにジッタを加える(full jitter)
+        :param attempt: リトライの回数. 1から
+        :return: 待ち時間(秒)
+        """
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+
+    def parse_retry_after(self, retry_after):
+        # type: (str) -> float
+        """
+        Retry-Afterヘッダを待ち時間にする. 秒数とHTTPの日付の両方に対応する
+        :param retry_after: Retry-Afterヘッダ
+        :return: 待ち時間(秒). ヘッダが無いか読めなければNone
+        """
+        if not retry_after:
+            return None
+        try:
+            return min(max(float(retry_after), 0.0), self.backoff_max)
+        except ValueError:
+            pass
+        try:
+            retry_date = parsedate_to_datetime(retry_after)
+            return min(max((retry_date - dt.now(retry_date.tzinfo)).total_seconds(), 0.0), self.backoff_max)
+        except (TypeError, ValueError):
+            return None
+
+    def check_health(self, url, params=None):
+        # type: (str, dict) -> None
+        """
+        サーバのステータスを確認しログへ出力する
+        :param url: エラーになったAPIのURL. 同じドメインのステータスを確認する
+        :param params: エラーになったリクエストのパラメータ. product_codeがあればそのプロダクトのステータスを確認する
+        :return:
+        """
+        if self.health_check_params is None:
+            return
+        health_check_url = urlunsplit(urlsplit(url)[:2] + (self.health_check_path, '', ''))
+        # 複数のプロダクトで共有している場合も、エラーになったプロダクトのステータスを確認する
+        health_check_params = dict(self.health_check_params)
+        if params and 'product_code' in params:
+            health_check_params['product_code'] = params['product_code']
+        product_code = health_check_params.get('product_code', '')
+        try:
+            status = self.send(health_check_url, health_check_params)
+            self.logger.logger.error('server status {}: {}'.format(product_code, status.text))
+        except requests.RequestException as e:
+            self.logger.logger.error('server status {}: {}'.format(product_code, e))
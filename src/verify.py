@@ -0,0 +1,417 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This module verifies the continuity of stored execution ids.
+Other products take the ids in between, so ids of a product are not consecutive.
+The ids of each file are kept as intervals in which no more than max_gap ids (about one api page) are skipped,
+in an index cached by the size and mtime of the file, so that duplicates and gaps are found without loading the data again.
+Overlapping files are merged into files without duplicates and gaps are fetched again from the api.
+"""
+
+import os
+import json
+import time
+import argparse
+import numpy as np
+import pandas as pd
+import logger
+import storage
+
+
+class IdIntervalIndex(object):
+    """
+    This class keeps the id intervals of each stored file and id ranges verified to have no executions.
+    """
+
+    def __init__(self, btc_storage, max_gap=500):
+        # type: (storage.BtcStorage, int) -> None
+        """
+        Class initialization.
+        :param btc_storage: 確認するbtcデータのストレージ
+        :param max_gap: 区間の中で飛ばしてよいidの数. これ以下の間隔は他のプロダクトのidとみなす
+        """
+        self.storage = btc_storage
+        self.index_file = os.path.join(btc_storage.data_dir, '.id_intervals.json')
+        self.max_gap = max_gap
+
+        # ファイル名 -> {size, mtime, rows: 行数, unique: idの数, intervals: [[最初のid, 最後のid], ...]}
+        self.entries = {}
+        # APIで取得し直しても約定が無かったidの範囲. [[最初のid, 最後のid], ...]
+        self.verified = []
+        self.load()
+
+    def load(self):
+        # type: () -> None
+        """
+        保存されたインデックスを読み込む
+        :return:
+        """
+        if not os.path.exists(self.index_file):
+            return
+
+        with open(self.index_file) as f:
+            index = json.load(f)
+        self.verified = index['verified']
+        # 区間のまとめ方が変わった場合は全てのファイルを読み込み直す
+        if index.get('max_gap') == self.max_gap:
+            self.entries = index['files']
+
+    def save(self):
+        # type: () -> None
+        """
+        インデックスを保存する. 途中で止まっても壊れないように一時ファイルから置き換える
+        :return:
+        """
+        writing_file = self.index_file + '.writing'
+        with open(writing_file, 'w') as f:
+            json.dump({'max_gap': self.max_gap, 'files': self.entries, 'verified': self.verified}, f,
+                      sort_keys=True)
+        os.replace(writing_file, self.index_file)
+
+    def update(self):
+        # type: () -> int
+        """
+        追加, 変更されたファイルのidだけを読み込み、削除されたファイルを取り除く
+        :return: 読み込んだファイル数
+        """
+        file_list = self.storage.list_files()
+        for file_name in set(self.entries) - set(file_list):
+            self.entries.pop(file_name)
+
+        read_count = 0
+        for file_name in file_list:
+            stat = os.stat(os.path.join(self.storage.data_dir, file_name))
+            entry = self.entries.get(file_name)
+            if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+                continue
+
+            exec_id = self.storage.load(file_name, columns=['id'])['id'].values
+            unique_id = get_unique_ids(exec_id)
+            self.entries[file_name] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'rows': len(exec_id),
+                                       'unique': len(unique_id),
+                                       'intervals': to_intervals(unique_id, self.max_gap).tolist()}
+            read_count += 1
+
+        self.save()
+        return read_count
+
+    def add_verified(self, first_id, last_id):
+        # type: (int, int) -> None
+        """
+        約定が無いことを確認したidの範囲を記録する
+        :param first_id: 範囲の最初のid
+        :param last_id: 範囲の最後のid
+        :return:
+        """
+        self.verified = merge_intervals(np.array(self.verified + [[first_id, last_id]], dtype=np.int64),
+                                        self.max_gap).tolist()
+
+    def get_file_intervals(self):
+        # type: () -> tuple
+        """
+        全ファイルのidの区間を最初のidの順に並べる
+        :return: (区間の配列 (n, 2), 区間ごとのファイル名のリスト)
+        """
+        interval_list, owner_list = [], []
+        for file_name in sorted(self.entries):
+            intervals = self.entries[file_name]['intervals']
+            interval_list += intervals
+            owner_list += [file_name] * len(intervals)
+
+        intervals = np.array(interval_list, dtype=np.int64).reshape(-1, 2)
+        order = np.argsort(intervals[:, 0], kind='stable')
+        return intervals[order], [owner_list[x] for x in order]
+
+    def check(self):
+        # type: () -> dict
+        """
+        重複とmax_gapより長く約定が無いidの範囲を求める
+        :return: rows: 行数, unique: idの数, duplicates: 重複した行数, first_id, last_id,
+                 groups: 重複するファイルのまとまりのリスト, gaps: 約定が無いidの範囲の配列 (n, 2)
+        """
+        intervals, owner_list = self.get_file_intervals()
+        rows = sum(x['rows'] for x in self.entries.values())
+        merged = merge_intervals(intervals, self.max_gap)
+
+        # 重複はまとまりのファイルにしか無いので、そのファイルのidだけを読み込んで数える
+        groups = self.get_overlap_groups(intervals, owner_list)
+        duplicates = 0
+        for group in groups:
+            exec_id = np.concatenate([self.storage.load(x, columns=['id'])['id'].values for x in group])
+            duplicates += len(exec_id) - len(get_unique_ids(exec_id))
+
+        # 約定が無いことを確認した範囲は欠けているとみなさない
+        covered = merge_intervals(np.concatenate([merged, np.array(self.verified, dtype=np.int64).reshape(-1, 2)]),
+                                  self.max_gap)
+        if len(merged) > 0:
+            covered = covered[(covered[:, 1] >= merged[0, 0]) & (covered[:, 0] <= merged[-1, 1])]
+
+        return {'rows': rows,
+                'unique': rows - duplicates,
+                'duplicates': duplicates,
+                'first_id': int(merged[0, 0]) if len(merged) > 0 else None,
+                'last_id': int(merged[-1, 1]) if len(merged) > 0 else None,
+                'groups': groups,
+                'gaps': np.stack([covered[:-1, 1] + 1, covered[1:, 0] - 1], axis=1)}
+
+    def get_overlap_groups(self, intervals, owner_list):
+        # type: (ndarray, list) -> list
+        """
+        同じidを持つファイルのまとまりを求める. ファイルの中で重複している場合もまとまりにする
+        :param intervals: 最初のidの順に並べた区間の配列
+        :param owner_list: 区間ごとのファイル名
+        :return: ファイル名のリストのリスト. 古い順
+        """
+        # ファイル名 -> まとまりの代表のファイル名
+        parent = {}
+
+        def find(file_name):
+            while parent.get(file_name, file_name) != file_name:
+                file_name = parent[file_name]
+            return file_name
+
+        for file_name, entry in self.entries.items():
+            if entry['rows'] > entry['unique']:
+                parent.setdefault(file_name, file_name)
+
+        # 直前までの区間で最も大きい最後のidと重なる区間のファイルを同じまとまりにする
+        max_end, max_owner = None, None
+        for (first_id, last_id), file_name in zip(intervals.tolist(), owner_list):
+            if max_end is not None and first_id <= max_end and file_name != max_owner:
+                parent.setdefault(file_name, file_name)
+                parent.setdefault(max_owner, max_owner)
+                parent[find(file_name)] = find(max_owner)
+            if max_end is None or last_id > max_end:
+                max_end, max_owner = last_id, file_name
+
+        group_dict = {}
+        for file_name in parent:
+            group_dict.setdefault(find(file_name), []).append(file_name)
+        return [sorted(x, key=self.storage.get_sort_key) for x in group_dict.values()]
+
+
+class IdVerifier(object):
+    """
+    This class reports duplicates and gaps of stored ids, merges overlapping files and fetches missing ids.
+    """
+
+    def __init__(self, root_logger, data_dir='./data', storage_format='csv', product_code='FX_BTC_JPY',
+                 file_lines=500000, max_report=20, max_gap=500):
+        # type: (logger, str, str, str, int, int, int) -> None
+        """
+        Class initialization.
+        :param root_logger: ロガー
+        :param data_dir: btcデータのディレクトリ
+        :param storage_format: csv or parquet
+        :param product_code: 取得し直す際のプロダクトコード
+        :param file_lines: 保存し直す際の1ファイルの行数
+        :param max_report: ログに出す約定が無い範囲の数
+        :param max_gap: この数より長く約定が無いidの範囲だけを確認する. APIの1ページ分程度
+        """
+        self.logger = root_logger
+        self.storage = storage.BtcStorage(data_dir, storage_format)
+        self.index = IdIntervalIndex(self.storage, max_gap)
+        self.product_code = product_code
+        self.file_lines = file_lines
+        self.max_report = max_report
+
+    def run(self, is_dedup=False, get_btc=None):
+        # type: (bool, GetBtcDataFromBitflyer) -> dict
+        """
+        重複と欠けているidを確認する. 指定されていれば重複を取り除き、欠けているidを取得し直してから確認し直す
+        :param is_dedup: 重複するファイルをまとめ直す
+        :param get_btc: 欠けているidを取得するGetBtcDataFromBitflyer. 指定がなければ取得しない
+        :return: checkの結果
+        """
+        result = self.check()
+        if is_dedup and result['groups']:
+            for group in result['groups']:
+                self.dedup(group)
+            result = self.check()
+
+        if get_btc is not None and len(result['gaps']) > 0:
+            # 1ページ分より近い範囲は一つの窓にまとめて取得する
+            windows = merge_intervals(result['gaps'], get_btc.count)
+            self.logger.logger.info('refetch {} gaps in {} windows'.format(len(result['gaps']), len(windows)))
+            for first_id, last_id in windows[::-1].tolist():
+                gaps = result['gaps'][(result['gaps'][:, 0] >= first_id) & (result['gaps'][:, 1] <= last_id)]
+                self.refetch(get_btc, first_id, last_id, gaps)
+            result = self.check()
+        return result
+
+    def check(self):
+        # type: () -> dict
+        """
+        インデックスを更新し、重複と欠けているidの範囲をログへ出す
+        :return: checkの結果
+        """
+        start_time = time.perf_counter()
+        read_count = self.index.update()
+        result = self.index.check()
+
+        self.logger.logger.info('{} files ({} read), {} rows, ids {} - {} in {:.3f} sec'.format(
+            len(self.index.entries), read_count, result['rows'], result['first_id'], result['last_id'],
+            time.perf_counter() - start_time))
+        self.logger.logger.info('duplicates: {} rows in {} groups of files'.format(
+            result['duplicates'], len(result['groups'])))
+        for group in result['groups'][:self.max_report]:
+            self.logger.logger.info(' overlap: {}'.format(', '.join(group)))
+        self.logger.logger.info('gaps: {} ranges of more than {} ids without executions'.format(
+            len(result['gaps']), self.index.max_gap))
+        for first_id, last_id in result['gaps'][:self.max_report].tolist():
+            self.logger.logger.info(' gap: {} - {}'.format(first_id, last_id))
+        return result
+
+    def dedup(self, group):
+        # type: (list) -> None
+        """
+        同じidを持つファイルを読み込み、重複を取り除いてfile_linesごとに保存し直す.
+        新しいファイルを保存してから古いファイルを削除する
+        :param group: ファイル名のリスト
+        :return:
+        """
+        df_btc = pd.concat([self.storage.load(x) for x in group])
+        if self.storage.storage_format == 'parquet':
+            df_btc = storage.BtcStorage.to_csv_frame(df_btc)
+        df_btc = df_btc.drop_duplicates('id').sort_values('id', ascending=False)
+
+        saved_list = []
+        for i in range(0, len(df_btc), self.file_lines):
+            saved_list += [os.path.relpath(x, self.storage.data_dir)
+                           for x in self.storage.save(df_btc.iloc[i:i + self.file_lines])]
+        for file_name in set(group) - set(saved_list):
+            os.remove(os.path.join(self.storage.data_dir, file_name))
+        self.logger.logger.info('dedup {} files into {} files ({} rows)'.format(len(group), len(saved_list),
+                                                                              len(df_btc)))
+
+    def refetch(self, get_btc, first_id, last_id, gaps=None):
+        # type: (GetBtcDataFromBitflyer, int, int, ndarray) -> None
+        """
+        窓の範囲をbeforeとcountでページごとにAPIから取得し、約定が無かった範囲の約定だけを保存する.
+        窓全体を確認済みとして一度だけ記録する
+        :param get_btc: APIを叩くGetBtcDataFromBitflyer
+        :param first_id: 窓の最初のid
+        :param last_id: 窓の最後のid
+        :param gaps: 窓の中の約定が無かった範囲の配列 (n, 2). 指定がなければ窓全体
+        :return:
+        """
+        if gaps is None:
+            gaps = np.array([[first_id, last_id]], dtype=np.int64)
+        params = {'product_code': self.product_code, 'count': get_btc.count,
+                  'before': last_id + 1, 'after': first_id - 1}
+        chunk_list = []
+        requests = 0
+        while params['before'] > first_id:
+            tmp_df = pd.DataFrame(get_btc.execute_api_request(params), columns=get_btc.keys)
+            requests += 1
+            if tmp_df.empty:
+                break
+            # 保存済みの約定と重複しないように範囲の中の約定だけを残す
+            exec_id = tmp_df['id'].values.astype(np.int64)
+            position = np.searchsorted(gaps[:, 0], exec_id, side='right') - 1
+            is_gap = (position >= 0) & (exec_id <= gaps[np.maximum(position, 0), 1])
+            chunk_list.append(tmp_df[is_gap])
+            params['before'] = int(exec_id.min())
+
+        rows = sum(len(x) for x in chunk_list)
+        if rows > 0:
+            df_btc = pd.concat(chunk_list).drop_duplicates('id').sort_values('id', ascending=False)
+            for file_name in self.storage.save(df_btc):
+                self.logger.logger.info(' save on {}'.format(file_name))
+        self.index.add_verified(first_id, last_id)
+        self.index.save()
+        self.logger.logger.info('refetch ids {} - {}: {} rows in {} requests'.format(first_id, last_id, rows,
+                                                                                    requests))
+
+
+def get_unique_ids(exec_id):
+    # type: (ndarray) -> ndarray
+    """
+    重複を除いたidを昇順に並べる
+    :param exec_id: idの配列. 順番と重複は問わない
+    :return: int64の配列
+    """
+    exec_id = np.asarray(exec_id, dtype=np.int64)
+    if len(exec_id) == 0:
+        return exec_id
+
+    # 保存したデータはidの降順なので、反転するだけで昇順になる
+    if np.all(exec_id[1:] <= exec_id[:-1]):
+        exec_id = exec_id[::-1]
+    elif not np.all(exec_id[1:] >= exec_id[:-1]):
+        exec_id = np.sort(exec_id)
+    return exec_id[np.r_[True, exec_id[1:] != exec_id[:-1]]]
+
+
+def to_intervals(exec_id, max_gap=0):
+    # type: (ndarray, int) -> ndarray
+    """
+    idを区間にまとめる. 間に飛ばしたidがmax_gap以下であれば同じ区間にする
+    :param exec_id: idの配列. 順番と重複は問わない
+    :param max_gap: 区間の中で飛ばしてよいidの数. 0であれば連続するidだけをまとめる
+    :return: [最初のid, 最後のid]の配列 (n, 2). idの昇順
+    """
+    exec_id = get_unique_ids(exec_id)
+    if len(exec_id) == 0:
+        return np.zeros((0, 2), dtype=np.int64)
+
+    breaks = np.flatnonzero(exec_id[1:] > exec_id[:-1] + 1 + max_gap)
+    return np.stack([exec_id[np.r_[0, breaks + 1]], exec_id[np.r_[breaks, len(exec_id) - 1]]], axis=1)
+
+
+def merge_intervals(intervals, max_gap=0):
+    # type: (ndarray, int) -> ndarray
+    """
+    重なる, または間に飛ばしたidがmax_gap以下の区間をまとめる
+    :param intervals: [最初のid, 最後のid]の配列 (n, 2)
+    :param max_gap: 区間の間で飛ばしてよいidの数. 0であれば重なるか隣り合う区間だけをまとめる
+    :return: まとめた区間の配列. idの昇順
+    """
+    if len(intervals) == 0:
+        return np.zeros((0, 2), dtype=np.int64)
+    intervals = intervals[np.argsort(intervals[:, 0], kind='stable')]
+    max_end = np.maximum.accumulate(intervals[:, 1])
+    # 直前までの区間の最後のidからmax_gapより後から始まれば新しい区間
+    starts = np.flatnonzero(np.r_[True, intervals[1:, 0] > max_end[:-1] + 1 + max_gap])
+    ends = np.r_[starts[1:], len(intervals)] - 1
+    return np.stack([intervals[starts, 0], max_end[ends]], axis=1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-d', '--dir', help='directory of btc data', action='store', default='./data')
+    parser.add_argument('-f', '--format', help='storage format of btc data. csv or parquet', action='store',
+                        choices=['csv', 'parquet'], default='csv')
+    parser.add_argument('-p', '--product', help='product code used to fetch missing ids', action='store',
+                        default='FX_BTC_JPY')
+    parser.add_argument('--max-gap', help='ids that may be skipped in a range. longer gaps are reported '
+                                          '(other products take the ids in between)',
+                        action='store', type=int, default=500)
+    parser.add_argument('--dedup', help='merge files having the same ids into files without duplicates',
+                        action='store_true')
+    parser.add_argument('--refetch', help='fetch missing id ranges from the api', action='store_true')
+    parser.add_argument('-r', '--rate', help='requests per window to fetch missing ids', action='store', type=float,
+                        default=5.0)
+    parser.add_argument('--window', help='window of the request budget in seconds', action='store', type=float,
+                        default=1.0)
+    parser.add_argument('--domain-url', help='url of the api (ex. http://127.0.0.1:8080 for the mock server)',
+                        action='store', default='https://api.bitflyer.jp')
+
+    args = parser.parse_args()
+    assert os.path.exists(args.dir), 'Please make directry: {}'.format(args.dir)
+    assert os.path.exists('./log'), 'Please make directry: log dirctory'
+    logger = logger.Logger()
+    logger.logger.info('START verify')
+
+    arg_get_btc = None
+    if args.refetch:
+        import getbtc
+        arg_get_btc = getbtc.GetBtcDataFromBitflyer(None, None, logger, requests_per_window=args.rate,
+                                                    window_seconds=args.window, storage_format=args.format,
+                                                    product_code=args.product, data_dir=args.dir)
+        arg_get_btc.domain_url = args.domain_url
+
+    id_verifier = IdVerifier(logger, args.dir, args.format, args.product, max_gap=args.max_gap)
+    verify_result = id_verifier.run(args.dedup, arg_get_btc)
+    exit(0 if verify_result['duplicates'] == 0 and len(verify_result['gaps']) == 0 else 1)